@@ -388,6 +388,36 @@ def detect_noXlimbs (myimg):
     return flag_nobords
 
 
+def detect_edge_rows (img_c, r1, r2, largeur):
+    # detection des bords gauche et droit des lignes r1 a r2-1 de l'image clampée
+    # traite toutes les lignes ensemble : percentile par ligne, filtres gaussiens
+    # et gradient selon l'axe 1, donne les memes points que le traitement ligne par ligne
+    # largeur : largeur du disque x2-x1, les bords doivent etre écartés de plus de largeur/2
+    # retourne les listes bords gauches, bords droits et lignes
+    if r2 <= r1:
+        return [], [], []
+    li=img_c[r1:r2,:-5]
+    
+    #method detect_bord same as flat median
+    b=np.percentile(li,97,axis=1)
+    bb=b*0.7 #retour à 0.7 sinon accroche sur zones trop noires
+    if cfg.LowDyn :
+        #guillaume
+        bb=b*0.9 # faible dynamique, ne pas trop clamper
+    
+    # clamp au seuil de chaque ligne, converti dans le type de l'image comme li[li>bb]=bb
+    li=np.where(li>bb[:,np.newaxis], bb.astype(li.dtype)[:,np.newaxis], li)
+    li=gaussian_filter1d(li, 2, axis=1)
+    li_filter=gaussian_filter1d(li, 11, axis=1)
+    li_gr=np.gradient(li_filter, axis=1)
+    
+    x1li=li_gr.argmax(axis=1)
+    x2li=li_gr.argmin(axis=1)
+    
+    ok=(x1li!=0) & (x2li!=0) & ((x2li-x1li) > largeur/2)
+    rows=np.arange(r1,r2)
+    return list(x1li[ok]), list(x2li[ok]), rows[ok].tolist()
+
 def detect_edge (myimg,zexcl, crop, disp_log):
     edgeX = []
     edgeY = []
@@ -450,79 +480,13 @@ def detect_edge (myimg,zexcl, crop, disp_log):
     img_c[img_c>img_mean]=img_mean
  
         
-    k=0
-    s=[]
-    
     # scorie test zone differente resolu avec coupe demi disque bord droit et bord gauche
     ze1=ze 
     ze2=ze 
 
-
-    for i in range(y1+ze1,y2-ze2):
-        li=np.copy(img_c[i,:-5])
-        #myli=np.copy(img_c[i,:-5])
-        #myli=np.copy(img_c[i,:-5])
-        
-        
-        #method detect_bord same as flat median
-        offset=0
-        b=np.percentile(li,97)
-        bb=b*0.7 #retour à 0.7 sinon accroche sur zones trop noires
-        
-        
-        if cfg.LowDyn :
-            #guillaume
-            bb=b*0.9 # faible dynamique, ne pas trop clamper
-            #bb=65535
-         
-        
-        #bb=b
-        #print("seuil edge : ", b," ",bb)
-
-        li[li>bb]=bb
-        li=gaussian_filter1d(li, 2)
-        #li[li<4000]=30
-        #li_med=median_filter(li,size=50)
-        li_filter=gaussian_filter1d(li, 11)
-        li_gr=np.gradient(li_filter)
-        #li_gr=np.gradient(li_med)
-        
-        
-        x1li=li_gr.argmax()
-        x2li=li_gr.argmin()
-
-        
-        if 2==1 :
-            if i in range(y1+ze1+3, y1+ze1+5) :
-            #if x1 <2500 :
-                plt.plot(li)
-                plt.title('Profil ligne '+str(i))
-                plt.show()
-                #plt.plot(li_med)
-                #plt.title('Median Profil ligne '+str(i))
-                #plt.show()
-                plt.plot(li_gr)
-                plt.title('Gradient Profil ligne '+str(i))
-                plt.show()
-        
-
-
-        
-        #x_argsort=li_gr.argsort()
-        
-        if x1li==0 or x2li==0 :
-            pass
-        else:
-            s=np.array([x1li,x2li])
-            
-            if s.size !=0 and (s[-1]-s[0])> (x2-x1)/2:
-                c_x1=s[0]+offset
-                c_x2=s[-1]-offset
-                bord_gauche.append(c_x1)
-                bord_gaucheY.append(i)
-                bord_droit.append(c_x2)
-                bord_droitY.append(i)
-                k=k+1
+    # toutes les lignes en une seule operation 2D
+    bord_gauche, bord_droit, bord_gaucheY = detect_edge_rows(img_c, y1+ze1, y2-ze2, x2-x1)
+    bord_droitY = list(bord_gaucheY)
    
     bords=[bord_gauche, bord_droit]
     bordsY=[bord_gaucheY, bord_droitY] 
@@ -1001,30 +965,25 @@ def auto_crop_img (cam_height, h,w, frame, cercle0, debug_crop, param):
 
 def translate_img (img_mean, poly):
     # calcul des ecarts entre min et fit polynome
-    fit=[]
-    ecart=[]
-    LineRecal = 1
-    
     a=poly[0]
     b=poly[1]
     c=poly[2] # constante a y=0
     
     ih, iw = img_mean.shape
-    img_mean_redresse = np.copy (img_mean)
+    img_mean_redresse = np.empty_like(img_mean)
     
-    for y in range(0,ih):
-        x=a*y**2+b*y+c
-        ecart.append((x)-c)
+    y=np.arange(0,ih)
+    ecart=(a*y**2+b*y+c)-c
         
     # ensuite il faut decaler les lignes en fonction de ecart
-    for y in range(0,ih):
-        myline= img_mean[y:y+1,:][0]
-        # on interpole
-        f=interp1d(np.arange(0,iw)-ecart[y],myline,kind='linear',fill_value="extrapolate")
-        
-        interp_line = f(np.arange(0,iw))
-        img_mean_redresse[y:y+1,:] = interp_line
-
+    # la ligne y est lue aux positions x+ecart[y], en une seule fois pour toute l'image
+    # interpolation lineaire, extrapolée avec le premier et dernier segment comme interp1d
+    pos=np.arange(0,iw)[np.newaxis,:]+ecart[:,np.newaxis]
+    i0=np.clip(np.floor(pos).astype(int), 0, iw-2)
+    t=pos-i0
+    rows=y[:,np.newaxis]
+    img=img_mean.astype(np.float64, copy=False)
+    img_mean_redresse[...] = img[rows,i0]*(1-t) + img[rows,i0+1]*t
     
     return img_mean_redresse
 
@@ -1073,3 +1032,154 @@ def pic_histo (frame) :
     
     
 
+
+def frames_per_block (frames):
+    # nombre de trames traitées ensemble pour tenir dans cfg.BlockBytes
+    frame_bytes=max(1, frames[0].nbytes) if len(frames)>0 else 1
+    return max(1, int(cfg.BlockBytes//frame_bytes))
+
+def mean_frames (scan, FrameCount, flag_rotate, factor, start=1, step=1):
+    # somme des trames start, start+step, ... du fichier ser, par blocs de trames
+    # la rotation et le facteur sont appliqués une seule fois à la somme
+    # retourne la somme et le nombre de trames gardées
+    frames=scan.getFrames()
+    mydata=np.zeros(frames.shape[1:],dtype='uint64')
+    kept_frame=0
+    block_len=frames_per_block(frames)*step
+    
+    for FrameIndex in range(start, FrameCount, block_len):
+        block=frames[FrameIndex:min(FrameIndex+block_len, FrameCount):step]
+        # trames gardées si moyenne non nulle
+        valid=np.mean(block, axis=(1,2))>0
+        kept_frame=kept_frame+int(np.count_nonzero(valid))
+        mydata+=np.sum(block, axis=0, dtype='uint64', where=valid[:,None,None])
+    
+    if flag_rotate:
+        mydata=np.rot90(mydata)
+    
+    return np.ascontiguousarray(mydata*factor), kept_frame
+
+def slit_poly_stable (img1, img2, tol, pos_fente_min=0, pos_fente_max=0):
+    # compare les polynomes de la fente calculés sur deux images moyennes
+    # retourne True si l'ecart maximum entre les deux est inferieur a tol pixels
+    try :
+        img1=np.array(img1, dtype='uint16')
+        img2=np.array(img2, dtype='uint16')
+        iw=img1.shape[1]
+        y1,y2=detect_bord(img1, axis=1, offset=5, flag_disk=False)
+        if pos_fente_min != 0 :
+            img1=img1[:,pos_fente_min:]
+            img2=img2[:,pos_fente_min:]
+        if pos_fente_max != 0 :
+            img1=img1[:,0:-int(iw)+pos_fente_max]
+            img2=img2[:,0:-int(iw)+pos_fente_max]
+        IndY=np.arange(y1+30, y2-30,1)
+        p1=np.polyfit(IndY,np.argmin(img1, axis=1)[y1+30:y2-30],2)
+        p2=np.polyfit(IndY,np.argmin(img2, axis=1)[y1+30:y2-30],2)
+        ecart=np.max(np.abs(np.polyval(p1,IndY)-np.polyval(p2,IndY)))
+    except :
+        return False
+    
+    return ecart <= tol
+
+def slit_poly_match (img, p, tol):
+    # compare un polynome de la fente a celui calculé sur une image moyenne
+    # retourne True si l'ecart maximum entre les deux est inferieur a tol pixels
+    try :
+        img=np.array(img, dtype='uint16')
+        y1,y2=detect_bord(img, axis=1, offset=5, flag_disk=False)
+        IndY=np.arange(y1+30, y2-30,1)
+        p1=np.polyfit(IndY,np.argmin(img, axis=1)[y1+30:y2-30],2)
+        ecart=np.max(np.abs(np.polyval(p1,IndY)-np.polyval(p,IndY)))
+    except :
+        return False
+    
+    return ecart <= tol
+
+def slit_fit (a, b, c, ih, iw, LineRecal=1):
+    # position de la fente x=a*y**2+b*y+c pour chaque ligne y
+    # retourne la liste [partie entiere - LineRecal, partie decimale, y]
+    fit=[]
+    for y in range(0,ih):
+        x=a*y**2+b*y+c
+        deci=x-int(x)
+        # gere si modele polynome de la fente depasse la dimension image iw
+        # sinon code vectorisation va generer un pb d'indice 
+        if x<iw-3:
+            fit.append([int(x)-LineRecal,deci,y])
+        else:
+            fit.append([iw-3,0,y])
+    return fit
+
+def slit_indices (fit, range_dec, ih, iw, LineRecal=1):
+    # init vector to speed up from Andrew & Doug Smiths BUIL2 calcul poids interpol
+    # retourne les poids et les indices des colonnes gauche et droite pour chaque decalage
+    left_weights = np.ones(ih) - np.asarray(fit)[:, 1]
+    right_weights = np.ones(ih) - left_weights
+    
+    ind_l=[]
+    ind_r=[]
+    
+    for s in range_dec:
+        
+        ind_l.append((np.asarray(fit)[:, 0] + np.ones(ih) * (LineRecal + s)).astype(int))
+        # teste des bornes pour indices left
+        ind_l[len(ind_l)-1][(ind_l[len(ind_l)-1])>iw-1]=iw-1
+        ind_l[len(ind_l)-1][(ind_l[len(ind_l)-1])<=0]=0
+        
+        ind_r.append((ind_l[len(ind_l)-1] + np.ones(ih)).astype(int))
+        #teste des bornes pour indices right
+        ind_r[len(ind_l)-1][(ind_r[len(ind_l)-1])>iw-1]=iw-1
+        ind_r[len(ind_l)-1][(ind_r[len(ind_l)-1])<=0]=0
+    
+    return left_weights, right_weights, ind_l, ind_r
+
+def slit_gather (ind_l, ind_r):
+    # empile les indices gauche et droite de tous les decalages
+    # en une matrice (2, nb decalages, ih) pour une seule lecture par trame
+    return np.stack((np.asarray(ind_l), np.asarray(ind_r)))
+
+def slit_extract_block (block, rows, ind_lr, left_weights, right_weights, factor, flag_rotate, out):
+    # extrait tous les decalages d'un bloc de trames (K, H, W) lues du fichier ser
+    # sans les tourner : si flag_rotate, la ligne y et la colonne x de la trame
+    # tournée sont la colonne W-1-y et la ligne x de la trame
+    # out : tableau (nb decalages, ih, K) qui recoit les intensités
+    if flag_rotate:
+        cols = block[:, ind_lr, block.shape[2]-1-rows]
+    else:
+        cols = block[:, rows, ind_lr]
+    disk = (cols[:,0]*left_weights + cols[:,1]*right_weights)*factor
+    out[...] = np.moveaxis(disk, 0, -1)
+
+def slit_extract (img, rows, ind_lr, left_weights, right_weights, out):
+    # extrait en une fois les colonnes interpolées de tous les decalages
+    # rows : np.arange(ih), ind_lr : matrice de slit_gather
+    # out : tableau (nb decalages, ih) qui recoit les intensités
+    cols = img[rows, ind_lr]
+    out[...] = cols[0]*left_weights + cols[1]*right_weights
+
+def row_median_above (frame, seuil):
+    # mediane de chaque ligne en ne gardant que les pixels superieurs a seuil
+    # les lignes triées donnent les pixels gardés à la fin de chaque ligne
+    # retourne les medianes (nan si aucun pixel) et le nombre de pixels gardés
+    ih, iw = frame.shape
+    rows = np.sort(frame, axis=1)
+    count = iw - np.argmax(rows > seuil, axis=1)
+    count[rows[:,-1] <= seuil] = 0
+    start = iw - count
+    lo = np.minimum(start + (count-1)//2, iw-1)
+    hi = np.minimum(start + count//2, iw-1)
+    ind = np.arange(ih)
+    med = (rows[ind, lo].astype(np.float64) + rows[ind, hi]) / 2
+    med[count == 0] = np.nan
+    return med, count
+
+def flat_divide (frame, hf):
+    # divise chaque ligne de l'image par le profil de flat hf, par broadcasting
+    # sans construire l'image de flat
+    hf = np.array(hf, dtype=np.float64)
+    # Evite les divisions par zeros...
+    hf[hf == 0] = 1
+    BelleImage = np.divide(frame, hf[:, np.newaxis])
+    np.minimum(BelleImage, 65535, out=BelleImage) # bug saturation
+    return BelleImage.astype('uint16')
@@ -208,8 +208,11 @@ import sys
 import math
 import config as cfg
 from datetime import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 from Inti_functions import *
+from live_recon import load_live_recon
 try :
     from serfilesreader.serfilesreader import Serfile
 except ImportError : 
@@ -320,16 +323,24 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
     # ouverture du fichier ser
 
     try:
-        scan = Serfile(serfile, False)
+        # fichier mappé en memoire, les trames sont des vues sans copie
+        scan = Serfile(serfile, False, memmap=True)
     except:
         logme('Erreur ouverture fichier : '+serfile)
         
-    FrameCount = scan.getLength()    #      return number of frame in SER file.
+    FrameCount = len(scan.getFrames())    #      return number of complete frames in SER file.
     Width = scan.getWidth()          #      return width of a frame
     Height = scan.getHeight()        #      return height of a frame
     dateSerUTC = scan.getHeader()['DateTimeUTC']  
     dateSer=scan.getHeader()['DateTime']
     bitdepth=scan.getHeader()['PixelDepthPerPlane']
+    # trames perdues ou retardees pendant l'acquisition, d'apres les dates du trailer
+    frame_gaps = scan.findFrameGaps()
+    if len(frame_gaps) > 0 :
+        if cfg.LG == 1:
+            logme('Trames perdues ou retardees apres les trames : '+str(list(frame_gaps[:20])))
+        else:
+            logme('Dropped or stalled frames after frames : '+str(list(frame_gaps[:20])))
     #ser_header=scan._readExistingHeader()
     #print(ser_header)
     if bitdepth==8:
@@ -426,28 +437,48 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
         factor=1
 
     
-    #initialize le tableau qui recevra l'image somme de toutes les trames
-    mydata=np.zeros((hdr['NAXIS2'],hdr['NAXIS1']),dtype='uint64')
-    kept_frame=0
+    #ajoute les trames pour creer une image haut snr pour extraire
+    #les parametres d'extraction de la colonne du centre de la raie et la
+    #corriger des distorsions
+    # reconstruction faite pendant l'acquisition : image somme et polynome deja calculés
+    # sur toute la largeur, donc pas de zone de detection de la fente
+    live=None
+    if shift == 0 and factor == 1 and not flag_weak and not flag_pol and pos_fente_min == 0 and pos_fente_max == 0 :
+        live=load_live_recon(serfile, FrameCount)
+    if live is not None :
+        if cfg.LG == 1:
+            logme('Reconstruction pendant acquisition trouvée')
+        else:
+            logme('Live reconstruction found')
+        mydata=live['sum']
+        kept_frame=int(live['kept'])
+    
+    # on n'utilise qu'un echantillon des trames pour ne lire la sequence qu'une fois
+    # en entier, sauf si les polynomes de deux echantillons entrelacés ne concordent pas
+    mean_step=1
+    if cfg.MeanFrames > 0 :
+        mean_step=max(1, (FrameCount-1)//cfg.MeanFrames)
+    
+    if live is not None :
+        mean_step=0
+    
+    if mean_step > 1 :
+        mydata, kept_frame = mean_frames(scan, FrameCount, flag_rotate, factor, 1, mean_step)
+        mydata2, kept_frame2 = mean_frames(scan, FrameCount, flag_rotate, factor, 1+mean_step//2, mean_step)
+        flag_poly_auto = not ((flag_weak and Flags["FREE_AUTOPOLY"]!=1) or (flag_pol and Flags["ZEE_AUTOPOLY"]!=1))
+        if flag_poly_auto and not slit_poly_stable(mydata/max(1,kept_frame), mydata2/max(1,kept_frame2), cfg.MeanPolyTol, pos_fente_min, pos_fente_max) :
+            if cfg.LG == 1:
+                logme('Polynome instable sur echantillon, image moyenne sur toutes les trames')
+            else:
+                logme('Unstable polynomial on sample, mean image on all frames')
+            mean_step=1
+        else :
+            mydata=mydata+mydata2
+            kept_frame=kept_frame+kept_frame2
+        del mydata2
     
-    while FrameIndex < FrameCount and ok_flag:
-        try :
-            num = scan.readFrameAtPos(FrameIndex)
-        except:
-            print(FrameIndex)
-        if flag_rotate:
-            num=np.rot90(num)
-        num=num*factor
-        #ajoute les trames pour creer une image haut snr pour extraire
-        #les parametres d'extraction de la colonne du centre de la raie et la
-        #corriger des distorsions
-        frame_mean=np.mean(num)
-        if frame_mean>0 : # seuil arbitraire etait a 3000
-            mydata=np.add(num,mydata)
-            kept_frame=kept_frame+1
-        
-        #increment la trame et l'offset pour lire trame suivant du fichier .ser
-        FrameIndex=FrameIndex+1
+    if mean_step == 1 :
+        mydata, kept_frame = mean_frames(scan, FrameCount, flag_rotate, factor)
     
     #print('frame kept :', kept_frame, 'over ', FrameIndex)
     # calcul de l'image moyenne
@@ -457,6 +488,14 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
     iw= hdr['NAXIS1']                     # Largeur de l'image
     myimg=np.reshape(myimg, (ih, iw))   # Forme tableau X,Y de l'image moyenne
     
+    # le polynome verrouillé sur les premieres trames doit concorder avec celui de l'image moyenne
+    if live is not None and not slit_poly_match(myimg, live['poly'], cfg.MeanPolyTol) :
+        if cfg.LG == 1:
+            logme('Polynome de la reconstruction pendant acquisition rejeté')
+        else:
+            logme('Live reconstruction polynomial rejected')
+        live=None
+    
     # sauve en fits l'image moyenne avec suffixe _mean
     savefich=basefich+'_mean'              
     SaveHdu=fits.PrimaryHDU(myimg,header=hdr)
@@ -543,14 +582,19 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
             pass
         
         
-        # THE calcul pour obtenir la position de la fente sur la raie la plus sombre
-        MinX=np.argmin(myimg, axis=1)
-        # on reduit à la zone du spectre
-        MinX=MinX[PosRaieHaut+30:PosRaieBas-30]
-        IndY=np.arange(PosRaieHaut+30, PosRaieBas-30,1)
         LineRecal=1
-        #best fit d'un polynome degre 2, les lignes y sont les x et les colonnes x sont les y
-        p=np.polyfit(IndY,MinX,2)
+        if live is not None :
+            # polynome verrouillé pendant l'acquisition, en coordonnées de l'image entiere,
+            # deja verifié sur l'image moyenne
+            p=np.copy(live['poly'])
+        else :
+            # THE calcul pour obtenir la position de la fente sur la raie la plus sombre
+            MinX=np.argmin(myimg, axis=1)
+            # on reduit à la zone du spectre
+            MinX=MinX[PosRaieHaut+30:PosRaieBas-30]
+            IndY=np.arange(PosRaieHaut+30, PosRaieBas-30,1)
+            #best fit d'un polynome degre 2, les lignes y sont les x et les colonnes x sont les y
+            p=np.polyfit(IndY,MinX,2)
 
 
         """
@@ -614,19 +658,7 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
         #c = posx - a*posy**2 - b*posy 
 
               
-    fit=[]
-    #ecart=[]
-    
-    for y in range(0,ih):
-        x=a*y**2+b*y+c
-        deci=x-int(x)
-        # gere si modele polynome de la fente depasse la dimension image iw
-        # sinon code vectorisation va generer un pb d'indice 
-        if x<iw-3:
-            fit.append([int(x)-LineRecal,deci,y])
-        else:
-            fit.append([iw-3,0,y])
-        #ecart.append([x-LineRecal,y])
+    fit=slit_fit(a,b,c,ih,iw,LineRecal)
     
     logme('Coef a*x2,b*x,c :'+"{:.4e}".format(a)+' '+str("{:.4e}".format(b))+' '+str("{:.2f}".format(c)))
     # 11 aout 22 ajout du retour en param des coef du polynome pour logger dans ini.yaml
@@ -732,8 +764,15 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
         range_dec=[0,-1,1,-shift_vol-1, -shift_vol, -shift_vol+1,shift_vol-1,shift_vol,shift_vol+1]
 
     
-    for k in range_dec:
-        Disk.append(np.zeros((ih,FrameMax), dtype='uint16'))
+    # disques deja extraits pendant l'acquisition si tous les decalages y sont
+    flag_live_disk = live is not None and all(k in live['shifts'] for k in range_dec)
+    
+    # tableau (nb decalages, ih, FrameCount), Disk[i] est une vue sur le disque du decalage i
+    if flag_live_disk :
+        Disks=live['disk'][[live['shifts'].index(k) for k in range_dec]]
+    else :
+        Disks=np.zeros((len(range_dec),ih,FrameMax), dtype='uint16')
+    Disk=[Disks[i] for i in range(len(range_dec))]
     
     if flag_display:
                    
@@ -750,69 +789,35 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
 
         
     # init vector to speed up from Andrew & Doug Smiths BUIL2 calcul poids interpol
-    left_weights = np.ones(ih) - np.asarray(fit)[:, 1]
-    right_weights = np.ones(ih) - left_weights
+    left_weights, right_weights, ind_l, ind_r = slit_indices(fit, range_dec, ih, iw, LineRecal)
+    ind_lr = slit_gather(ind_l, ind_r)
+    rows = np.arange(ih)
     
-    ind_l=[]
-    ind_r=[]
     
-    for s in range_dec:
-        
-        ind_l.append((np.asarray(fit)[:, 0] + np.ones(ih) * (LineRecal + s)).astype(int))
-        # teste des bornes pour indices left
-        ind_l[len(ind_l)-1][(ind_l[len(ind_l)-1])>iw-1]=iw-1
-        ind_l[len(ind_l)-1][(ind_l[len(ind_l)-1])<=0]=0
-        
-        ind_r.append((ind_l[len(ind_l)-1] + np.ones(ih)).astype(int))
-        #teste des bornes pour indices right
-        ind_r[len(ind_l)-1][(ind_r[len(ind_l)-1])>iw-1]=iw-1
-        ind_r[len(ind_l)-1][(ind_r[len(ind_l)-1])<=0]=0
+    # Lance la reconstruction du disk a partir des trames, par blocs de trames
+    frames=scan.getFrames()
+    block_len=frames_per_block(frames)
     
-    
-    # Lance la reconstruction du disk a partir des trames
-    while FrameIndex < FrameCount :
+    while FrameIndex < FrameCount and not flag_live_disk :
         #t0=float(time.time())
-        img=scan.readFrameAtPos(FrameIndex)
-        img=img*factor
+        FrameEnd=min(FrameIndex+block_len, FrameCount)
         
-        # si fente orientée verticale on remet le spectre à l'horizontal
-        if flag_rotate:
-            img=np.rot90(img)
+        # Extraction de tous les decalages du bloc en une fois, ajoute au tableau disk
+        slit_extract_block(frames[FrameIndex:FrameEnd], rows, ind_lr, left_weights, right_weights, factor, flag_rotate, Disks[:,:,FrameIndex:FrameEnd])
         
-        # si flag_display vrai montre trame en temps reel
+        # si flag_display vrai montre la derniere trame du bloc
         if flag_display:
+            img=frames[FrameEnd-1]*factor
+            # si fente orientée verticale on remet le spectre à l'horizontal
+            if flag_rotate:
+                img=np.rot90(img)
             cv2.imshow('image', img)
             if cv2.waitKey(1)==27:
                 cv2.destroyAllWindows()
                 sys.exit()
-                
-        # Boucle sur les decalages
-        i=0
-        for i in range(0,len(range_dec)): 
-            # vector slit
-            left_col = img[np.arange(ih), ind_l[i]]
-            right_col = img[np.arange(ih), ind_r[i]]
-            # prevent saturation overflow for saturated areas
-            #left_col[left_col>64500]=64500
-            #right_col[right_col>64500]=64500
-        
-            IntensiteRaie = (left_col*left_weights + right_col*right_weights)
-            
-            # guillaume
-            #test point chaud
-            #original=np.copy(IntensiteRaie)
-            # gr=np.divide(IntensiteRaie,savgol_filter(IntensiteRaie,41, 3))
-            # hot=np.argwhere(gr>1)
-            # a= ndimage.median_filter(IntensiteRaie, size=3)
-            # #IntensiteRaie=np.where(IntensiteRaie <th, a, IntensiteRaie)
-            # IntensiteRaie[hot]=a[hot]
             
-            # Ajoute au tableau disk 
-            Disk[i][:,FrameIndex]=IntensiteRaie
-            
-        # Display reconstruction of the disk refreshed every 30 lines
-        refresh_lines=int(20)
-        if flag_display and FrameIndex %refresh_lines ==0:
+        # Display reconstruction of the disk refreshed every block
+        if flag_display:
             disk_display=[]
             disk_display=np.copy(Disk[0])*2
             cv2.imshow ('disk', disk_display)
@@ -820,7 +825,10 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
                      cv2.destroyAllWindows()
                      sys.exit()
     
-        FrameIndex=FrameIndex+1
+        FrameIndex=FrameEnd
+    
+    # libere le mapping du fichier ser
+    scan.close()
    
     # reduction de bruit - moyenne de 3 colonnes
     if (kend == 1 and Flags["NOISEREDUC"] ==1)  or (Flags["NOISEREDUC"]== 1 and Flags["WEAK"]) or (Flags["NOISEREDUC"]== 1 and Flags["POL"]) :
@@ -894,840 +902,887 @@ def solex_proc(serfile,Shift, Flags, ratio_fixe,ang_tilt, poly, data_entete,ang_
     -------------------------------------------------------------------------
     """
     
-    for k in range(0,kend):
-        
-        logme(' ')
-        logme(msg[k])
-        """
-        --------------------------------------------------------------------
-        Calcul des mauvaises lignes et de la correction geometrique
-        --------------------------------------------------------------------
-        """
-        # guillaume
-        # elimine premiere colonne qui serait à zéro
-        Disk[k][:,0]=50
-     
-     
-        
-        iw=Disk[k].shape[1]
-        ih=Disk[k].shape[0]
-        img=Disk[k]
-        
+    # contexte partagé par les disques, complété par la geometrie du disque k=0
+    ctx={'hdr':hdr, 'WorkDir':WorkDir, 'basefich':basefich, 'img_suff':img_suff, 'msg':msg,
+         'filename_suffixe':filename_suffixe, 'ang_P':ang_P, 'cam_height':cam_height,
+         'param':param, 'solar_dict':solar_dict, 'flag_flipRA':flag_flipRA, 'flag_flipNS':flag_flipNS,
+         'auto_crop':auto_crop, 'flag_force':flag_force, 'ang_tilt':ang_tilt,
+         'ratio_fixe':ratio_fixe, 'geom':geom}
+    
+    # le disque k=0 fixe le ratio, le tilt et le cercle des autres disques
+    frame, cercleC, ctx = disk_proc(0, Disk[0], ctx)
+    frames.append(frame)
+    
+    with  open(os.path.join(WorkDir,basefich+'_log.txt'), "w") as logfile:
+        logfile.writelines(mylog)
+    
+    # les decalages k>0 sont indépendants, traités en parallele sur plusieurs processus
+    nb_workers=min(cfg.DiskWorkers, kend-1)
+    ctx_k=ctx
+    if nb_workers > 1 :
+        with ProcessPoolExecutor(max_workers=nb_workers, mp_context=multiprocessing.get_context('spawn')) as pool :
+            futures=[pool.submit(disk_proc_worker, k, Disk[k], ctx) for k in range(1,kend)]
+            for future in futures :
+                frame, cercleC, ctx_k, log = future.result()
+                mylog.extend(log)
+                frames.append(frame)
+    else :
+        for k in range(1,kend):
+            frame, cercleC, ctx_k = disk_proc(k, Disk[k], ctx)
+            frames.append(frame)
+    hdr=ctx_k['hdr']
     
+    with  open(os.path.join(WorkDir,basefich+'_log.txt'), "w") as logfile:
+        logfile.writelines(mylog)
     
-        y1,y2=detect_bord (img, axis=1,offset=5, flag_disk=True)    # bords verticaux
-        
-        #detection de mauvaises lignes
-        
-        # somme de lignes projetées sur axe Y
-        #img_blur=cv2.GaussianBlur(img,(3,3),0)
-        ysum_img=np.mean(img,1)
-        
-        
-        # ne considere que les lignes du disque avec marge de 15 lignes 
-        marge=15
-        ysum=ysum_img[y1+marge:y2-marge]
-        
-        # choix methode par fit polynome et division
-        # ou detection des lignes et mediane 
-        methode_poly= False
-        debug=False
+
+    return frames, hdr, cercleC, range_dec, geom, poly
+
+
+def disk_proc(k, disk, ctx):
+    """
+    ----------------------------------------------------------------------------
+    Traitement du disque brut du decalage k : mauvaises lignes, flat, tilt,
+    circularisation, inversions, rotation et crop
+    
+    ctx: parametres du traitement et geometrie du disque k=0 (ratio, tilt, cercle)
+    utilisée pour les decalages k>0
+    Retourne l'image finale, le cercle et le contexte mis à jour
+    ----------------------------------------------------------------------------
+    """
+    hdr=ctx['hdr']
+    WorkDir=ctx['WorkDir']
+    basefich=ctx['basefich']
+    img_suff=ctx['img_suff']
+    msg=ctx['msg']
+    filename_suffixe=ctx['filename_suffixe']
+    ang_P=ctx['ang_P']
+    cam_height=ctx['cam_height']
+    param=ctx['param']
+    solar_dict=ctx['solar_dict']
+    flag_flipRA=ctx['flag_flipRA']
+    flag_flipNS=ctx['flag_flipNS']
+    auto_crop=ctx['auto_crop']
+    flag_force=ctx['flag_force']
+    ang_tilt=ctx['ang_tilt']
+    ratio_fixe=ctx['ratio_fixe']
+    geom=ctx['geom']
+    ratio_fixe_d1=ctx.get('ratio_fixe_d1')
+    cercle0=ctx.get('cercle0')
+    cercle=ctx.get('cercle')
+    r=ctx.get('r')
+    
+
+    
+    logme(' ')
+    logme(msg[k])
+    """
+    --------------------------------------------------------------------
+    Calcul des mauvaises lignes et de la correction geometrique
+    --------------------------------------------------------------------
+    """
+    # guillaume
+    # elimine premiere colonne qui serait à zéro
+    disk[:,0]=50
  
-        # filtrage sur fenetre de 31 pixels, polynome ordre 3 (etait 101 avant)
-        yc=savgol_filter(ysum,41, 3)
-        """
-        #polynome
-        xval=np.arange(0,y2-y1-2*marge,1)
-        p = np.polyfit(xval,ysum,6)
-        fit=[]
-        for x in xval:
-            fitv = p[0]*x**6+p[1]*x**5+p[2]*x**4+p[3]*x**3+p[4]*x**2+p[5]*x+p[6]
-            fit.append(fitv)
-        #print('Coef poly ',p)
-        #fp = ysum-np.array(fit)
-        yc=np.array(fit)
-        """
-        if debug :
-            # affichage debug
-            plt.plot(yc)
-            plt.plot(ysum)
-            plt.show()
-      
+ 
+    
+    iw=disk.shape[1]
+    ih=disk.shape[0]
+    img=disk
+    
+
+
+    y1,y2=detect_bord (img, axis=1,offset=5, flag_disk=True)    # bords verticaux
+    
+    #detection de mauvaises lignes
+    
+    # somme de lignes projetées sur axe Y
+    #img_blur=cv2.GaussianBlur(img,(3,3),0)
+    ysum_img=np.mean(img,1)
+    
     
-        # divise le profil somme par le profil filtré pour avoir les hautes frequences
-        hcol1=np.divide(ysum,yc)
-        hcol=np.copy(hcol1)
+    # ne considere que les lignes du disque avec marge de 15 lignes 
+    marge=15
+    ysum=ysum_img[y1+marge:y2-marge]
+    
+    # choix methode par fit polynome et division
+    # ou detection des lignes et mediane 
+    methode_poly= False
+    debug=False
+ 
+    # filtrage sur fenetre de 31 pixels, polynome ordre 3 (etait 101 avant)
+    yc=savgol_filter(ysum,41, 3)
+    """
+    #polynome
+    xval=np.arange(0,y2-y1-2*marge,1)
+    p = np.polyfit(xval,ysum,6)
+    fit=[]
+    for x in xval:
+        fitv = p[0]*x**6+p[1]*x**5+p[2]*x**4+p[3]*x**3+p[4]*x**2+p[5]*x+p[6]
+        fit.append(fitv)
+    #print('Coef poly ',p)
+    #fp = ysum-np.array(fit)
+    yc=np.array(fit)
+    """
+    if debug :
+        # affichage debug
+        plt.plot(yc)
+        plt.plot(ysum)
+        plt.show()
+  
 
+    # divise le profil somme par le profil filtré pour avoir les hautes frequences
+    hcol1=np.divide(ysum,yc)
+    hcol=np.copy(hcol1)
 
-        # met à zero les pixels dont l'intensité est inferieur à 1.03 (3%)
-        #hcol[abs(hcol1-1)<= 0.02]=0
-        hcol[(hcol1-1)>=-0.02]=0
 
-        if debug :
-            # affichage debug
-            plt.plot(hcol1)
-            plt.plot(hcol)
-            plt.show()
+    # met à zero les pixels dont l'intensité est inferieur à 1.03 (3%)
+    #hcol[abs(hcol1-1)<= 0.02]=0
+    hcol[(hcol1-1)>=-0.02]=0
 
+    if debug :
+        # affichage debug
+        plt.plot(hcol1)
+        plt.plot(hcol)
+        plt.show()
+
+    # tableau de zero en debut et en fin pour completer le tableau du disque
+    a=[0]*(y1+marge)
+    b=[0]*(ih-y2+marge)
+    hcol=np.concatenate((a,hcol,b))
+    
+
+    # creation du tableau d'indice des lignes a corriger
+    l_col=np.where(hcol!=0)
+    listcol=l_col[0]
+    #print(listcol)
+    
+    # doit etre abandonné
+    # demarre a x constant et gain trop fort
+    # et poly ne convient pas pour disque tronqué
+
+    if methode_poly:
+        # on ne clamp pas le profil
+        hcol=1+((ysum-yc)/yc)
+        hcol[hcol-1>-0.03]=1
         # tableau de zero en debut et en fin pour completer le tableau du disque
-        a=[0]*(y1+marge)
-        b=[0]*(ih-y2+marge)
+        a=[1]*(y1+marge)
+        b=[1]*(ih-y2+marge)
         hcol=np.concatenate((a,hcol,b))
         
-
-        # creation du tableau d'indice des lignes a corriger
-        l_col=np.where(hcol!=0)
-        listcol=l_col[0]
-        #print(listcol)
-        
-        # doit etre abandonné
-        # demarre a x constant et gain trop fort
-        # et poly ne convient pas pour disque tronqué
-    
-        if methode_poly:
-            # on ne clamp pas le profil
-            hcol=1+((ysum-yc)/yc)
-            hcol[hcol-1>-0.03]=1
-            # tableau de zero en debut et en fin pour completer le tableau du disque
-            a=[1]*(y1+marge)
-            b=[1]*(ih-y2+marge)
-            hcol=np.concatenate((a,hcol,b))
-            
-            if debug :
-                #affichage debug
-                plt.plot(hcol)
-                plt.title('hcol_poly')
-                plt.show()
-            
-            # Geénère tableau image de flat 
-            flat_hf=[]
-            for i in range(0,iw):
-                flat_hf.append(hcol)
-                
-            np_flat_hf=np.asarray(flat_hf)
-            flat_hf = np_flat_hf.T
-            
-            # Evite les divisions par zeros...
-            flat_hf[flat_hf==0]=1
-            
-            # somme des lignes mauvaises le log de x
-            #hsum=np.mean(img[listcol],0)
-            m=np.mean(img,0)
-            hsum=np.max(m)/m
-            hsum[hsum>2]=1
-            #hsum=savgol_filter(hsum,31, 3)
-            
-            if debug :
-                plt.plot(hsum)
-                plt.show()
-            
-            # flat pondere en x 
-            
-            for i in listcol :
-                flat_hf[i,:]=flat_hf[i,:]/hsum
-               
-            if debug :
-                # affichage debug
-                plt.imshow(flat_hf)
-                plt.show()
-                
-            # Divise image par le flat
-            b=np.divide(img,flat_hf)
-            img=np.array(b, dtype='uint16')
-            
-        else :
-            origimg=np.copy(img)
-            # correction de lignes par filtrage median 13 lignes, empririque
-            if debug : print(listcol)
-            lines=[]
-            lines_collection=[]
-            try :
-                lines.append(listcol[0])
-                for i in range(1,len(listcol)-1):
-                    if listcol[i]-listcol[i-1] ==1 :
-                        lines.append(listcol[i])
-                    else :
-                        lines_collection.append(lines)
-                        lines=[]
-                        lines.append(listcol[i])
-                if debug : print(lines_collection)
-            except:
-                pass
-            
-            for c in listcol:
-                m=origimg[c-11:c+10,] #now refer to original image
-                # calcul de la mediane sur 10 lignes de part et d'autres
-                # suppression de 2 colonnes en debut et fin qui peuvent être à zéro
-                s=np.median(m[:,2:-2],0)
-                
-                #on prepare un patch de 2 valeurs 
-                a=[m[0][3],m[0][-3]]
-                #on ajoute les patchs
-                s=np.concatenate((a,s,a))
-                
-                #on remplace la ligne defectueuse
-                #s=0 #pour visualiser la ligne idetifiée comme defectueuse
-                img[c:c+1,]=s #fix bug ecart une ligne
-            
-          
-            """
-            for c in lines_collection :
-                d=2
-                m1 = origimg[c[0]-d,]
-                m2 = origimg[c[len(c)-1]+d,]
-                m=np.array([m1,m2])
-                # suppression de 2 colonnes en debut et fin qui peuvent être à zéro
-                s=np.median(m[:,2:-2],0)
-                #on prepare un patch de 2 valeurs 
-                a=[s[0],s[-1]]
-                #on ajoute les patchs
-                s=np.concatenate((a,s,a))
-                
-                #on remplace la ligne defectueuse
-                #s=0
-                for i in c :
-                    img[i:i+1,]=s #fix bug ecart une ligne
-            """ 
-        debug=False
         if debug :
-            # affichage debug
-            plt.plot(ysum_img)
-            plt.plot(np.mean(img,1))
-            plt.title('avant-apres')
+            #affichage debug
+            plt.plot(hcol)
+            plt.title('hcol_poly')
             plt.show()
-            # test sauve image apres correction pour debug
-            DiskHDU=fits.PrimaryHDU(img,header=hdr)
-            DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_line.fits'),overwrite='True')
-    
-        
-        """
-        --------------------------------------------------------------
-        Correction de flat - basse freq
-        --------------------------------------------------------------
-        """
-        frame=np.copy(img)
-        #plt.imshow(frame)
-        #plt.show()
-        
-        debug=False
-        
-        # on cherche la projection de la taille max du soleil en Y
-        y1,y2=detect_bord(frame, axis=1,offset=0, flag_disk=True) 
-        #x1,x2=detect_bord(frame, axis=0,offset=0)
-        if cfg.LG == 1:
-            logme('Limites verticales y1,y2 : '+str(y1)+' '+str(y2))
-        else:
-            logme('Vertical limits y1,y2 : '+str(y1)+' '+str(y2))
         
-    
-        flag_nobords=detect_noXlimbs(frame)
-        
-        # si mauvaise detection des bords en x alors on doit prendre toute l'image
-        if flag_nobords:
-            ydisk=np.median(img,1)
-            offset_y1=0
-            offset_y2=0
-        else:
-    
-            seuil_haut = pic_histo(frame)
-            myseuil=seuil_haut*0.5 # seuillage pour segmentation disque solaire
-            
-            if cfg.LowDyn :
-                #guillaume
-                myseuil=seuil_haut*0.7 # faible dynamique, seuil pour segmenter le disque solaire was 0.6
-                print(seuil_haut, myseuil)
+        # Geénère tableau image de flat 
+        flat_hf=[]
+        for i in range(0,iw):
+            flat_hf.append(hcol)
             
-            # filtre le profil moyen en Y en ne prenant que le disque
-            # pixel est dans disque si intensité supérieure à la moitié du percentile à 97%
-            # value where 97% of the pixels are lower
-            ydisk=np.empty(ih+1)
-            offset_y1=0
-            offset_y2=0
-            for j in range(0,ih):
-                temp=np.copy(frame[j,:])
-                temp=temp[temp>myseuil]
-                if len(temp)!=0:
-                    ydisk[j]=np.median(temp)
-                else:
-                    # manage poor disk intensities inside disk
-                    # avoid line artefact
-                    if j>=y1 and j<=y2:
-                        ydisk[j]=myseuil
-                        if abs(j-y1) < abs(j-y2):
-                            offset_y1=offset_y1+1
-                        else:
-                            offset_y2=offset_y2-1
-
-                    else:
-                        ydisk[j]=myseuil
-
-    
-        # ne prend que le profil des intensités pour eviter les rebonds de bords
+        np_flat_hf=np.asarray(flat_hf)
+        flat_hf = np_flat_hf.T
         
-        # manage flat range application
-        y1=y1+offset_y1
-        y2=y2+offset_y2
+        # Evite les divisions par zeros...
+        flat_hf[flat_hf==0]=1
         
-        ToSpline= ydisk[y1:y2]
+        # somme des lignes mauvaises le log de x
+        #hsum=np.mean(img[listcol],0)
+        m=np.mean(img,0)
+        hsum=np.max(m)/m
+        hsum[hsum>2]=1
+        #hsum=savgol_filter(hsum,31, 3)
         
-        # traitement du cas ou le disque est saturé - cas de la couronne solaire raie verte
-        moy_profil=np.mean(ToSpline)
-        #print ('moy profil : ', moy_profil)
-        if moy_profil <64000 :
+        if debug :
+            plt.plot(hsum)
+            plt.show()
         
-            winterp=301
-            if len(ToSpline)<301 :
-                
-                if cfg.LG == 1:
-                    logme('Hauteur du disque anormalement faible : '+str(y1)+' '+str(y2))
-                else:
-                    logme('Disk Height abnormally low : '+str(y1)+' '+str(y2))
-                
-                if len(ToSpline)%2==0 :
-                    winterp=len(ToSpline)-10+1
-                else:
-                    winterp=len(ToSpline)-10
-            
-            Smoothed2=savgol_filter(ToSpline,winterp, 3) # window size, polynomial order
+        # flat pondere en x 
         
-
-            if debug:
-                plt.plot(ToSpline)
-                #plt.plot(Smoothed)
-                plt.plot(Smoothed2)
-                plt.show()
-     
-            
-            # Divise le profil reel par son filtre ce qui nous donne le flat
-            hf=np.divide(ToSpline,Smoothed2)
-               
-            # Elimine possible artefact de bord
-            hf=hf[5:-5]
-            
-            #reconstruit le tableau du profil complet an completant le debut et fin
-            a=[1]*(y1+5)
-            b=[1]*(ih-y2+5)
-            hf=np.concatenate((a,hf,b))
-            
-            #Smoothed=np.concatenate((a,Smoothed,b))
-            ToSpline=np.concatenate((a,ToSpline,b))
-            Smoothed2=np.concatenate((a,Smoothed2,b))
-            
-            if debug:
-                plt.plot(ToSpline)
-                plt.plot(Smoothed2)
-                plt.show()
-                
-                plt.plot(hf)
-                plt.show()
-     
-            # Génère tableau image de flat 
-            flat=[]
-            for i in range(0,iw):
-                flat.append(hf)
-                
-            np_flat=np.asarray(flat)
-            flat = np_flat.T
-            
-            # Evite les divisions par zeros...
-            flat[flat==0]=1
-            
-            if debug:
-                plt.imshow(flat)
-                plt.show()
-    
-            # Divise image par le flat
-            BelleImage=np.divide(frame,flat)
-            BelleImage[BelleImage>65535]=65535 # bug saturation
-            frame=np.array(BelleImage, dtype='uint16')
-            
-            if debug:
-                # sauvegarde de l'image deflattée
-                #DiskHDU=fits.PrimaryHDU(frame,header=hdu.header)
-                DiskHDU=fits.PrimaryHDU(frame,header=hdr)
-                DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_flat.fits'),overwrite='True')
-            
-        else:
-            # pas de correction de flat on reprend l'image
-            print ("pas de correction de flat, profil saturé")
+        for i in listcol :
+            flat_hf[i,:]=flat_hf[i,:]/hsum
+           
+        if debug :
+            # affichage debug
+            plt.imshow(flat_hf)
+            plt.show()
             
+        # Divise image par le flat
+        b=np.divide(img,flat_hf)
+        img=np.array(b, dtype='uint16')
         
-        # on sauvegarde les bords haut et bas pour les calculs doppler et cont
-        if k==0: 
-            y1_img=y1
-            y2_img=y2
+    else :
+        origimg=np.copy(img)
+        # correction de lignes par filtrage median 13 lignes, empririque
+        if debug : print(listcol)
+        lines=[]
+        lines_collection=[]
+        try :
+            lines.append(listcol[0])
+            for i in range(1,len(listcol)-1):
+                if listcol[i]-listcol[i-1] ==1 :
+                    lines.append(listcol[i])
+                else :
+                    lines_collection.append(lines)
+                    lines=[]
+                    lines.append(listcol[i])
+            if debug : print(lines_collection)
+        except:
+            pass
         
+        for c in listcol:
+            m=origimg[c-11:c+10,] #now refer to original image
+            # calcul de la mediane sur 10 lignes de part et d'autres
+            # suppression de 2 colonnes en debut et fin qui peuvent être à zéro
+            s=np.median(m[:,2:-2],0)
+            
+            #on prepare un patch de 2 valeurs 
+            a=[m[0][3],m[0][-3]]
+            #on ajoute les patchs
+            s=np.concatenate((a,s,a))
+            
+            #on remplace la ligne defectueuse
+            #s=0 #pour visualiser la ligne idetifiée comme defectueuse
+            img[c:c+1,]=s #fix bug ecart une ligne
         
-       
-        """
-        -----------------------------------------------------------------------
-        Calcul du tilt si on voit les bords du soleil
-        sinon on n'applique pas de correction de tilt,
-        on applique un facteur SY/SX=0.5
-        et on renvoit a ISIS
-        -----------------------------------------------------------------------
+      
         """
-        
-        img2=np.copy(frame)
-        EllipseFit=[]
-        crop=0
-        
-        if k != 0:
-            flag_force = True
-    
-        #if float(ang_tilt)==0:
-              
-       
-  
-        if not(flag_nobords):
-            
-            # methode fit ellipse pour calcul de tilt
-            # zone d'exclusion des points contours zexcl en pourcentage de la hauteur image 
-            X = detect_edge (img2, zexcl=0.1, crop=crop, disp_log=False)
-            EllipseFit,XE=fit_ellipse(img2, X,disp_log=False)
+        for c in lines_collection :
+            d=2
+            m1 = origimg[c[0]-d,]
+            m2 = origimg[c[len(c)-1]+d,]
+            m=np.array([m1,m2])
+            # suppression de 2 colonnes en debut et fin qui peuvent être à zéro
+            s=np.median(m[:,2:-2],0)
+            #on prepare un patch de 2 valeurs 
+            a=[s[0],s[-1]]
+            #on ajoute les patchs
+            s=np.concatenate((a,s,a))
             
-            # correction de tilt uniquement si on voit les limbes droit/gauche
-            # trouve les coordonnées y des bords du disque dont on a les x1 et x2 
-            # pour avoir les coordonnées y du grand axe horizontal
-            # on cherche la projection de la taille max du soleil en Y et en X
-
-            if y1<=10 :
-                background= np.percentile(img2, 15)
-                #print("Percentile h 15: ",background)
-                img_dark1=np.full((2,iw), background)
-            else :
-                #img_dark1=img2[0:y1-10,]
-                img_dark1=img2[0:10,]
-            if y2>ih-10 :
-                background= np.percentile(img2, 15)
-                #print("Percentile b 15: ",background)
-                img_dark2=np.full((2,iw), background)
-
-            else :
-                #img_dark2=img2[y2+10:,]
-                img_dark2=img2[-10:,]
-                
-            img_dark=np.concatenate((img_dark1,img_dark2))
-            img_fill1=np.mean(img_dark1,axis=0)
-            img_fill2=np.mean(img_dark2, axis=0)
-            background= np.percentile(img_dark, 55) # was 55
-            #background= np.percentile(img2, 15)
-            #print("zone fond: ",background)
+            #on remplace la ligne defectueuse
+            #s=0
+            for i in c :
+                img[i:i+1,]=s #fix bug ecart une ligne
+        """ 
+    debug=False
+    if debug :
+        # affichage debug
+        plt.plot(ysum_img)
+        plt.plot(np.mean(img,1))
+        plt.title('avant-apres')
+        plt.show()
+        # test sauve image apres correction pour debug
+        DiskHDU=fits.PrimaryHDU(img,header=hdr)
+        DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_line.fits'),overwrite='True')
 
-           
-            # methode calcul angle de tilt avec XE ellipse fit
-            elX=XE.T[0]
-            elY=XE.T[1]
-            el_x1=np.min(elX)
-            el_x2=np.max(elX)
-            el_ind_x1= np.argmin(elX)
-            el_ind_x2= np.argmax(elX)
-            el_y_x1=elY[el_ind_x1]
-            el_y_x2=elY[el_ind_x2]
-            #print('ellipse x1,x2 : ', el_x1, el_x2)
-            #print('ellipse y_x1,y_x2 : ', el_y_x1, el_y_x2)
-            
-            if k==0 :
-                el_x1_img=el_x1
-                el_x2_img=el_x2
-                
-            #if float(ang_tilt)==0:
-            if flag_force != True :
-                # calcul l'angle de tilt ellipse
-                dy=(el_y_x2-el_y_x1)
-                dx=(el_x2-el_x1)
-                TanAlpha=(-dy/dx)
-                AlphaRad=math.atan(TanAlpha)
-                AlphaDeg=math.degrees(AlphaRad)
-            
-        
-            else :
-                AlphaDeg=float(ang_tilt)
-                AlphaRad=math.radians(AlphaDeg)
-                TanAlpha=math.tan(AlphaRad)
-                
+    
+    """
+    --------------------------------------------------------------
+    Correction de flat - basse freq
+    --------------------------------------------------------------
+    """
+    frame=np.copy(img)
+    #plt.imshow(frame)
+    #plt.show()
+    
+    debug=False
+    
+    # on cherche la projection de la taille max du soleil en Y
+    y1,y2=detect_bord(frame, axis=1,offset=0, flag_disk=True) 
+    #x1,x2=detect_bord(frame, axis=0,offset=0)
+    if cfg.LG == 1:
+        logme('Limites verticales y1,y2 : '+str(y1)+' '+str(y2))
+    else:
+        logme('Vertical limits y1,y2 : '+str(y1)+' '+str(y2))
+    
+
+    flag_nobords=detect_noXlimbs(frame)
+    
+    # si mauvaise detection des bords en x alors on doit prendre toute l'image
+    if flag_nobords:
+        ydisk=np.median(img,1)
+        offset_y1=0
+        offset_y2=0
+    else:
+
+        seuil_haut = pic_histo(frame)
+        myseuil=seuil_haut*0.5 # seuillage pour segmentation disque solaire
+        
+        if cfg.LowDyn :
+            #guillaume
+            myseuil=seuil_haut*0.7 # faible dynamique, seuil pour segmenter le disque solaire was 0.6
+            print(seuil_haut, myseuil)
+        
+        # filtre le profil moyen en Y en ne prenant que le disque
+        # pixel est dans disque si intensité supérieure à la moitié du percentile à 97%
+        # value where 97% of the pixels are lower
+        ydisk=np.empty(ih+1)
+        ydisk[:ih], count=row_median_above(frame, myseuil)
+        vide=count==0
+        ydisk[:ih][vide]=myseuil
+        # manage poor disk intensities inside disk
+        # avoid line artefact
+        j=np.arange(ih)
+        dans_disque=vide & (j>=y1) & (j<=y2)
+        pres_y1=dans_disque & (np.abs(j-y1) < np.abs(j-y2))
+        offset_y1=int(np.count_nonzero(pres_y1))
+        offset_y2=-int(np.count_nonzero(dans_disque & ~pres_y1))
+
+
+    # ne prend que le profil des intensités pour eviter les rebonds de bords
+    
+    # manage flat range application
+    y1=y1+offset_y1
+    y2=y2+offset_y2
+    
+    ToSpline= ydisk[y1:y2]
+    
+    # traitement du cas ou le disque est saturé - cas de la couronne solaire raie verte
+    moy_profil=np.mean(ToSpline)
+    #print ('moy profil : ', moy_profil)
+    if moy_profil <64000 :
+    
+        winterp=301
+        if len(ToSpline)<301 :
             
             if cfg.LG == 1:
-                logme('Angle de Tilt : '+"{:+.4f}".format(AlphaDeg))
+                logme('Hauteur du disque anormalement faible : '+str(y1)+' '+str(y2))
             else:
-                logme('Tilt angle : '+"{:+.4f}".format(AlphaDeg))
-            
-            #on force l'angle de tilt pour les prochaines images
-            ang_tilt=AlphaDeg
-           
+                logme('Disk Height abnormally low : '+str(y1)+' '+str(y2))
             
-            # ne teste plus si correction de tilt si angle supérieur a 0.2 degres
-            if abs(AlphaDeg)>= 0.0 :
-                #decale lignes images par rapport au centre
-                colref=round((el_x1+el_x2)/2)
-                dymax=int(abs(TanAlpha)*(colref))
-                #print ("background tilt : ", background)
-                #background= np.percentile(img2, 5)
-                #a=np.full((dymax,iw), background)
-                #b=a
-                a=np.atleast_2d(img_fill1).repeat(repeats=dymax, axis=0)
-                b=np.atleast_2d(img_fill2).repeat(repeats=dymax, axis=0)
-                img2=np.concatenate((a,img2,b))
-                ih=ih+dymax*2
-                crop=int(abs(TanAlpha)*iw)
-                NewImg=np.empty((ih,iw))
-                for i in range(0,iw):
-                    x=img2[:,i]
-                    NewImg[:,i]=x
-                    y=np.arange(0,ih)
-                    dy=(i-colref)*TanAlpha
-                    ycalc = y + np.ones(ih)*dy # improvements TheSmiths
-                    f=interp1d(ycalc,x,kind='linear',fill_value=(background,background),bounds_error=False)
-                    xcalc=f(y)
-                    NewLine=xcalc
-                    NewImg[:,i]=NewLine
-                NewImg[NewImg<=0]=0  #modif du 19/05/2021 etait a 1000
-                img2=np.copy(NewImg)
-                if dymax != 0 :
-                    img2[:dymax,]=a
-                    img2[-dymax:,]=b
-
+            if len(ToSpline)%2==0 :
+                winterp=len(ToSpline)-10+1
             else:
-                if cfg.LG == 1:
-                    logme('Alignement meilleur que 0.2°, correction de tilt non nécessaire.')
-                else:
-                    logme('Alignment better than 0.2°, tilt correction not necessary.')
-                   
-        sfit_onlyfinal=False
+                winterp=len(ToSpline)-10
         
-        if sfit_onlyfinal==False:
-            # sauvegarde en fits de l'image tilt
-            img2=np.array(img2, dtype='uint16')
-            DiskHDU=fits.PrimaryHDU(img2,header=hdr)
-            DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_tilt.fits'), overwrite='True')
+        Smoothed2=savgol_filter(ToSpline,winterp, 3) # window size, polynomial order
+    
+
+        if debug:
+            plt.plot(ToSpline)
+            #plt.plot(Smoothed)
+            plt.plot(Smoothed2)
+            plt.show()
+ 
         
-        """
-        ----------------------------------------------------------------
-        Calcul du parametre de scaling SY/SX
-        ----------------------------------------------------------------
-        """
+        # Divise le profil reel par son filtre ce qui nous donne le flat
+        hf=np.divide(ToSpline,Smoothed2)
+           
+        # Elimine possible artefact de bord
+        hf=hf[5:-5]
         
-       
+        #reconstruit le tableau du profil complet an completant le debut et fin
+        a=[1]*(y1+5)
+        b=[1]*(ih-y2+5)
+        hf=np.concatenate((a,hf,b))
         
-        if flag_nobords:
-            ratio_fixe=0.5
-            
-        if k==1:
-            ratio_fixe=ratio_fixe_d1
+        #Smoothed=np.concatenate((a,Smoothed,b))
+        ToSpline=np.concatenate((a,ToSpline,b))
+        Smoothed2=np.concatenate((a,Smoothed2,b))
+        
+        if debug:
+            plt.plot(ToSpline)
+            plt.plot(Smoothed2)
+            plt.show()
             
-        #if ratio_fixe==0:
-        if flag_force != True and not flag_nobords:
-            # methode fit ellipse pour calcul du ratio SY/SX
-            X = detect_edge (img2, zexcl=0.1,crop=crop, disp_log=False)
-            EllipseFit,XE=fit_ellipse(img2, X,disp_log=False)
+            plt.plot(hf)
+            plt.show()
+ 
+        # Divise image par le flat, chaque ligne par sa valeur de hf
+        frame=flat_divide(frame, hf)
+        
+        if debug:
+            # sauvegarde de l'image deflattée
+            #DiskHDU=fits.PrimaryHDU(frame,header=hdu.header)
+            DiskHDU=fits.PrimaryHDU(frame,header=hdr)
+            DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_flat.fits'),overwrite='True')
+        
+    else:
+        # pas de correction de flat on reprend l'image
+        print ("pas de correction de flat, profil saturé")
+        
+    
+    # on sauvegarde les bords haut et bas pour les calculs doppler et cont
+    if k==0: 
+        y1_img=y1
+        y2_img=y2
+    
+    
+   
+    """
+    -----------------------------------------------------------------------
+    Calcul du tilt si on voit les bords du soleil
+    sinon on n'applique pas de correction de tilt,
+    on applique un facteur SY/SX=0.5
+    et on renvoit a ISIS
+    -----------------------------------------------------------------------
+    """
+    
+    img2=np.copy(frame)
+    EllipseFit=[]
+    crop=0
+    
+    if k != 0:
+        flag_force = True
+
+    #if float(ang_tilt)==0:
+          
+   
+  
+    if not(flag_nobords):
+        
+        # methode fit ellipse pour calcul de tilt
+        # zone d'exclusion des points contours zexcl en pourcentage de la hauteur image 
+        X = detect_edge (img2, zexcl=0.1, crop=crop, disp_log=False)
+        EllipseFit,XE=fit_ellipse(img2, X,disp_log=False)
+        
+        # correction de tilt uniquement si on voit les limbes droit/gauche
+        # trouve les coordonnées y des bords du disque dont on a les x1 et x2 
+        # pour avoir les coordonnées y du grand axe horizontal
+        # on cherche la projection de la taille max du soleil en Y et en X
+
+        if y1<=10 :
+            background= np.percentile(img2, 15)
+            #print("Percentile h 15: ",background)
+            img_dark1=np.full((2,iw), background)
+        else :
+            #img_dark1=img2[0:y1-10,]
+            img_dark1=img2[0:10,]
+        if y2>ih-10 :
+            background= np.percentile(img2, 15)
+            #print("Percentile b 15: ",background)
+            img_dark2=np.full((2,iw), background)
+
+        else :
+            #img_dark2=img2[y2+10:,]
+            img_dark2=img2[-10:,]
             
-            ratio=EllipseFit[2]/EllipseFit[1]
+        img_dark=np.concatenate((img_dark1,img_dark2))
+        img_fill1=np.mean(img_dark1,axis=0)
+        img_fill2=np.mean(img_dark2, axis=0)
+        background= np.percentile(img_dark, 55) # was 55
+        #background= np.percentile(img2, 15)
+        #print("zone fond: ",background)
+
        
+        # methode calcul angle de tilt avec XE ellipse fit
+        elX=XE.T[0]
+        elY=XE.T[1]
+        el_x1=np.min(elX)
+        el_x2=np.max(elX)
+        el_ind_x1= np.argmin(elX)
+        el_ind_x2= np.argmax(elX)
+        el_y_x1=elY[el_ind_x1]
+        el_y_x2=elY[el_ind_x2]
+        #print('ellipse x1,x2 : ', el_x1, el_x2)
+        #print('ellipse y_x1,y_x2 : ', el_y_x1, el_y_x2)
+        
+        if k==0 :
+            el_x1_img=el_x1
+            el_x2_img=el_x2
             
-            if cfg.LG == 1:
-                logme('Facteur d\'échelle SY/SX : '+"{:+.4f}".format(ratio))
-            else:
-                logme('Scaling SY/SX : '+"{:+.4f}".format(ratio))
+        #if float(ang_tilt)==0:
+        if flag_force != True :
+            # calcul l'angle de tilt ellipse
+            dy=(el_y_x2-el_y_x1)
+            dx=(el_x2-el_x1)
+            TanAlpha=(-dy/dx)
+            AlphaRad=math.atan(TanAlpha)
+            AlphaDeg=math.degrees(AlphaRad)
+        
+    
+        else :
+            AlphaDeg=float(ang_tilt)
+            AlphaRad=math.radians(AlphaDeg)
+            TanAlpha=math.tan(AlphaRad)
             
-            NewImg, newiw=circularise2(img2,iw,ih,ratio)
         
+        if cfg.LG == 1:
+            logme('Angle de Tilt : '+"{:+.4f}".format(AlphaDeg))
         else:
-            # Forcer le ratio SY/SX
-            NewImg, newiw=circularise2(img2,iw,ih,ratio_fixe)
+            logme('Tilt angle : '+"{:+.4f}".format(AlphaDeg))
+        
+        #on force l'angle de tilt pour les prochaines images
+        ang_tilt=AlphaDeg
+       
+        
+        # ne teste plus si correction de tilt si angle supérieur a 0.2 degres
+        if abs(AlphaDeg)>= 0.0 :
+            #decale lignes images par rapport au centre
+            colref=round((el_x1+el_x2)/2)
+            dymax=int(abs(TanAlpha)*(colref))
+            #print ("background tilt : ", background)
+            #background= np.percentile(img2, 5)
+            #a=np.full((dymax,iw), background)
+            #b=a
+            a=np.atleast_2d(img_fill1).repeat(repeats=dymax, axis=0)
+            b=np.atleast_2d(img_fill2).repeat(repeats=dymax, axis=0)
+            img2=np.concatenate((a,img2,b))
+            ih=ih+dymax*2
+            crop=int(abs(TanAlpha)*iw)
+            NewImg=np.empty((ih,iw))
+            for i in range(0,iw):
+                x=img2[:,i]
+                NewImg[:,i]=x
+                y=np.arange(0,ih)
+                dy=(i-colref)*TanAlpha
+                ycalc = y + np.ones(ih)*dy # improvements TheSmiths
+                f=interp1d(ycalc,x,kind='linear',fill_value=(background,background),bounds_error=False)
+                xcalc=f(y)
+                NewLine=xcalc
+                NewImg[:,i]=NewLine
+            NewImg[NewImg<=0]=0  #modif du 19/05/2021 etait a 1000
+            img2=np.copy(NewImg)
+            if dymax != 0 :
+                img2[:dymax,]=a
+                img2[-dymax:,]=b
 
+        else:
             if cfg.LG == 1:
-                logme('Facteur d\'échelle fixe SY/SX : '+"{:+.4f}".format(ratio_fixe))
+                logme('Alignement meilleur que 0.2°, correction de tilt non nécessaire.')
             else:
-                logme('Fixed Scaling SY/SX : '+"{:+.4f}".format(ratio_fixe))
-
+                logme('Alignment better than 0.2°, tilt correction not necessary.')
+               
+    sfit_onlyfinal=False
+    
+    if sfit_onlyfinal==False:
+        # sauvegarde en fits de l'image tilt
+        img2=np.array(img2, dtype='uint16')
+        DiskHDU=fits.PrimaryHDU(img2,header=hdr)
+        DiskHDU.writeto(os.path.join(WorkDir,basefich+img_suff[k]+'_tilt.fits'), overwrite='True')
+    
+    """
+    ----------------------------------------------------------------
+    Calcul du parametre de scaling SY/SX
+    ----------------------------------------------------------------
+    """
+    
+   
+    
+    if flag_nobords:
+        ratio_fixe=0.5
         
-        if k==0:
-            #if ratio_fixe==0:
-            if flag_force != True and not flag_nobords:
-                ratio_fixe_d1=ratio
-            else:
-                ratio_fixe_d1=ratio_fixe
+    if k==1:
+        ratio_fixe=ratio_fixe_d1
         
+    #if ratio_fixe==0:
+    if flag_force != True and not flag_nobords:
+        # methode fit ellipse pour calcul du ratio SY/SX
+        X = detect_edge (img2, zexcl=0.1,crop=crop, disp_log=False)
+        EllipseFit,XE=fit_ellipse(img2, X,disp_log=False)
         
-        frame=np.array(NewImg, dtype='uint16')
-        #print('shape',frame.shape)
+        ratio=EllipseFit[2]/EllipseFit[1]
+   
         
-        """
-        if sfit_onlyfinal==False:
-            # sauvegarde en fits de l'image rescaled
-            hdr['NAXIS1']=frame.shape[1]
-            hdr['NAXIS2']=frame.shape[0]
-            #img2=np.array(frame, dtype='uint16')
-            DiskHDU=fits.PrimaryHDU(frame,header=hdr)
-            DiskHDU.writeto(basefich+"_"+str(k)+'_scaled.fits', overwrite='True')
-        """
-       
-        """
-        ----------------------------------------------------------------------
-        Sanity check, second iteration et calcul des parametres du disk occulteur
-        ----------------------------------------------------------------------
-        """
-        if flag_nobords:
-            cercle=[0,0,0,0]
-            r=0
-            
+        if cfg.LG == 1:
+            logme('Facteur d\'échelle SY/SX : '+"{:+.4f}".format(ratio))
         else:
-            # fit ellipse pour denier check
-            # zone d'exclusion des points contours zexcl en pourcentage de la hauteur image 
+            logme('Scaling SY/SX : '+"{:+.4f}".format(ratio))
+        
+        NewImg, newiw=circularise2(img2,iw,ih,ratio)
     
-            X = detect_edge (frame, zexcl=0.1, crop=crop, disp_log=False)
-            EllipseFit,XE=fit_ellipse(frame, X, disp_log=False)
-            
-            ratio=EllipseFit[2]/EllipseFit[1]
-            
-            if abs(ratio-1)>=1 and k==0 and ratio_fixe==0: #0.01
-                logme('Ratio iteration2 :'+ str(ratio))
-                NewImg, newiw=circularise2(frame,newiw,ih,ratio)
-                frame=np.array(NewImg, dtype='uint16')
-                X= detect_edge (frame, zexcl=0.1,crop=crop, disp_log=False)
-                EllipseFit,XE=fit_ellipse(frame, X, disp_log=False)
-                
-            if k==0:
-                xc=round(EllipseFit[0][0])
-                yc=round(EllipseFit[0][1])
-                wi=round(EllipseFit[1]) # diametre
-                he=round(EllipseFit[2])
-                cercle=[xc,yc,wi,he]              
-                
-                #if ratio_fixe==0 :
-                if flag_force != True :
-                    cercle=[xc,yc,wi,he]
-
-                r=round(min(wi-5,he-5)-4)
-                if cfg.LG == 1:
-                    logme('Final SY/SX :'+ "{:+.3f}".format(he/wi))
-                    #logme('Centre xc,yc et rayon : '+str(xc)+' '+str(yc)+' '+str(int(r)))
-                else:
-                    logme('Final SY/SX :'+ "{:+.3f}".format(he/wi))
-                    #logme('xc,yc center and radius : '+str(xc)+' '+str(yc)+' '+str(int(r)))
+    else:
+        # Forcer le ratio SY/SX
+        NewImg, newiw=circularise2(img2,iw,ih,ratio_fixe)
+
+        if cfg.LG == 1:
+            logme('Facteur d\'échelle fixe SY/SX : '+"{:+.4f}".format(ratio_fixe))
+        else:
+            logme('Fixed Scaling SY/SX : '+"{:+.4f}".format(ratio_fixe))
+
     
+    if k==0:
+        #if ratio_fixe==0:
+        if flag_force != True and not flag_nobords:
+            ratio_fixe_d1=ratio
+        else:
+            ratio_fixe_d1=ratio_fixe
+    
+    
+    frame=np.array(NewImg, dtype='uint16')
+    #print('shape',frame.shape)
+    
+    """
+    if sfit_onlyfinal==False:
+        # sauvegarde en fits de l'image rescaled
+        hdr['NAXIS1']=frame.shape[1]
+        hdr['NAXIS2']=frame.shape[0]
+        #img2=np.array(frame, dtype='uint16')
+        DiskHDU=fits.PrimaryHDU(frame,header=hdr)
+        DiskHDU.writeto(basefich+"_"+str(k)+'_scaled.fits', overwrite='True')
+    """
+   
+    """
+    ----------------------------------------------------------------------
+    Sanity check, second iteration et calcul des parametres du disk occulteur
+    ----------------------------------------------------------------------
+    """
+    if flag_nobords:
+        cercle=[0,0,0,0]
+        r=0
         
+    else:
+        # fit ellipse pour denier check
+        # zone d'exclusion des points contours zexcl en pourcentage de la hauteur image 
+
+        X = detect_edge (frame, zexcl=0.1, crop=crop, disp_log=False)
+        EllipseFit,XE=fit_ellipse(frame, X, disp_log=False)
+        
+        ratio=EllipseFit[2]/EllipseFit[1]
         
+        if abs(ratio-1)>=1 and k==0 and ratio_fixe==0: #0.01
+            logme('Ratio iteration2 :'+ str(ratio))
+            NewImg, newiw=circularise2(frame,newiw,ih,ratio)
+            frame=np.array(NewImg, dtype='uint16')
+            X= detect_edge (frame, zexcl=0.1,crop=crop, disp_log=False)
+            EllipseFit,XE=fit_ellipse(frame, X, disp_log=False)
+            
         if k==0:
-            cercle0=np.copy(cercle)
-            geom.append(ratio_fixe_d1)
-            geom.append(ang_tilt)
+            xc=round(EllipseFit[0][0])
+            yc=round(EllipseFit[0][1])
+            wi=round(EllipseFit[1]) # diametre
+            he=round(EllipseFit[2])
+            cercle=[xc,yc,wi,he]              
             
+            #if ratio_fixe==0 :
+            if flag_force != True :
+                cercle=[xc,yc,wi,he]
 
-            
-        x0=cercle0[0]
-        y0=cercle0[1]
-        wi=round(cercle0[2])
-        he=round(cercle0[3])
+            r=round(min(wi-5,he-5)-4)
+            if cfg.LG == 1:
+                logme('Final SY/SX :'+ "{:+.3f}".format(he/wi))
+                #logme('Centre xc,yc et rayon : '+str(xc)+' '+str(yc)+' '+str(int(r)))
+            else:
+                logme('Final SY/SX :'+ "{:+.3f}".format(he/wi))
+                #logme('xc,yc center and radius : '+str(xc)+' '+str(yc)+' '+str(int(r)))
 
+    
+    
+    if k==0:
+        cercle0=np.copy(cercle)
+        geom.append(ratio_fixe_d1)
+        geom.append(ang_tilt)
         
-        
-        sensNS_corr_ang_tilt=1
-        sensEW_corr_ang_tilt=1
-             
-        # retourne horizontalement image si flag de flip est vrai
-        if flag_flipRA:
-             frame=np.flip(frame, axis=1)
-             # il faut recentrer le centre du disque en X...
-             x0=frame.shape[1]-x0
-             cercle[0]=x0
-             #if k==0 : cercle0[0]=x0
-             sensEW_corr_ang_tilt=-1
-             if cfg.LG == 1:
-                 logme("Inversion EW")
-             else:
-                 logme("EW inversion")
-         
-        if flag_flipNS:
-             frame=np.flip(frame, axis=0)
-             # il faut recentrer le centre du disque en Y...
-             y0=frame.shape[0]-y0-1
-             cercle[1]=y0
-             #if k==0: cercle0[1]=y0
-             sensNS_corr_ang_tilt=-1
-             if cfg.LG == 1:
-                 logme("Inversion NS")
-             else:
-                 logme("NS inversion")
-          
-        """
-        -----------------------------------------------------------------------
-        Correction rotation angle P et tilt
-        -----------------------------------------------------------------------
-        """
-        # corrige angle P de rotation, par defaut il sera égal à zero
-        # pour l'instant on applique la valeur dans le champs Angle P
-        # on corrige aussi de l'angle de tilt dans geom[1]
-        
-        # recalcul angle de tilt apres circularisation
-        # calcule angle de tilt apres rescaling
-        
-        if geom[1] != 0 :
-            Arad=math.radians(geom[1])
-            TanA=math.tan(Arad)
-            TanA_scaled= TanA/geom[0]
-            A2Rad=math.atan(TanA_scaled)
-            Tilt_scaled_Deg=math.degrees(A2Rad)
-        else :
-            Tilt_scaled_Deg = 0
-        
-        angle_rot = ang_P+sensNS_corr_ang_tilt*sensEW_corr_ang_tilt*Tilt_scaled_Deg
 
         
-        if angle_rot !=0 :
-            if cfg.LG == 1:
-                logme("Angle de correction : "+ str(angle_rot))
-                logme("Angle P utilisé : "+str(ang_P))
-            else:
-                logme("Correction angle : "+ str(angle_rot))
-                logme("P angle used : "+str(ang_P))
-            
-            # on copie l'image de travail et on recupere hauteur et largeur
-            fr_avant_rot=np.copy(frame)
-            hh,ww=fr_avant_rot.shape[:2]
-            
-            #calcul de bande max liée a la rotation d'angle
-            RotRad=math.radians(angle_rot)
-            TanRot=np.tan(RotRad)
-            hy=int(abs(TanRot*ww*0.5))
-           
-            
+    x0=cercle0[0]
+    y0=cercle0[1]
+    wi=round(cercle0[2])
+    he=round(cercle0[3])
+
     
-            # y0 inferieur à hauteur on padde des bandes haut et bas pour ne pas cropper apres rotation
-            if y0<he :
-                #print('hauteur bande auto : ', hy)
-                #print('hauteur fixe : ', abs(he+hy-y0))
-                #hy=50
-                """
-                pad_area= np.ones((abs(he+hy-y0),ww))
-                fr_avant_rot=np.concatenate((pad_area,fr_avant_rot,pad_area))
-                cercle[1]=he+hy
-                cercle0[1]=he+hy
-                """
-                pad_area= np.ones((hy,ww))
-                fr_avant_rot=np.concatenate((pad_area,fr_avant_rot,pad_area))
-                cercle[1]=y0+hy
-                #if k==0: cercle0[1]=y0+hy
-                
-                        
-            # et on met a jour dimensions de l'image avant rotation
-            h,w=fr_avant_rot.shape[:2]
-            # calcul de la matrice de rotation, angle en degre
-            rotation_mat=cv2.getRotationMatrix2D((int(cercle[0]),int(cercle[1])),float(angle_rot),1.0)
-                        
-            # application de la matrice de rotation
-            fr_rot=cv2.warpAffine(fr_avant_rot,rotation_mat,(w,h),flags=cv2.INTER_LINEAR)
-            frame=np.array(fr_rot, dtype='uint16')
-        else :
-            h, w = frame.shape
-            
+    
+    sensNS_corr_ang_tilt=1
+    sensEW_corr_ang_tilt=1
+         
+    # retourne horizontalement image si flag de flip est vrai
+    if flag_flipRA:
+         frame=np.flip(frame, axis=1)
+         # il faut recentrer le centre du disque en X...
+         x0=frame.shape[1]-x0
+         cercle[0]=x0
+         #if k==0 : cercle0[0]=x0
+         sensEW_corr_ang_tilt=-1
+         if cfg.LG == 1:
+             logme("Inversion EW")
+         else:
+             logme("EW inversion")
+     
+    if flag_flipNS:
+         frame=np.flip(frame, axis=0)
+         # il faut recentrer le centre du disque en Y...
+         y0=frame.shape[0]-y0-1
+         cercle[1]=y0
+         #if k==0: cercle0[1]=y0
+         sensNS_corr_ang_tilt=-1
+         if cfg.LG == 1:
+             logme("Inversion NS")
+         else:
+             logme("NS inversion")
+      
+    """
+    -----------------------------------------------------------------------
+    Correction rotation angle P et tilt
+    -----------------------------------------------------------------------
+    """
+    # corrige angle P de rotation, par defaut il sera égal à zero
+    # pour l'instant on applique la valeur dans le champs Angle P
+    # on corrige aussi de l'angle de tilt dans geom[1]
+    
+    # recalcul angle de tilt apres circularisation
+    # calcule angle de tilt apres rescaling
+    
+    if geom[1] != 0 :
+        Arad=math.radians(geom[1])
+        TanA=math.tan(Arad)
+        TanA_scaled= TanA/geom[0]
+        A2Rad=math.atan(TanA_scaled)
+        Tilt_scaled_Deg=math.degrees(A2Rad)
+    else :
+        Tilt_scaled_Deg = 0
+    
+    angle_rot = ang_P+sensNS_corr_ang_tilt*sensEW_corr_ang_tilt*Tilt_scaled_Deg
 
+    
+    if angle_rot !=0 :
         if cfg.LG == 1:
-            logme('Centre xc,yc et rayon : '+str(cercle[0])+' '+str(cercle[1])+' '+str(int(r)))
+            logme("Angle de correction : "+ str(angle_rot))
+            logme("Angle P utilisé : "+str(ang_P))
         else:
-            logme('xc,yc center and radius : '+str(cercle[0])+' '+str(cercle[1])+' '+str(int(r)))
+            logme("Correction angle : "+ str(angle_rot))
+            logme("P angle used : "+str(ang_P))
+        
+        # on copie l'image de travail et on recupere hauteur et largeur
+        fr_avant_rot=np.copy(frame)
+        hh,ww=fr_avant_rot.shape[:2]
         
-        # on croppe et on centre
-        # Hauteur du capteur est dans dam_Heigth=scan.height
+        #calcul de bande max liée a la rotation d'angle
+        RotRad=math.radians(angle_rot)
+        TanRot=np.tan(RotRad)
+        hy=int(abs(TanRot*ww*0.5))
+       
+        
+
+        # y0 inferieur à hauteur on padde des bandes haut et bas pour ne pas cropper apres rotation
+        if y0<he :
+            #print('hauteur bande auto : ', hy)
+            #print('hauteur fixe : ', abs(he+hy-y0))
+            #hy=50
+            """
+            pad_area= np.ones((abs(he+hy-y0),ww))
+            fr_avant_rot=np.concatenate((pad_area,fr_avant_rot,pad_area))
+            cercle[1]=he+hy
+            cercle0[1]=he+hy
+            """
+            pad_area= np.ones((hy,ww))
+            fr_avant_rot=np.concatenate((pad_area,fr_avant_rot,pad_area))
+            cercle[1]=y0+hy
+            #if k==0: cercle0[1]=y0+hy
+            
+                    
+        # et on met a jour dimensions de l'image avant rotation
+        h,w=fr_avant_rot.shape[:2]
+        # calcul de la matrice de rotation, angle en degre
+        rotation_mat=cv2.getRotationMatrix2D((int(cercle[0]),int(cercle[1])),float(angle_rot),1.0)
+                    
+        # application de la matrice de rotation
+        fr_rot=cv2.warpAffine(fr_avant_rot,rotation_mat,(w,h),flags=cv2.INTER_LINEAR)
+        frame=np.array(fr_rot, dtype='uint16')
+    else :
+        h, w = frame.shape
         
-        debug_crop=False
-        #auto_crop=True
+
+    if cfg.LG == 1:
+        logme('Centre xc,yc et rayon : '+str(cercle[0])+' '+str(cercle[1])+' '+str(int(r)))
+    else:
+        logme('xc,yc center and radius : '+str(cercle[0])+' '+str(cercle[1])+' '+str(int(r)))
+    
+    # on croppe et on centre
+    # Hauteur du capteur est dans dam_Heigth=scan.height
+    
+    debug_crop=False
+    #auto_crop=True
+    
+    if flag_nobords :
+        auto_crop=False
+        cercle=[0,0,0,0]
+    
+    if auto_crop :
         
-        if flag_nobords :
+        #cercleC, crop_he, crop_wi, crop_img=auto_crop_img(cam_height, h, w, frame, cercle0, debug_crop)
+        cercleC, crop_he, crop_wi, crop_img=auto_crop_img(cam_height, h, w, frame, cercle, debug_crop, param) # [0,0,1200,1200])
+        if crop_he==0 :
             auto_crop=False
-            cercle=[0,0,0,0]
+            if cfg.LG == 1:
+                print("Erreur AutoCrop")
+            else:
+                print ("Error AutoCrop")
+    
+    # doit changer les coord du centre
+    
+    if auto_crop :
         
-        if auto_crop :
-            
-            #cercleC, crop_he, crop_wi, crop_img=auto_crop_img(cam_height, h, w, frame, cercle0, debug_crop)
-            cercleC, crop_he, crop_wi, crop_img=auto_crop_img(cam_height, h, w, frame, cercle, debug_crop, param) # [0,0,1200,1200])
-            if crop_he==0 :
-                auto_crop=False
-                if cfg.LG == 1:
-                    print("Erreur AutoCrop")
-                else:
-                    print ("Error AutoCrop")
+        # Sauvegarde en fits de l'image finale
+        frame=np.array(crop_img, dtype='uint16')
+        hdr['NAXIS1']=crop_wi
+        hdr['NAXIS2']=crop_he
         
-        # doit changer les coord du centre
+        hdr['INTI_XC'] = cercleC[0]
+        hdr['INTI_YC'] = cercleC[1]
+        hdr['INTI_R'] = cercleC[2]
+        # duplication keywords pour BASS2000
+        hdr['CENTER_X'] = cercleC[0]
+        hdr['CENTER_Y'] = cercleC[1]
+        hdr['SOLAR_R'] = cercleC[2]
         
-        if auto_crop :
-            
-            # Sauvegarde en fits de l'image finale
-            frame=np.array(crop_img, dtype='uint16')
-            hdr['NAXIS1']=crop_wi
-            hdr['NAXIS2']=crop_he
-            
-            hdr['INTI_XC'] = cercleC[0]
-            hdr['INTI_YC'] = cercleC[1]
-            hdr['INTI_R'] = cercleC[2]
-            # duplication keywords pour BASS2000
-            hdr['CENTER_X'] = cercleC[0]
-            hdr['CENTER_Y'] = cercleC[1]
-            hdr['SOLAR_R'] = cercleC[2]
-            
-            # recalcul des coordonnées haut et bas du disque
-            y1_img,y2_img = detect_bord(frame, axis=1, offset=0,flag_disk=True)
-            x1_img,x2_img = detect_bord(frame, axis=0, offset=0,flag_disk=True)
-            hdr['INTI_Y1'] = y1_img
-            hdr['INTI_Y2'] = y2_img
-            hdr['INTI_X1'] = x1_img
-            hdr['INTI_X2'] = x2_img
+        # recalcul des coordonnées haut et bas du disque
+        y1_img,y2_img = detect_bord(frame, axis=1, offset=0,flag_disk=True)
+        x1_img,x2_img = detect_bord(frame, axis=0, offset=0,flag_disk=True)
+        hdr['INTI_Y1'] = y1_img
+        hdr['INTI_Y2'] = y2_img
+        hdr['INTI_X1'] = x1_img
+        hdr['INTI_X2'] = x2_img
+    
+    else :
+        # Sauvegarde en fits de l'image finale
+        #cercleC=cercle0
+        cercleC=cercle
+        frame=np.array(frame, dtype='uint16')
+        hdr['NAXIS1']=newiw
+
+        hdr['INTI_XC'] = cercle[0]
+        hdr['INTI_YC'] = cercle[1]
+        hdr['INTI_R'] = cercle[2]
+        # duplication keywords pour BASS2000
+        hdr['CENTER_X'] = cercle[0]
+        hdr['CENTER_Y'] = cercle[1]
+        hdr['SOLAR_R'] = cercle[2]
         
-        else :
-            # Sauvegarde en fits de l'image finale
-            #cercleC=cercle0
-            cercleC=cercle
-            frame=np.array(frame, dtype='uint16')
-            hdr['NAXIS1']=newiw
-
-            hdr['INTI_XC'] = cercle[0]
-            hdr['INTI_YC'] = cercle[1]
-            hdr['INTI_R'] = cercle[2]
-            # duplication keywords pour BASS2000
-            hdr['CENTER_X'] = cercle[0]
-            hdr['CENTER_Y'] = cercle[1]
-            hdr['SOLAR_R'] = cercle[2]
-            
-            # recalcul des coordonnées haut et bas du disque
-            y1_img,y2_img = detect_bord(frame, axis=1, offset=0,flag_disk=True)
-            x1_img,x2_img = detect_bord(frame, axis=0, offset=0,flag_disk=True)
-            hdr['INTI_Y1'] = y1_img
-            hdr['INTI_Y2'] = y2_img
-            hdr['INTI_X1'] = x1_img
-            hdr['INTI_X2'] = x2_img
+        # recalcul des coordonnées haut et bas du disque
+        y1_img,y2_img = detect_bord(frame, axis=1, offset=0,flag_disk=True)
+        x1_img,x2_img = detect_bord(frame, axis=0, offset=0,flag_disk=True)
+        hdr['INTI_Y1'] = y1_img
+        hdr['INTI_Y2'] = y2_img
+        hdr['INTI_X1'] = x1_img
+        hdr['INTI_X2'] = x2_img
 
 
 
-        hdr['FILENAME']= basefich+img_suff[k]+'_'+filename_suffixe+".fits"
-        
-        if auto_crop :
-            if cfg.LG == 1:
-                logme('Centre xcc,ycc et rayon : '+str(cercleC[0])+' '+str(cercleC[1])+' '+str(int(r)))
-                logme('Coordonnées y1,y2 et x1,x2 disque : '+str(y1_img)+','+str(y2_img)+' '+str(x1_img)+','+str(x2_img))
-            else:
-                logme('xcc,ycc center and radius : '+str(cercleC[0])+' '+str(cercleC[1])+' '+str(int(r)))
-                logme('Coordinates y1,y2 and x1,x2 disk : '+str(y1_img)+','+str(y2_img)+' '+str(x1_img)+','+str(x2_img))
+    hdr['FILENAME']= basefich+img_suff[k]+'_'+filename_suffixe+".fits"
+    
+    if auto_crop :
+        if cfg.LG == 1:
+            logme('Centre xcc,ycc et rayon : '+str(cercleC[0])+' '+str(cercleC[1])+' '+str(int(r)))
+            logme('Coordonnées y1,y2 et x1,x2 disque : '+str(y1_img)+','+str(y2_img)+' '+str(x1_img)+','+str(x2_img))
+        else:
+            logme('xcc,ycc center and radius : '+str(cercleC[0])+' '+str(cercleC[1])+' '+str(int(r)))
+            logme('Coordinates y1,y2 and x1,x2 disk : '+str(y1_img)+','+str(y2_img)+' '+str(x1_img)+','+str(x2_img))
 
-        try :
-            print('solar data : ', solar_dict)
-            hdr['SEP_LAT']=float(solar_dict['B0'])
-            hdr['SEP_LON']=float(solar_dict['L0'])
-            hdr['SOLAR_P']=float(ang_P)
-            hdr['CAR_ROT']=float(solar_dict['Carr'])
-        except:
-            pass
-        
+    try :
+        print('solar data : ', solar_dict)
+        hdr['SEP_LAT']=float(solar_dict['B0'])
+        hdr['SEP_LON']=float(solar_dict['L0'])
+        hdr['SOLAR_P']=float(ang_P)
+        hdr['CAR_ROT']=float(solar_dict['Carr'])
+    except:
+        pass
 
-        with  open(os.path.join(WorkDir,basefich+'_log.txt'), "w") as logfile:
-            logfile.writelines(mylog)
-        
+    
+    if k==0 :
+        # geometrie du disque k=0 pour les autres decalages
+        ctx=dict(ctx, auto_crop=auto_crop, ang_tilt=ang_tilt, ratio_fixe=ratio_fixe_d1, ratio_fixe_d1=ratio_fixe_d1,
+                 cercle0=cercle0, cercle=list(cercle), r=r)
+    ctx=dict(ctx, hdr=hdr)
+    
+    return frame, cercleC, ctx
 
-        
-        # ajoute l'image a la liste
-        frames.append(frame)
-        
 
-        
-        
-    return frames, hdr, cercleC, range_dec, geom, poly
+def disk_proc_worker(k, disk, ctx):
+    # disk_proc dans un processus separé, retourne aussi les lignes du log
+    clearlog()
+    frame, cercleC, ctx = disk_proc(k, disk, ctx)
+    return frame, cercleC, ctx, list(mylog)
+
     
\ No newline at end of file
@@ -1,5 +1,4 @@
 import time
-import cv2
 import numpy as np
 from pathlib import Path
 from libcamera import controls
@@ -10,6 +9,11 @@ from abc import ABC
 from abc import abstractmethod
 from image import AbstractImageRaw12BitColor, ImageRawCameraHQ
 
+# Number of output frame buffers used in turn by the capture, a frame is only valid
+# until FRAME_BUFFERS more frames are captured: the consumers keeping it longer
+# (SER ring, preview) copy it
+FRAME_BUFFERS = 4
+
 def getMaxAduValue(array):
     """
     Get the maximum ADU value from the given array.
@@ -61,6 +65,9 @@ class BaseIMX477Camera_CSI(ABC):
         # see more about camera black level https://www.strollswithmydog.com/pi-hq-cam-sensor-performance/
         self.black_level_camera = 200
 
+        self._frame_buffers = []
+        self._frame_buffer_index = 0
+
     def init(self):
         """
         Initialize the camera with specific settings.
@@ -125,17 +132,35 @@ class BaseIMX477Camera_CSI(ABC):
         """
         return True
 
+    def _next_frame_buffer(self, shape):
+        """
+        Get the next preallocated output frame buffer.
+
+        Args:
+            shape (tuple): Shape of the output frame.
+
+        Returns:
+            numpy.ndarray: uint16 buffer, reused every FRAME_BUFFERS frames.
+        """
+        if not self._frame_buffers or self._frame_buffers[0].shape != shape:
+            self._frame_buffers = [np.empty(shape, dtype=np.uint16) for i in range(FRAME_BUFFERS)]
+        self._frame_buffer_index = (self._frame_buffer_index + 1) % len(self._frame_buffers)
+        return self._frame_buffers[self._frame_buffer_index]
+
     def process_monobin_mode(self, image: AbstractImageRaw12BitColor, monobin_mode):
-        match monobin_mode: 
-            case 0:  # rgb monobin
-                array = (image.bin_2x2() - (self.black_level_camera * 4)) 
-            case 1:  # red layer
-                array = (image.channel_red() - self.black_level_camera)
-            case 2:  # green layer
-                array = (image.channel_green() - self.black_level_camera)
-            case 3:  # blue layer
-                array = (image.channel_blue() - self.black_level_camera)
-        return array * 4 # 16 bits conversion
+        """
+        Convert the image to a black level corrected 16-bit mono frame (rgb monobin,
+        red, green or blue layer), in a preallocated buffer.
+
+        Args:
+            image (AbstractImageRaw12BitColor): The cropped raw image.
+            monobin_mode (int): 0 for rgb monobin, 1 for red, 2 for green, 3 for blue.
+
+        Returns:
+            numpy.ndarray: 16-bit mono frame.
+        """
+        out = self._next_frame_buffer((image.array.shape[0]//2, image.array.shape[1]//2))
+        return image.monobin(monobin_mode, self.black_level_camera, out)
 
     def capture(self, isRecording):
         """
@@ -160,22 +185,20 @@ class BaseIMX477Camera_CSI(ABC):
         else:
             image = image.crop(0, self._preview_crop_y, self._sensor_size[0], self._preview_crop_height)
 
-        if not isRecording:
-            self._max_adu = image.calculate_max_adu()
-
         if self._monobin:
             # mono image output
-            array_16bit = self.process_monobin_mode(image, monobin_mode=self._monobin_mode)
-            array_16bit[array_16bit>65535]=65535  # clip values to 16-bit
-            frame = np.uint16(array_16bit)  # cast to uint16
+            # black level, 16 bits conversion, clipping and max ADU are done in the same pass
+            frame = self.process_monobin_mode(image, monobin_mode=self._monobin_mode)
+            if not isRecording:
+                self._max_adu = image.calculate_max_adu()
 
         else:
-            # color image output
-            f = image.to_rgb_16bit()
-            height = f.shape[0]//4
-            width = f.shape[1]//4
-            r = cv2.resize(f, (width, height))
-            frame = np.uint16(r)
+            if not isRecording:
+                self._max_adu = image.calculate_max_adu()
+
+            # color image output, quarter resolution built from the Bayer superpixels
+            out = self._next_frame_buffer((image.array.shape[0]//4, image.array.shape[1]//4, 3))
+            frame = image.to_rgb_16bit_binned(2, out)
         return frame
            
     def stop(self):
@@ -257,10 +280,10 @@ class IMX477Camera_CSI_rpi5(BaseIMX477Camera_CSI):
         """
         raw_array = self._picam2.capture_array('raw').view(np.uint16)
 
-        # Extract the 12 most significant bits
-        raw_array_12bit = raw_array >> 4
+        # Extract the 12 most significant bits, in place as the array is a new copy of the buffer
+        raw_array >>= 4
 
-        return raw_array_12bit.astype(np.uint16)
+        return raw_array
 
 
 
@@ -2,15 +2,234 @@
 import time
 import os
 import json
+import queue
+import statistics
+import numpy as np
+from collections import deque
 from datetime import datetime, timezone
 from pprint import *
-from threading import Condition, Thread
+from threading import Condition, Thread, Lock
 
 try:
     from serfilesreader import Serfile
 except:
     from serfilesreader.serfilesreader import Serfile
 
+from live_recon import LiveReconstructor
+
+class SerRingWriter:
+    """
+    Write frames to a SER file from a dedicated thread through a preallocated ring of buffers.
+
+    The capture thread only copies each frame into a free slot of the ring, so a
+    storage stall delays the writer thread instead of the next capture. When the
+    ring is full the frame is dropped and counted as an overrun.
+    """
+
+    def __init__(self, serfile_object, slots=32, max_bytes=256*1024*1024, live=None):
+        """
+        Initialize the ring writer and start the writer thread.
+
+        :param serfile_object: Serfile opened for writing (see Serfile.openWriter)
+        :param live: Optional LiveReconstructor fed with each written frame
+        :param slots: Maximum number of frame buffers in the ring
+        :param max_bytes: Memory budget of the ring, limits the number of slots for large frames
+        """
+        self._serfile_object = serfile_object
+        self._live = live
+        self._max_slots = slots
+        self._max_bytes = max_bytes
+        self._buffers = None
+        self._buffer_dates = None
+        self._dates = []
+        self._free = queue.Queue()
+        self._filled = queue.Queue()
+        self._high_water = 0
+        self._overruns = 0
+        self._written = 0
+        self._bytes_written = 0
+        self._error = None
+        self._thread = Thread(target=self._thread_func, daemon=True)
+        self._thread.start()
+
+    def _allocate(self, frame):
+        """
+        Preallocate the ring buffers with the shape and type of the first frame.
+
+        :param frame: First frame of the record
+        """
+        count = max(2, min(self._max_slots, self._max_bytes // max(1, frame.nbytes)))
+        self._buffers = np.empty((count,) + frame.shape, dtype=frame.dtype)
+        self._buffer_dates = np.zeros(count, dtype=np.uint64)
+        for i in range(count):
+            self._free.put(i)
+
+    def push(self, frame, date=0):
+        """
+        Copy a frame into a free slot of the ring and queue it for writing.
+
+        :param frame: The frame to record
+        :param date: Capture date of the frame as a SER timestamp, written in the file trail
+        :return: False if the ring was full and the frame was dropped, True otherwise
+        """
+        if self._buffers is None:
+            self._allocate(frame)
+        try:
+            i = self._free.get_nowait()
+        except queue.Empty:
+            self._overruns += 1
+            return False
+        np.copyto(self._buffers[i], frame)
+        self._buffer_dates[i] = date
+        self._filled.put(i)
+        self._high_water = max(self._high_water, self._filled.qsize())
+        return True
+
+    def _thread_func(self):
+        """
+        Writer thread, append queued frames to the SER file until close() is called.
+        """
+        while True:
+            i = self._filled.get()
+            if i is None:
+                break
+            try:
+                if self._error is None:
+                    self._serfile_object.writeFrame(self._buffers[i])
+                    self._dates.append(self._buffer_dates[i])
+                    self._written += 1
+                    self._bytes_written += self._buffers[i].nbytes
+                    if self._live:
+                        self._addLiveFrame(self._buffers[i])
+            except Exception as e:
+                # keep draining the ring so the capture thread is never blocked
+                self._error = e
+                print('SER writer error :', e)
+            self._free.put(i)
+
+    def _addLiveFrame(self, frame):
+        """
+        Feed the live reconstruction, which is abandoned on error so that the record goes on.
+
+        :param frame: The frame just written
+        """
+        try:
+            self._live.addFrame(frame)
+        except Exception as e:
+            print('live reconstruction error :', e)
+            self._live = None
+
+    def close(self):
+        """
+        Write the remaining queued frames, then close the SER file with the frame dates trail
+        and save the live reconstruction if any.
+        """
+        self._filled.put(None)
+        self._thread.join()
+        self._serfile_object.closeWriter(trail=np.array(self._dates, dtype=np.uint64))
+        if self._live:
+            try:
+                self._live.close()
+            except Exception as e:
+                print('live reconstruction error :', e)
+        self._buffers = None
+
+    def getStats(self):
+        """
+        Get the ring buffer counters.
+
+        :return: Dictionary with queue depth, high-water mark, overruns, written frames and bytes
+        """
+        return {'queue_depth': self._filled.qsize(),
+                'high_water': self._high_water,
+                'overruns': self._overruns,
+                'written': self._written,
+                'bytes_written': self._bytes_written,
+                'slots': 0 if self._buffers is None else len(self._buffers),
+                'error': None if self._error is None else str(self._error)}
+
+
+class FrameTelemetry:
+    """
+    Frame rate counters of a stream of frames: instantaneous and average fps,
+    histogram of the intervals between frames and detected frame gaps.
+    """
+
+    # Upper bounds of the interval histogram bins, in milliseconds, the last bin has no bound
+    HISTOGRAM_MS = (50, 100, 150, 200, 300, 500, 1000)
+
+    def __init__(self, gap_factor=1.5, window=50):
+        """
+        Initialize the counters.
+
+        :param gap_factor: An interval longer than gap_factor times the median interval is a gap,
+                           same rule as Serfile.findFrameGaps
+        :param window: Number of recent intervals of the median interval
+        """
+        self._gap_factor = gap_factor
+        self._window = window
+        self.reset()
+
+    def reset(self):
+        """
+        Clear the counters.
+        """
+        self._frames = 0
+        self._first = None
+        self._last = None
+        self._interval = None
+        self._intervals = deque(maxlen=self._window)
+        self._histogram = [0] * (len(self.HISTOGRAM_MS) + 1)
+        self._gaps = 0
+
+    def addFrame(self, t):
+        """
+        Count a new frame.
+
+        :param t: Time of the frame in seconds, from time.monotonic()
+        """
+        self._frames += 1
+        if self._last is None:
+            self._first = self._last = t
+            return
+        interval = t - self._last
+        self._last = t
+        self._interval = interval
+        if len(self._intervals) >= 5 and interval > self._gap_factor * statistics.median(self._intervals):
+            self._gaps += 1
+        self._intervals.append(interval)
+        ms = interval * 1000
+        b = 0
+        while b < len(self.HISTOGRAM_MS) and ms > self.HISTOGRAM_MS[b]:
+            b += 1
+        self._histogram[b] += 1
+
+    def elapsed(self):
+        """
+        Get the time between the first and the last frame.
+
+        :return: Time in seconds
+        """
+        if self._first is None:
+            return 0
+        return self._last - self._first
+
+    def getStats(self):
+        """
+        Get the counters.
+
+        :return: Dictionary with frames, instantaneous and average fps, interval histogram and gaps
+        """
+        elapsed = self.elapsed()
+        return {'frames': self._frames,
+                'elapsed': elapsed,
+                'fps': 1 / self._interval if self._interval else None,
+                'average_fps': (self._frames - 1) / elapsed if elapsed > 0 else None,
+                'interval_ms': self._interval * 1000 if self._interval is not None else None,
+                'histogram_ms': {'bounds': list(self.HISTOGRAM_MS), 'counts': list(self._histogram)},
+                'gaps': self._gaps}
+
+
 class CameraController:
     """
     A class to control camera operations, including recording and image processing.
@@ -34,6 +253,8 @@ class CameraController:
         self._camera = camera
         self._bin = False
         self._focus_assistant = False
+        self._live_recon = False
+        self._live_shifts = [0, -1, 1]
 
         self._record = False
 
@@ -42,12 +263,18 @@ class CameraController:
         self._filename_prefix = filename_prefix
         self._stream = stream
         self._frame = []
+        self._frame_seq = 0
         self._condition = Condition()
         self._running = True
         self._count = 0
         self._fc = 0
         
         self._serfile_object = None
+        self._serfile_lock = Lock()
+        self._ser_writer = None
+        self._record_stats = {}
+        self._capture_telemetry = FrameTelemetry()
+        self._record_telemetry = FrameTelemetry()
         self._normalize = 1
         self._max_visu_threshold = 256
 
@@ -67,15 +294,24 @@ class CameraController:
         """
         print('Thread camera is running...')
         while(self._running):
-            self._frame = self._camera.capture(self._record)  # Capture a frame from the camera
+            frame = self._camera.capture(self._record)  # Capture a frame from the camera
+            capture_ts = get_custom_ts_ns(time.time_ns())  # UTC capture date of the frame, SER format
+            capture_time = time.monotonic()
+            self._capture_telemetry.addFrame(capture_time)  # Frame rate counters of the capture
+            with self._condition:  # Publish the frame and wake up the preview
+                self._frame = frame
+                self._frame_seq += 1
+                self._condition.notify_all()
             if not self.isInColorMode():  # Check if the camera is not in color mode
-                if self._record:  # Check if recording is active
-                    if not self._serfile_object:  # If SER file object doesn't exist
-                        self._initSerFile()  # Initialize a new SER file
-                        self._t0 = time.time()  # Set the start time for recording
-                    self._time_in_progress = time.time()  # Update the current time
-                    self._serfile_object.addFrame(self._frame)  # Add the captured frame to the SER file
-                    self._fc+=1  # Increment the frame count
+                with self._serfile_lock:  # stopRecord may close the SER file meanwhile
+                    if self._record:  # Check if recording is active
+                        if not self._serfile_object:  # If SER file object doesn't exist
+                            self._initSerFile()  # Initialize a new SER file
+                            self._t0 = time.time()  # Set the start time for recording
+                        self._time_in_progress = time.time()  # Update the current time
+                        if self._ser_writer.push(frame, capture_ts):  # Queue the captured frame for the writer thread
+                            self._fc+=1  # Increment the frame count
+                            self._record_telemetry.addFrame(capture_time)  # Frame rate counters of the record
 
        
     def isRecording(self):
@@ -155,8 +391,10 @@ class CameraController:
         Stop the camera controller thread and release resources.
         """
         self._running = False
-        self._frame = None
         self._thread.join()
+        with self._condition:
+            self._frame = None
+            self._condition.notify_all()
         self._camera_status = 'disconnected'
         self._camera.stop()
 
@@ -164,9 +402,33 @@ class CameraController:
         """
         Get the most recent captured frame.
 
-        :return: The last captured frame
+        The frame is a copy owned by the caller, the capture reuses its frame buffers.
+
+        :return: The last captured frame, or None if there is none
+        """
+        with self._condition:
+            if self._frame is None:
+                return None
+            return self._frame.copy()
+
+    def waitFrame(self, seq, timeout=1.0):
+        """
+        Wait for a frame newer than a sequence number.
+
+        The new frame is a copy owned by the caller, the capture reuses its frame
+        buffers while the caller may still read it (snapshot, profiles, encoding).
+
+        :param seq: Sequence number of the last frame already seen
+        :param timeout: Maximum waiting time in seconds
+        :return: Tuple (sequence number, frame), the sequence number is still seq on timeout
         """
-        return self._frame
+        with self._condition:
+            self._condition.wait_for(lambda: self._frame_seq != seq, timeout)
+            frame = self._frame
+            if self._frame_seq != seq and frame is not None:
+                # copied before the capture thread can publish and reuse more buffers
+                frame = frame.copy()
+            return self._frame_seq, frame
 
     def getCameraControls(self):
         """
@@ -186,6 +448,7 @@ class CameraController:
                 'preview_crop_height': self._preview_crop_height,
                 'monobin_mode': self._monobin_mode,
                 'focus_assistant': self._focus_assistant,
+                'live_recon': self._live_recon,
                 'bin': self._bin,
                 'monobin':self._monobin, 
                 'camera':self._camera.getName()}
@@ -225,6 +488,36 @@ class CameraController:
             self._focus_assistant = not self._focus_assistant
             self._camera.updateCameraControls(self.getCameraControls())
 
+    def toggleLiveRecon(self):
+        """
+        Toggle the reconstruction of the raw disk while recording.
+        """
+        self._live_recon = not self._live_recon
+
+    def setLiveShifts(self, shifts):
+        """
+        Set the pixel shifts from the line center extracted by the live reconstruction.
+
+        :param shifts: List of integer shifts, 0 is always extracted
+        """
+        self._live_shifts = [0] + [int(s) for s in shifts if int(s) != 0]
+
+    def getLiveShifts(self):
+        """
+        Get the pixel shifts extracted by the live reconstruction.
+
+        :return: List of integer shifts
+        """
+        return self._live_shifts
+
+    def liveReconIsOn(self):
+        """
+        Check if the live reconstruction is active.
+
+        :return: Boolean indicating live reconstruction status
+        """
+        return self._live_recon
+
     def toggleNormalize(self, mode):
         """
         Toggle image normalization.
@@ -267,11 +560,38 @@ class CameraController:
         self._camera.updateCameraControls(self.getCameraControls())
         
 
+    def getRecordStats(self):
+        """
+        Get the SER writer counters of the current record, or of the last one.
+
+        :return: Dictionary with queue depth, high-water mark, overruns and written frames
+        """
+        ser_writer = self._ser_writer
+        if ser_writer:
+            return ser_writer.getStats()
+        return self._record_stats
+
+    def getTelemetry(self):
+        """
+        Get the frame rate counters of the capture and of the current or last record,
+        with the SER writer backlog and throughput.
+
+        :return: Dictionary with 'capture', 'record' and 'writer' counters
+        """
+        writer = dict(self.getRecordStats())
+        elapsed = self._record_telemetry.elapsed()
+        writer['bytes_per_second'] = writer.get('bytes_written', 0) / elapsed if elapsed > 0 else None
+        return {'recording': self._record,
+                'capture': self._capture_telemetry.getStats(),
+                'record': self._record_telemetry.getStats(),
+                'writer': writer}
+
     def startRecord(self):
         """
         Start recording frames.
         """
         self._serfile_object = None
+        self._record_telemetry.reset()
         self._fc = 1
         self._time_in_progress =0
         self._t0 =0  
@@ -281,9 +601,16 @@ class CameraController:
         """
         Stop recording frames and print recording statistics.
         """
-        self._record = False
-        print(self._fc,self._time_in_progress,self._t0)
-        print(f"frame count : {self._fc} time:{self._time_in_progress-self._t0} fps:{self._fc/(self._time_in_progress-self._t0)}")
+        with self._serfile_lock:
+            self._record = False
+            ser_writer = self._ser_writer
+            self._ser_writer = None
+        if ser_writer:
+            ser_writer.close()  # Write queued frames and final FrameCount
+            self._record_stats = ser_writer.getStats()
+            print('SER writer :', self._record_stats)
+        record = self._record_telemetry.getStats()
+        print(f"frame count : {self._fc} time:{record['elapsed']} fps:{record['average_fps']} gaps:{record['gaps']}")
         return self._final_ser_filename
 
     def _initSerFile(self):
@@ -337,8 +664,13 @@ class CameraController:
         serfile_object.setDateTime(custom_ser_ts)
         serfile_object.setDateTimeUTC(custom_ser_ts)
         
-        # Store the Serfile object
+        # Keep a single buffered handle open for the whole record
+        serfile_object.openWriter(checkpoint=100)
+        
+        # Store the Serfile object, frames are written by a dedicated thread
         self._serfile_object = serfile_object
+        live = LiveReconstructor(self._final_ser_filename, shifts=self._live_shifts) if self._live_recon else None
+        self._ser_writer = SerRingWriter(serfile_object, live=live)
         
         # Write camera controls to a configuration file
         with  open(os.path.join(full_path, 'sunscan_conf.txt'), "w") as logfile:
@@ -355,4 +687,11 @@ def get_custom_ts(datetime):
 
     # Adjust to custom epoch by adding the offset
     custom_epoch_time = epoch_offset_100ns + current_time_100ns 
-    return int(custom_epoch_time  )  
\ No newline at end of file
+    return int(custom_epoch_time  )  
+
+
+def get_custom_ts_ns(timestamp_ns):
+    # Same as get_custom_ts, from an integer Unix timestamp in nanoseconds (time.time_ns())
+    # to keep the 100-nanoseconds resolution of the SER dates
+    epoch_offset_100ns = 621355968000000000
+    return epoch_offset_100ns + timestamp_ns // 100
@@ -26,3 +26,25 @@ LineDict = {
   'caIIK':'Ca II K line - 3934 Å',
   'caIIH':'Ca II H line - 3968  Å',
 }
+
+# Number of frames sampled over the whole scan to compute the mean image used
+# for the slit polynomial, so that the SER file is read only once in full.
+# 0 to sum all the frames.
+MeanFrames = 256
+
+# Size in bytes of the blocks of frames processed together during the
+# reconstruction, small enough to stay in the RAM of a Raspberry Pi.
+BlockBytes = 16*1024*1024
+
+# Number of processes used to post-process the shifted disks (doppler,
+# continuum...) once the geometry of the line center disk is known.
+# 1 to process them one after the other.
+DiskWorkers = 4
+
+# Number of scans processed at the same time by the job queue. Only one
+# scan is processed while recording, so that the capture is never starved.
+ScanJobWorkers = 2
+
+# Maximum distance in pixels between the slit polynomials fitted on two
+# interleaved samples. Above it, the mean image is computed on all the frames.
+MeanPolyTol = 0.5
@@ -3,7 +3,6 @@ from abc import ABC
 import cv2
 import numpy as np
 from numba import jit
-from picamera2 import Picamera2, Platform
 
 class AbstractImageRaw12BitColor(ABC):
     def __init__(self, array: np.ndarray):
@@ -11,6 +10,7 @@ class AbstractImageRaw12BitColor(ABC):
         self._red_channel = None
         self._green_channel = None
         self._blue_channel = None
+        self._max_adu = None
 
     def _get_channel(self, channel_name: str, extract_method: callable) -> np.ndarray:
         if getattr(self, channel_name) is None:
@@ -35,6 +35,39 @@ class AbstractImageRaw12BitColor(ABC):
         """
         return bin2dBayer(np.array(self.array),2)
 
+    def monobin(self, monobin_mode: int, black_level: int, out: np.ndarray = None) -> np.ndarray:
+        """
+        Convert the image to a 16-bit mono image in a single pass, without intermediate arrays.
+        The maximum ADU values are measured in the same pass, see calculate_max_adu.
+
+        Args:
+            monobin_mode (int): 0 for the 2x2 bin of all channels, 1 for red, 2 for green, 3 for blue.
+            black_level (int): Black level of one pixel, in ADU, subtracted monobin_black times.
+            out (numpy.ndarray): Optional uint16 output array of half the image size.
+
+        Returns:
+            numpy.ndarray: Black level corrected 16-bit mono image.
+        """
+        weights = self.monobin_weights[monobin_mode]
+        if out is None:
+            out = np.empty((self.array.shape[0]//2, self.array.shape[1]//2), dtype=np.uint16)
+        self._run_kernel(weights, black_level * self.monobin_black[monobin_mode], out)
+        return out
+
+    def _run_kernel(self, weights: np.ndarray, black: int, out: np.ndarray):
+        """
+        Run the monobin kernel and keep the maximum ADU values.
+
+        Args:
+            weights (numpy.ndarray): Weights of the 4 pixels of a superpixel in the mono output.
+            black (int): Black level of the weighted sum.
+            out (numpy.ndarray): uint16 output array, empty for the maximum ADU values only.
+        """
+        max_adu = np.zeros(3, dtype=np.int64)
+        monobinBayer(self.array, weights, self.bayer_channels, black, out, max_adu)
+        # the green maximum is the one of the mean of the two green pixels
+        self._max_adu = (int(max_adu[0]), max_adu[1] / 2, int(max_adu[2]))
+
     def to_rgb_16bit(self):
         """
         Convert the Bayer pattern image to an RGB image.
@@ -43,6 +76,26 @@ class AbstractImageRaw12BitColor(ABC):
             numpy.ndarray: Converted RGB image.
         """
         return cv2.cvtColor(self.array * 16, cv2.COLOR_BayerRGGB2RGB)
+
+    def to_rgb_16bit_binned(self, factor: int = 2, out: np.ndarray = None) -> np.ndarray:
+        """
+        Convert the Bayer pattern image to a reduced color image built straight from
+        the 2x2 Bayer superpixels, without full resolution demosaic nor resize.
+        The channels are in the BGR order of OpenCV, as with to_rgb_16bit.
+
+        Args:
+            factor (int): Number of superpixels averaged along each axis, the output is
+                          1/(2*factor) of the image size (1 for half, 2 for quarter resolution).
+            out (numpy.ndarray): Optional uint16 output array of shape (height, width, 3).
+
+        Returns:
+            numpy.ndarray: Converted 16-bit BGR image.
+        """
+        size = 2 * factor
+        if out is None:
+            out = np.empty((self.array.shape[0]//size, self.array.shape[1]//size, 3), dtype=np.uint16)
+        debayerBayer(self.array, self.bayer_channels, factor, out)
+        return out
  
     def calculate_max_adu(self) -> tuple[int, int, int]:
         """
@@ -52,10 +105,10 @@ class AbstractImageRaw12BitColor(ABC):
         Returns:
             tuple[int, int, int]: Maximum ADU values (red, green, blue).
         """
-        red_max = np.max(self.channel_red())
-        green_max = np.max(self.channel_green()/2)
-        blue_max = np.max(self.channel_blue())
-        return (red_max, green_max, blue_max)
+        if self._max_adu is None:
+            # not measured by monobin, single pass without mono output
+            self._run_kernel(self.monobin_weights[0], 0, np.empty((0, 0), dtype=np.uint16))
+        return self._max_adu
 
     def crop(self, crop_x: int, crop_y: int, crop_width: int, crop_height: int) -> 'AbstractImageRaw12BitColor':
         """
@@ -74,6 +127,20 @@ class AbstractImageRaw12BitColor(ABC):
     
 
 class ImageRawCameraHQ(AbstractImageRaw12BitColor):
+    # Pixels of a 2x2 Bayer superpixel in the order (0,0), (0,1), (1,0), (1,1)
+    # Channel of each pixel : 0 red, 1 green, 2 blue
+    bayer_channels = np.array([2, 1, 1, 0])
+    # Weight of each pixel in the mono output of each monobin mode
+    monobin_weights = {
+        0: np.array([1, 1, 1, 1]),  # rgb
+        1: np.array([0, 0, 0, 1]),  # red
+        2: np.array([0, 1, 1, 0]),  # green
+        3: np.array([1, 0, 0, 0]),  # blue
+    }
+    # Number of black levels subtracted from the sum of each monobin mode,
+    # a single one for the two green pixels as the photometry of the green mode always had
+    monobin_black = {0: 4, 1: 1, 2: 1, 3: 1}
+
     def __init__(self, array: np.ndarray):
         super().__init__(array)
     def extract_red_channel(self) -> np.ndarray:
@@ -118,5 +185,89 @@ def bin2dBayer(a, K):
     n_bins = a.shape[1]//K
     return a.reshape(m_bins, K, n_bins, K).sum(3).sum(1)
 
+@jit(nopython=True, cache=True)
+def monobinBayer(a, weights, channels, black, out, max_adu):
+    """
+    In a single pass over a Bayer pattern array, sum the selected pixels of each
+    2x2 superpixel, subtract the black level and convert to 16 bits, writing the
+    result in a preallocated array, and measure the maximum of each channel.
+
+    Args:
+        a (numpy.ndarray): Input Bayer pattern array, may be a non contiguous view.
+        weights (numpy.ndarray): Weights of the 4 pixels of a superpixel in the output.
+        channels (numpy.ndarray): Channel (0 red, 1 green, 2 blue) of the 4 pixels of a superpixel.
+        black (int): Black level of the weighted sum.
+        out (numpy.ndarray): uint16 output array of half the input size, or empty to only measure the maximums.
+        max_adu (numpy.ndarray): int64 array of 3 values, receive the maximum sum of the pixels of each channel in a superpixel.
+    """
+    write = out.shape[0] > 0
+    for i in range(a.shape[0]//2):
+        for j in range(a.shape[1]//2):
+            v = 0
+            c0 = 0
+            c1 = 0
+            c2 = 0
+            for k in range(4):
+                p = np.int64(a[2*i+k//2, 2*j+k%2])
+                v += weights[k] * p
+                c = channels[k]
+                if c == 0:
+                    c0 += p
+                elif c == 1:
+                    c1 += p
+                else:
+                    c2 += p
+            if c0 > max_adu[0]:
+                max_adu[0] = c0
+            if c1 > max_adu[1]:
+                max_adu[1] = c1
+            if c2 > max_adu[2]:
+                max_adu[2] = c2
+            if write:
+                v = (v - black) * 4  # 16 bits conversion
+                if v < 0:
+                    v = 0
+                elif v > 65535:
+                    v = 65535
+                out[i, j] = v
+
+@jit(nopython=True, cache=True)
+def debayerBayer(a, channels, factor, out):
+    """
+    Build a reduced 16-bit BGR image from a Bayer pattern array, each output pixel
+    being the mean of factor x factor superpixels of 2x2 Bayer pixels.
+
+    Args:
+        a (numpy.ndarray): Input 12-bit Bayer pattern array, may be a non contiguous view.
+        channels (numpy.ndarray): Channel (0 red, 1 green, 2 blue) of the 4 pixels of a superpixel.
+        factor (int): Number of superpixels averaged along each axis.
+        out (numpy.ndarray): uint16 output array of shape (height, width, 3), blue, green, red.
+    """
+    # pixels of each channel in a superpixel
+    count = np.zeros(3, dtype=np.int64)
+    for k in range(4):
+        count[channels[k]] += 1
+    for i in range(out.shape[0]):
+        for j in range(out.shape[1]):
+            s0 = 0
+            s1 = 0
+            s2 = 0
+            for y in range(2*factor*i, 2*factor*(i+1), 2):
+                for x in range(2*factor*j, 2*factor*(j+1), 2):
+                    for k in range(4):
+                        p = np.int64(a[y+k//2, x+k%2])
+                        c = channels[k]
+                        if c == 0:
+                            s0 += p
+                        elif c == 1:
+                            s1 += p
+                        else:
+                            s2 += p
+            n = factor * factor
+            # 16 bits conversion, BGR order
+            out[i, j, 2] = s0 * 16 // (n * count[0])
+            out[i, j, 1] = s1 * 16 // (n * count[1])
+            out[i, j, 0] = s2 * 16 // (n * count[2])
+
 
 
@@ -0,0 +1,242 @@
+"""
+Scan processing job queue.
+
+Scans to process are queued with a priority and run by a bounded pool of
+worker threads. The number of jobs running at the same time is limited to 1
+while the camera is recording, so that batch processing never starves the
+capture and the live preview. Each job reports its progress by stage.
+"""
+
+import itertools
+import time
+from threading import Condition, Thread
+
+
+class JobCancelled(Exception):
+    """Raised in a running job when it has been cancelled."""
+    pass
+
+
+class ScanJob:
+    """
+    A scan waiting for processing, running or done.
+    """
+
+    def __init__(self, job_id, scan, priority):
+        """
+        Initialize a new job.
+
+        :param job_id: Unique job identifier
+        :param scan: Scan model with the processing parameters
+        :param priority: Jobs with the highest priority run first
+        """
+        self.id = job_id
+        self.scan = scan
+        self.priority = priority
+        self.status = 'queued'
+        self.stage = ''
+        self.cancelled = False
+        self.created = time.time()
+        self.started = None
+        self.ended = None
+
+    def toDict(self):
+        """
+        Get the job description.
+
+        :return: Dictionary with the job state
+        """
+        return {'id': self.id,
+                'filename': self.scan.filename,
+                'priority': self.priority,
+                'status': self.status,
+                'stage': self.stage,
+                'created': self.created,
+                'started': self.started,
+                'ended': self.ended}
+
+
+class ScanJobQueue:
+    """
+    Priority queue of scan processing jobs run by a bounded pool of worker threads.
+    """
+
+    def __init__(self, process, notify, max_workers=2, is_busy=None, history=50):
+        """
+        Initialize the queue and start the worker threads.
+
+        :param process: Function process(callback, scan, progress) processing a scan
+        :param notify: Function notify(message) publishing job events to the clients
+        :param max_workers: Maximum number of jobs running at the same time
+        :param is_busy: Function returning True when only one job may run (e.g. while recording)
+        :param history: Number of finished jobs kept in the list
+        """
+        self._process = process
+        self._notify = notify
+        self._max_workers = max_workers
+        self._is_busy = is_busy
+        self._history = history
+        self._jobs = []
+        self._running = 0
+        self._ids = itertools.count(1)
+        self._condition = Condition()
+        for i in range(max_workers):
+            Thread(target=self._thread_func, daemon=True).start()
+
+    def _limit(self):
+        """
+        Get the number of jobs allowed to run now.
+
+        :return: 1 if is_busy() is True, max_workers otherwise
+        """
+        if self._is_busy and self._is_busy():
+            return 1
+        return self._max_workers
+
+    def _next(self):
+        """
+        Get the queued job with the highest priority, the oldest first.
+
+        :return: The job, or None if no job is queued
+        """
+        queued = [job for job in self._jobs if job.status == 'queued']
+        if not queued:
+            return None
+        return min(queued, key=lambda job: (-job.priority, job.id))
+
+    def _thread_func(self):
+        """
+        Worker thread, run the queued jobs one after the other.
+        """
+        while True:
+            with self._condition:
+                job = self._next()
+                while job is None or self._running >= self._limit():
+                    # the limit may change while recording, check it regularly
+                    self._condition.wait(timeout=1.0)
+                    job = self._next()
+                job.status = 'running'
+                job.started = time.time()
+                self._running += 1
+            self._publish(job)
+            self._run(job)
+            with self._condition:
+                self._running -= 1
+                job.ended = time.time()
+                self._prune()
+                self._condition.notify_all()
+            self._publish(job)
+
+    def _run(self, job):
+        """
+        Process the scan of a job and record its final status.
+
+        :param job: The job to run
+        """
+        def progress(stage):
+            if job.cancelled:
+                raise JobCancelled(job.id)
+            job.stage = stage
+            self._publish(job)
+
+        def callback(filename, status):
+            job.status = status
+
+        try:
+            self._process(callback=callback, scan=job.scan, progress=progress)
+        except Exception as e:
+            print('scan job error', job.id, e)
+            job.status = 'failed'
+        if job.cancelled:
+            job.status = 'cancelled'
+        elif job.status == 'running':
+            job.status = 'completed'
+
+    def _prune(self):
+        """
+        Forget the oldest finished jobs beyond the history size.
+        """
+        finished = [job for job in self._jobs if job.status not in ('queued', 'running')]
+        for job in finished[:max(0, len(finished)-self._history)]:
+            self._jobs.remove(job)
+
+    def _publish(self, job):
+        """
+        Send a job event to the clients.
+
+        :param job: The job whose state changed
+        """
+        self._notify(job)
+
+    def submit(self, scan, priority=0):
+        """
+        Queue a scan for processing.
+
+        :param scan: Scan model with the processing parameters
+        :param priority: Jobs with the highest priority run first
+        :return: The new job
+        """
+        with self._condition:
+            job = ScanJob(next(self._ids), scan, priority)
+            self._jobs.append(job)
+            self._condition.notify_all()
+        self._publish(job)
+        return job
+
+    def list(self):
+        """
+        Get all the jobs, queued, running and recently finished.
+
+        :return: List of job dictionaries
+        """
+        with self._condition:
+            return [job.toDict() for job in self._jobs]
+
+    def get(self, job_id):
+        """
+        Get a job by identifier.
+
+        :param job_id: The job identifier
+        :return: The job, or None if unknown
+        """
+        with self._condition:
+            for job in self._jobs:
+                if job.id == job_id:
+                    return job
+        return None
+
+    def cancel(self, job_id):
+        """
+        Cancel a job. A queued job is removed from the queue, a running job
+        stops at its next stage.
+
+        :param job_id: The job identifier
+        :return: The job, or None if unknown or already finished
+        """
+        with self._condition:
+            job = self.get(job_id)
+            if job is None or job.status not in ('queued', 'running'):
+                return None
+            job.cancelled = True
+            if job.status == 'queued':
+                job.status = 'cancelled'
+                job.ended = time.time()
+        self._publish(job)
+        return job
+
+    def setPriority(self, job_id, priority):
+        """
+        Change the priority of a queued job.
+
+        :param job_id: The job identifier
+        :param priority: The new priority
+        :return: The job, or None if unknown or not queued anymore
+        """
+        with self._condition:
+            job = self.get(job_id)
+            if job is None or job.status != 'queued':
+                return None
+            job.priority = priority
+            self._condition.notify_all()
+        self._publish(job)
+        return job
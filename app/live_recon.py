@@ -0,0 +1,174 @@
+"""
+Live reconstruction of the raw solar disk while a scan is recorded.
+
+The slit polynomial is locked from the mean of the first frames of the record,
+then the spectral columns of each new frame are extracted for a fixed list of
+shifts. When the record stops the raw disks are saved next to the SER file, so
+that solex_proc only has to run the geometric post-processing.
+
+The frames received before the lock are kept to be extracted afterwards. Their
+number and the lock attempts are bounded: a scan whose slit is never found
+(clouds, no slit, wrong crop) gives up the live reconstruction, solex_proc then
+processes it as usual.
+"""
+
+import os
+import numpy as np
+
+from Inti_functions import detect_bord, slit_fit, slit_indices, slit_gather, slit_extract
+
+LIVE_FILENAME = 'scan_live.npz'
+MAX_PENDING_FRAMES = 100  # frames kept while waiting for the slit polynomial
+MAX_LOCK_ATTEMPTS = 3
+
+
+class LiveReconstructor:
+    """
+    Build the raw disks of a scan from the frames as they are recorded.
+    """
+
+    def __init__(self, serfile, shifts=(0, -1, 1), lock_frames=50):
+        """
+        Initialize the live reconstruction of a scan.
+
+        :param serfile: Path of the SER file being recorded, the result is saved in the same directory
+        :param shifts: Pixel shifts from the line center to extract (same meaning as range_dec in solex_proc)
+        :param lock_frames: Number of frames used to lock the slit polynomial
+        """
+        self._serfile = serfile
+        self._shifts = list(shifts)
+        self._lock_frames = min(lock_frames, MAX_PENDING_FRAMES)
+        self._frame_count = 0
+        self._sum = None
+        self._kept = 0
+        self._pending = []
+        self._lock_attempts = 0
+        self._failed = False
+        self._columns = []
+        self._poly = None
+        self._indices = None
+
+    def _prepare(self, frame):
+        """
+        Put the spectrum horizontal, as solex_proc does.
+
+        :param frame: A SER frame
+        :return: The frame rotated if the spectral lines are vertical
+        """
+        if frame.shape[1] > frame.shape[0]:
+            return np.rot90(frame)
+        return frame
+
+    def _extract(self, img):
+        """
+        Extract the interpolated slit columns of a frame for each shift.
+
+        :param img: A frame with the spectrum horizontal
+        :return: Array of shape (len(shifts), ih)
+        """
+        left_weights, right_weights, ind_lr, rows = self._indices
+        columns = np.empty((len(self._shifts), img.shape[0]), dtype='uint16')
+        slit_extract(img, rows, ind_lr, left_weights, right_weights, columns)
+        return columns
+
+    def _lock(self):
+        """
+        Fit the slit polynomial on the mean of the frames received so far,
+        then extract the frames kept while waiting for it.
+
+        :return: True if the polynomial is locked
+        """
+        try:
+            myimg = np.array(self._sum/max(1, self._kept-1), dtype='uint16')
+            ih, iw = myimg.shape
+            y1, y2 = detect_bord(myimg, axis=1, offset=5, flag_disk=False)
+            MinX = np.argmin(myimg, axis=1)[y1+30:y2-30]
+            IndY = np.arange(y1+30, y2-30, 1)
+            p = np.polyfit(IndY, MinX, 2)
+        except Exception as e:
+            print('live reconstruction, slit polynomial not found :', e)
+            return False
+        self._poly = p
+        fit = slit_fit(p[0], p[1], p[2], ih, iw)
+        left_weights, right_weights, ind_l, ind_r = slit_indices(fit, self._shifts, ih, iw)
+        self._indices = (left_weights, right_weights, slit_gather(ind_l, ind_r), np.arange(ih))
+        for img in self._pending:
+            self._columns.append(None if img is None else self._extract(img))
+        self._pending = []
+        return True
+
+    def addFrame(self, frame):
+        """
+        Add the next recorded frame to the reconstruction.
+
+        :param frame: The frame, in the order it is written in the SER file
+        """
+        index = self._frame_count
+        self._frame_count += 1
+        if self._failed:
+            return
+        img = self._prepare(frame)
+        if index == 0:
+            # first frame is not used by solex_proc
+            self._sum = np.zeros(img.shape, dtype='uint64')
+            self._columns.append(None)
+            return
+        if np.mean(img) > 0:
+            self._sum += img
+            self._kept += 1
+        if self._poly is None:
+            self._pending.append(np.copy(img))
+            if len(self._pending) >= self._lock_frames and not self._lock():
+                self._lock_attempts += 1
+                if self._lock_attempts >= MAX_LOCK_ATTEMPTS or len(self._pending) >= MAX_PENDING_FRAMES:
+                    print('live reconstruction abandoned after', self._frame_count, 'frames')
+                    self._failed = True
+                    self._pending = []
+                else:
+                    # try again with more frames
+                    self._lock_frames = min(2*self._lock_frames, MAX_PENDING_FRAMES)
+            return
+        self._columns.append(self._extract(img))
+
+    def close(self):
+        """
+        Save the raw disks, the locked polynomial and the frame sum next to the SER file.
+
+        :return: Path of the saved file, or None if the slit polynomial could not be locked
+        """
+        if self._failed or (self._poly is None and not (self._kept > 1 and self._lock())):
+            return None
+        ih = self._sum.shape[0]
+        disk = np.zeros((len(self._shifts), ih, self._frame_count), dtype='uint16')
+        for FrameIndex, columns in enumerate(self._columns):
+            if columns is not None:
+                disk[:, :, FrameIndex] = columns
+        filename = os.path.join(os.path.dirname(self._serfile), LIVE_FILENAME)
+        np.savez(filename, disk=disk, shifts=np.array(self._shifts), poly=self._poly,
+                 sum=self._sum, kept=self._kept, frame_count=self._frame_count)
+        self._columns = []
+        return filename
+
+
+def load_live_recon(serfile, FrameCount):
+    """
+    Load the live reconstruction saved next to a SER file.
+
+    :param serfile: Path of the SER file
+    :param FrameCount: Number of frames of the SER file
+    :return: Dictionary with disk, shifts, poly, sum, kept, or None if there is no
+             live reconstruction for this number of frames
+    """
+    filename = os.path.join(os.path.dirname(serfile), LIVE_FILENAME)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as data:
+            live = {k: data[k] for k in data.files}
+    except Exception as e:
+        print('live reconstruction, cannot read', filename, e)
+        return None
+    if int(live['frame_count']) != FrameCount:
+        return None
+    live['shifts'] = [int(s) for s in live['shifts']]
+    return live
@@ -22,21 +22,16 @@ import shutil
 import zipfile
 import datetime
 import subprocess
-from typing import List
+import json
+from typing import List, Optional
 from hashlib import md5
 from fastapi.encoders import jsonable_encoder
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
-from astropy.io import fits
 
-import base64
 from fastapi import FastAPI, WebSocket, Request, File, UploadFile, HTTPException, WebSocketDisconnect, Header, Response, Body, BackgroundTasks, Query
 
 
-import asyncio
-import cv2
-import numpy as np
-
 import queue
 from locate_lines import locateLines
 
@@ -47,8 +42,10 @@ from storage import *
 from camera import *
 from power import factory_power_helper
 from camera_controller import CameraController
-
-from focus_analyzer import FocusAnalyzer
+from jobs import ScanJobQueue
+import config as cfg
+import preview_protocol
+from preview import PreviewProducer, DEFAULT_FPS, parse_roi
 
 from process import process_scan, get_fits_header
 from animate import *
@@ -81,6 +78,7 @@ class Scan(ScanBase):
     advanced: str = ''
     doppler_color: int 
     process_doppler: bool
+    products: Optional[List[str]] = None  # products to generate (surface, continuum, protus, doppler, helium), all if None
 
 class CameraControls(BaseModel):
     exp: float
@@ -467,6 +465,44 @@ async def toggleFocusAssistant(request: Request):
         app.cameraController.toggleFocusAssistant()
         return getCameraControls()
 
+@app.get("/camera/toggle-live-recon/", response_class=JSONResponse)
+async def toggleLiveRecon(request: Request):
+    """
+    Toggle live reconstruction while recording.
+    
+    When enabled, the raw solar disk is reconstructed from the frames as they
+    are recorded, so that processing a scan only runs the geometric
+    post-processing instead of reading the whole SER file again.
+    
+    Args:
+        request (Request): The incoming request object.
+    
+    Returns:
+        JSONResponse: Updated camera settings after toggling live reconstruction.
+    """
+    if app.cameraController:
+        app.cameraController.toggleLiveRecon()
+        return getCameraControls()
+
+@app.get("/camera/live-recon/shifts/", response_class=JSONResponse)
+async def setLiveShifts(request: Request, shifts: List[int] = Query([])):
+    """
+    Set the pixel shifts extracted by the live reconstruction.
+    
+    A scan can only use the live reconstruction if all the shifts it needs
+    (continuum, doppler, noise reduction neighbours) were extracted.
+    
+    Args:
+        request (Request): The incoming request object.
+        shifts (List[int]): Pixel shifts from the line center, 0 is always extracted.
+    
+    Returns:
+        JSONResponse: The shifts extracted by the live reconstruction.
+    """
+    if app.cameraController:
+        app.cameraController.setLiveShifts(shifts)
+        return JSONResponse(content=jsonable_encoder({"shifts": app.cameraController.getLiveShifts()}))
+
 @app.get("/camera/infos/", response_class=JSONResponse)
 async def infos(request: Request):
     """
@@ -603,6 +639,60 @@ async def decreaseGain(request: Request):
         scan_path = app.cameraController.stopRecord()
         return JSONResponse(content={"scan": os.path.dirname(scan_path)}, status_code=200)
 
+@app.get("/camera/record/stats/", response_class=JSONResponse)
+async def recordStats(request: Request):
+    """
+    Retrieve the SER writer counters of the current or last recording.
+    
+    This endpoint reports the queue depth, high-water mark and overruns of the
+    ring buffer between the capture thread and the SER writer thread. Overruns
+    mean frames were dropped because storage could not keep up.
+    
+    Args:
+        request (Request): The incoming request object.
+    
+    Returns:
+        JSONResponse: The SER writer counters.
+    """
+    if app.cameraController:
+        return JSONResponse(content=jsonable_encoder(app.cameraController.getRecordStats()))
+    else:
+        return JSONResponse(content=jsonable_encoder({}))
+
+@app.get("/camera/preview/stats/", response_class=JSONResponse)
+async def previewStats(request: Request):
+    """
+    Retrieve the live preview counters and the event loop latency.
+    
+    The preview is encoded in a dedicated thread. A low event loop latency
+    confirms the API stays responsive while the preview is streamed.
+    
+    Args:
+        request (Request): The incoming request object.
+    
+    Returns:
+        JSONResponse: The preview counters and the event loop latency.
+    """
+    return JSONResponse(content=jsonable_encoder(app.preview.getStats()))
+
+@app.get("/camera/telemetry/", response_class=JSONResponse)
+async def telemetry(request: Request):
+    """
+    Retrieve the live telemetry of the capture, the record, the SER writer and the preview.
+    
+    Reports the instantaneous and average fps, the histogram of the intervals
+    between frames, the detected frame gaps, the writer backlog and throughput.
+    The same data is streamed over /ws every second while recording, so that
+    gaps are seen before the scan is stopped.
+    
+    Args:
+        request (Request): The incoming request object.
+    
+    Returns:
+        JSONResponse: The telemetry counters.
+    """
+    return JSONResponse(content=jsonable_encoder(app.preview.getTelemetry()))
+
 @app.get("/camera/reset-controls/", response_class=JSONResponse)
 async def resetControls(request: Request):
     """
@@ -665,6 +755,28 @@ def notifyScanProcessCompleted(filename, status):
     print('add event to queue', filename, 'scan_process_'+md5(filename.encode()).hexdigest())
     app.q.put('scan_process_'+md5(filename.encode()).hexdigest()+';#;'+status) 
 
+def notifyScanJob(job):
+    """
+    Publish the state of a scan processing job.
+    
+    This function is called by the job queue each time a job is queued,
+    starts, reaches a new processing stage or ends. The event is sent to the
+    clients through the WebSocket queue; when the job ends the former
+    scan_process notification is sent as well.
+    
+    Args:
+        job (ScanJob): The job whose state changed.
+    """
+    app.q.put('scan_job;#;'+json.dumps(job.toDict()))
+    if job.status in ('completed', 'failed', 'cancelled'):
+        notifyScanProcessCompleted(job.scan.filename, job.status)
+
+def isRecording():
+    return app.cameraController is not None and app.cameraController.isRecording()
+
+# Scan processing jobs, only one at a time while recording
+app.jobs = ScanJobQueue(process_scan, notifyScanJob, max_workers=cfg.ScanJobWorkers, is_busy=isRecording)
+
 @app.post("/sunscan/scan/delete/", response_class=JSONResponse)
 async def deleteScan(scan:ScanBase, background_tasks: BackgroundTasks):
     """
@@ -746,24 +858,72 @@ async def getScanDetails(scan:ScanBase, request: Request):
     return JSONResponse(content=jsonable_encoder(scans))
 
 @app.post("/sunscan/scan/process/", response_class=JSONResponse)
-async def processScan(scan:Scan, background_tasks: BackgroundTasks):
+async def processScan(scan:Scan, priority: int = 0):
     """
-    Process a scan in the background.
+    Queue a scan for processing.
     
-    This endpoint initiates the processing of a scan. The actual processing
-    is done in a background task to avoid blocking the API. It handles
-    various processing options like autocropping and contrast adjustment.
+    This endpoint adds the processing of a scan to the job queue. Jobs run
+    in the background by priority, then in order of arrival, with a bounded
+    number of jobs at the same time. It handles various processing options
+    like autocropping and contrast adjustment.
     
     Args:
         scan (Scan): A model containing scan processing parameters.
-        background_tasks (BackgroundTasks): FastAPI's background tasks handler.
+        priority (int): Jobs with the highest priority run first. Defaults to 0.
     
     Returns:
-        None: The processing is done in the background, so no immediate return.
+        JSONResponse: The queued job.
     """
     if (os.path.exists(scan.filename)):
         print(scan)
-        background_tasks.add_task(process_scan,callback=notifyScanProcessCompleted, scan=scan)
+        job = app.jobs.submit(scan, priority)
+        return JSONResponse(content=jsonable_encoder(job.toDict()))
+
+@app.get("/sunscan/jobs/", response_class=JSONResponse)
+async def listJobs():
+    """
+    List the scan processing jobs.
+    
+    Returns:
+        JSONResponse: The queued, running and recently finished jobs.
+    """
+    return JSONResponse(content=jsonable_encoder(app.jobs.list()))
+
+@app.post("/sunscan/jobs/{job_id}/cancel/", response_class=JSONResponse)
+async def cancelJob(job_id: int):
+    """
+    Cancel a scan processing job.
+    
+    A queued job is removed from the queue, a running job stops at its
+    next processing stage.
+    
+    Args:
+        job_id (int): The job identifier.
+    
+    Returns:
+        JSONResponse: The cancelled job.
+    """
+    job = app.jobs.cancel(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or already finished")
+    return JSONResponse(content=jsonable_encoder(job.toDict()))
+
+@app.post("/sunscan/jobs/{job_id}/priority/", response_class=JSONResponse)
+async def setJobPriority(job_id: int, priority: int):
+    """
+    Change the priority of a queued scan processing job.
+    
+    Args:
+        job_id (int): The job identifier.
+        priority (int): The new priority, the highest runs first.
+    
+    Returns:
+        JSONResponse: The updated job.
+    """
+    job = app.jobs.setPriority(job_id, priority)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found or not queued")
+    return JSONResponse(content=jsonable_encoder(job.toDict()))
 
 
 @app.post("/sunscan/process/stack/")
@@ -922,17 +1082,7 @@ async def create_tag_file(request: FileTagRequest):
     return {"message": f"File '{tag_filename}' created successfully."}
 
 
-def calculate_fwhm(y):
-    x = np.arange(len(y))
-    max_value = np.max(y)
-    half_max = max_value / 2.0
-    indices = np.where(y >= half_max)[0]
-    if len(indices) < 2:
-        return None
-    left_idx = indices[0]
-    right_idx = indices[-1]
-    fwhm = x[right_idx] - x[left_idx]
-    return fwhm
+app.preview = PreviewProducer(app)
 
 @app.websocket("/ws")
 async def websocket_endpoint(websocket: WebSocket):
@@ -940,110 +1090,58 @@ async def websocket_endpoint(websocket: WebSocket):
     WebSocket endpoint for real-time communication.
     
     This endpoint handles WebSocket connections for real-time data streaming.
-    It continuously sends camera frames, ADU values, and other real-time data
-    to connected clients. It also handles notifications from the queue.
+    It sends camera frames, ADU values, and other real-time data to connected
+    clients, and forwards the notifications of the queue to all of them.
     
     Args:
         websocket (WebSocket): The WebSocket connection object.
     
-    The function runs in an infinite loop, continuously sending data until
-    the WebSocket connection is closed.
+    The previews are built once by the shared preview producer and published
+    to every client. A slow client only skips previews, it never slows down
+    the other clients or the capture.
+    
+    Clients connecting with /ws?protocol=2 receive the preview and profiles
+    as binary messages (see preview_protocol), others the text protocol.
+    The maximum preview rate can be set with /ws?fps=N, and the client screen
+    size with /ws?width=W&height=H. The preview quality, size and rate are
+    then adapted to the time spent sending the previews to the client.
+    
+    While tuning the slit or line position, a client may only receive a region
+    of the frame with /ws?roi=x,y,w,h, decimated profiles with /ws?decimate=N,
+    or no profiles with /ws?profiles=0.
     """
     await websocket.accept()
+    binary = websocket.query_params.get('protocol') == str(preview_protocol.PROTOCOL_VERSION)
+
+    def query_number(name, default):
+        try:
+            return float(websocket.query_params.get(name, default))
+        except (TypeError, ValueError):
+            return default
+
+    fps = query_number('fps', DEFAULT_FPS)
+    viewport = (query_number('width', None), query_number('height', None))
+    roi = parse_roi(websocket.query_params.get('roi'))
+    decimation = query_number('decimate', 1)
+    profiles = websocket.query_params.get('profiles') != '0'
 
     print("Socket is running...")
+    subscriber = app.preview.subscribe(binary, fps, viewport, roi, decimation, profiles)
     try:
-        focus_analyzer = FocusAnalyzer(measure_every=5)
-        # Infinite loop to handle continuous data streaming
         while True:
-            # Check for notifications in the queue
-            if not app.q.empty(): 
-                print('q')
-                await websocket.send_text(app.q.get()) 
-                
-            # Handle camera frame streaming if camera is connected
-            if app.cameraController and app.cameraController.getStatus() == 'connected':
-                frame = app.cameraController.getLastFrame() 
-    
-                if len(frame):
-                    r = frame / 256
-                    edges = None
-                    if not app.cameraController.isRecording():
-                        #if not app.cameraController.cameraIsCropped() :
-                        #    r = locateLines(r)
-                        
-                        # Handle snapshot capture if requested
-                        if app.takeSnapShot and app.snapshot_filename and app.snapshot_header:
-                            d = time.strftime("%Y_%m_%d")
-                            cv2.imwrite(app.snapshot_filename+'.png',frame) 
-
-                            app.snapshot_header['WIDTH']=frame.shape[1]
-                            app.snapshot_header['HEIGHT']=frame.shape[0]
-
-                            DiskHDU=fits.PrimaryHDU(frame,app.snapshot_header)
-                            DiskHDU.writeto(app.snapshot_filename+'.fits', overwrite='True')
-
-                            app.snapShotCount += 1
-                            app.takeSnapShot = False
-                            app.snapshot_header = None
-
-                        # Resize image for streaming
-                        scale_percent = 90 if app.cameraController.isInColorMode() else 70
-                        width = int(frame.shape[1] * scale_percent / 100)
-                        height = int(frame.shape[0] * scale_percent / 100)
-                        r = cv2.resize(r, (width, height))
-                    
-                        # Get and send ADU values
-                        max_adu = app.cameraController.getMaxADU()
-                        await websocket.send_text('adu;#;'+str(max_adu[0])+';#;'+str(max_adu[1])+';#;'+str(max_adu[2])) 
-
-                        # Send intensity and spectrum data for cropped imagess
-                        if len(frame.shape) == 2 and app.cameraController.cameraIsCropped() :
-                            await websocket.send_text('intensity;#;'+','.join([str(int(p)) for p in frame[0,500:1500]]))  
-                            await websocket.send_text('spectrum;#;'+str(calculate_fwhm(frame[:,1014]))+';#;'+','.join([str(int(p)) for p in frame[:,1014]])) 
-
-                        # Send focus analyzer data
-                        edges = None
-                        if app.cameraController.focusAssistantIsOn() and not app.cameraController.isInColorMode():
-                            # Update focus measurement
-                            sharpness, edges = focus_analyzer.update(frame)
-                            await websocket.send_text('focus;#;'+str(sharpness)+';#;'+str(0)+';#;'+str(edges[0])+';#;'+str(edges[1]))
-                    
-                    # Apply normalization if enabled
-                    if app.cameraController.normalizeMode()==1:    
-                        r = cv2.normalize(r, dst=None, alpha=0, beta=256, norm_type=cv2.NORM_MINMAX)
-                    else:
-                        max_threshold = app.cameraController.getMaxVisuThreshold()
-                        r = (r * 256) / max_threshold
-
-                    # Rescale edges if they exist
-                    if edges:
-
-                        # Compute resize ratios
-                        scale_x = r.shape[1] / frame.shape[1]   # width ratio
-                        scale_y = r.shape[0] / frame.shape[0]   # height ratio, usually 1D profile so can ignore
-
-                        edges_scaled = (
-                            int(edges[0] * scale_x - 10) if edges[0] is not None else None,
-                            int(edges[1] * scale_x + 10) if edges[1] is not None else None
-                        )
-                        r = FocusAnalyzer.overlay_edges(r.copy(), edges_scaled)
-                    
-                    # Encode and send the frame
-                    byte_im = cv2.imencode('.jpg', r)[1].tobytes()
-                    file_64encoded = str(base64.b64encode(byte_im)  ).split('b\'')
-                    bytes_to_sent = (file_64encoded[1])[:-1]
-
-                    await websocket.send_text('camera;#;0;#;0;#;data:image/jpg;base64,'+bytes_to_sent )
-                   
-            # Adjust sleep time based on recording status
-            if app.cameraController and app.cameraController.isRecording():
-                await asyncio.sleep(0.5)
-            else:
-                await asyncio.sleep(0.25)
+            messages = await subscriber.get()
+            t0 = time.monotonic()
+            for message in messages:
+                if isinstance(message, bytes):
+                    await websocket.send_bytes(message)
+                else:
+                    await websocket.send_text(message)
+            subscriber.sent(time.monotonic() - t0)
 
     except WebSocketDisconnect:
         print('Socket close.')
+    finally:
+        app.preview.unsubscribe(subscriber)
 
 
 
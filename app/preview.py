@@ -0,0 +1,636 @@
+"""
+Shared camera preview producer for the /ws WebSocket clients.
+
+A single asyncio task builds the preview of each camera frame once (resize,
+normalization, JPEG encoding, profiles, focus analysis) and publishes it to
+every connected client. Each client has a small bounded buffer of previews
+that drops the oldest entry, so a slow client only loses previews and never
+slows down the other clients or the capture thread. Notifications from the
+application queue are delivered to every client.
+
+The producer waits for the camera frame sequence number to change, so each
+new frame is encoded at most once and an unchanged frame is never encoded
+again. The encoding rate is the highest rate requested by the clients
+(/ws?fps=N), each client receiving previews at its own rate.
+
+The previews are built and encoded in a dedicated thread, the event loop only
+awaits the finished messages, so the HTTP API stays responsive during live
+view. The event loop latency is measured and reported with the preview stats.
+
+Each client has an adaptive quality controller. The time spent sending the
+previews to the client and the previews it dropped lower its JPEG quality,
+its resolution, then its preview rate, which are raised again when the link
+keeps up. A client may also declare its viewport (/ws?width=W&height=H) so
+that the preview is never larger than its screen. The JPEG images are encoded
+once for each distinct size and quality used by the clients.
+
+A client tuning the slit or the line position may ask for a region of interest
+of the frame (/ws?roi=x,y,w,h), only this region is then extracted, encoded
+and sent. The intensity and spectrum profiles may be decimated
+(/ws?decimate=N) or not sent at all (/ws?profiles=0).
+
+While recording, the capture, preview and SER writer telemetry is sent to the
+clients every second as a 'telemetry' text message.
+"""
+
+import asyncio
+import base64
+import json
+import queue
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+from astropy.io import fits
+
+import preview_protocol
+from focus_analyzer import FocusAnalyzer
+
+DEFAULT_FPS = 4  # previews per second sent to a client
+MAX_FPS = 15
+RECORD_FPS = 2  # previews per second while recording, to spare the CPU for the capture
+FRAME_WAIT = 0.25  # maximum waiting time for a new frame, notifications are sent meanwhile
+LATENCY_INTERVAL = 0.1  # event loop latency sampling period
+TELEMETRY_INTERVAL = 1.0  # period of the telemetry messages while recording
+MIN_FPS = 0.5  # lowest preview rate of a slow client
+
+# Quality levels from the best to the lightest : resolution factor, JPEG quality
+QUALITY_LEVELS = [(1.0, 95), (1.0, 80), (0.75, 75), (0.5, 70), (0.35, 60)]
+SEND_SLOW = 0.5  # send time, as a fraction of the preview interval, above which the quality is lowered
+SEND_FAST = 0.2  # send time, as a fraction of the preview interval, below which the quality is raised
+RAISE_AFTER = 10  # number of fast sends before raising the quality
+SIZE_STEP = 16  # preview widths are rounded to share encodings between clients
+
+
+def parse_roi(value):
+    """
+    Parse a region of interest.
+
+    :param value: String "x,y,width,height" in frame pixels
+    :return: Tuple (x, y, width, height), or None if the string is not valid
+    """
+    try:
+        roi = tuple(int(v) for v in value.split(','))
+    except (AttributeError, ValueError):
+        return None
+    if len(roi) != 4 or roi[0] < 0 or roi[1] < 0 or roi[2] <= 0 or roi[3] <= 0:
+        return None
+    return roi
+
+
+def decimate(profile, factor):
+    """
+    Decimate a profile, each value being the mean of factor consecutive values.
+
+    :param profile: 1D array
+    :param factor: Decimation factor
+    :return: The decimated profile
+    """
+    if factor <= 1:
+        return profile
+    n = len(profile) // factor * factor
+    return profile[:n].reshape(-1, factor).mean(axis=1)
+
+
+def calculate_fwhm(y):
+    x = np.arange(len(y))
+    max_value = np.max(y)
+    half_max = max_value / 2.0
+    indices = np.where(y >= half_max)[0]
+    if len(indices) < 2:
+        return None
+    left_idx = indices[0]
+    right_idx = indices[-1]
+    fwhm = x[right_idx] - x[left_idx]
+    return fwhm
+
+
+class Preview:
+    """
+    The preview of one camera frame, encoded once and formatted for each protocol on demand.
+    """
+
+    def __init__(self):
+        self.jpegs = {}
+        self.adu = None
+        self.intensity = None
+        self.spectrum = None
+        self.focus = None
+        self._messages = {}
+        self._images = {}
+
+    def messages(self, binary, key, decimation=1, profiles=True):
+        """
+        Get the messages to send for this preview, built once per protocol and image.
+
+        :param binary: True for the binary protocol, False for the text protocol
+        :param key: Image (roi, width, height, quality) sent to the client
+        :param decimation: Decimation factor of the profiles
+        :param profiles: False to leave out the intensity and spectrum profiles
+        :return: List of bytes (binary) or str (text) messages
+        """
+        options = (binary, decimation if profiles else 0)
+        if options not in self._messages:
+            self._messages[options] = self._binaryMessages(*options[1:]) if binary else self._textMessages(*options[1:])
+        if (binary, key) not in self._images:
+            jpeg = self.jpegs.get(key)
+            roi = key[0] if key else None
+            if jpeg is None:
+                self._images[(binary, key)] = []
+            elif binary and roi:
+                self._images[(binary, key)] = [preview_protocol.pack_roi(roi, jpeg)]
+            elif binary:
+                self._images[(binary, key)] = [preview_protocol.pack_camera(jpeg)]
+            else:
+                x, y = roi[:2] if roi else (0, 0)
+                self._images[(binary, key)] = ['camera;#;'+str(x)+';#;'+str(y)+';#;data:image/jpg;base64,'+base64.b64encode(jpeg).decode('ascii')]
+        return self._messages[options] + self._images[(binary, key)]
+
+    def _binaryMessages(self, decimation):
+        m = []
+        if self.adu is not None:
+            m.append(preview_protocol.pack_adu(self.adu))
+        if self.intensity is not None and decimation:
+            m.append(preview_protocol.pack_intensity(decimate(self.intensity, decimation), decimation))
+        if self.spectrum is not None and decimation:
+            fwhm, profile = self.spectrum
+            m.append(preview_protocol.pack_spectrum(fwhm, decimate(profile, decimation), decimation))
+        if self.focus is not None:
+            m.append(preview_protocol.pack_focus(*self.focus))
+        return m
+
+    def _textMessages(self, decimation):
+        m = []
+        if self.adu is not None:
+            m.append('adu;#;'+str(self.adu[0])+';#;'+str(self.adu[1])+';#;'+str(self.adu[2]))
+        if self.intensity is not None and decimation:
+            m.append('intensity;#;'+','.join([str(int(p)) for p in decimate(self.intensity, decimation)]))
+        if self.spectrum is not None and decimation:
+            fwhm, profile = self.spectrum
+            m.append('spectrum;#;'+str(fwhm)+';#;'+','.join([str(int(p)) for p in decimate(profile, decimation)]))
+        if self.focus is not None:
+            sharpness, edges = self.focus
+            m.append('focus;#;'+str(sharpness)+';#;'+str(0)+';#;'+str(edges[0])+';#;'+str(edges[1]))
+        return m
+
+
+class AdaptiveQuality:
+    """
+    Adjust the preview quality and rate of a client to its link.
+    """
+
+    def __init__(self, fps):
+        """
+        :param fps: Maximum preview rate requested by the client
+        """
+        self.level = 0
+        self.fps = fps
+        self.max_fps = fps
+        self._send_time = None
+        self._fast = 0
+
+    def update(self, send_time, dropped):
+        """
+        Update the quality after a preview was sent.
+
+        :param send_time: Time spent sending the preview, in seconds
+        :param dropped: True if previews were dropped because the client was too slow
+        """
+        if self._send_time is None:
+            self._send_time = send_time
+        else:
+            self._send_time = 0.7 * self._send_time + 0.3 * send_time
+        interval = 1.0 / self.fps
+        if dropped or self._send_time > SEND_SLOW * interval:
+            self._fast = 0
+            self._send_time = None
+            if self.level < len(QUALITY_LEVELS) - 1:
+                self.level += 1
+            else:
+                self.fps = max(MIN_FPS, self.fps / 2)
+        elif self._send_time < SEND_FAST * interval:
+            self._fast += 1
+            if self._fast >= RAISE_AFTER:
+                self._fast = 0
+                if self.fps < self.max_fps:
+                    self.fps = min(self.max_fps, self.fps * 2)
+                elif self.level > 0:
+                    self.level -= 1
+        else:
+            self._fast = 0
+
+
+class PreviewSubscriber:
+    """
+    The pending previews and notifications of one WebSocket client.
+    """
+
+    def __init__(self, binary, fps=DEFAULT_FPS, viewport=None, roi=None, decimation=1, profiles=True, max_previews=2):
+        """
+        :param binary: True if the client uses the binary protocol
+        :param fps: Maximum number of previews per second sent to the client
+        :param viewport: Size (width, height) of the client screen in pixels, None values if unknown
+        :param roi: Region (x, y, width, height) of the frame sent to the client, None for the whole frame
+        :param decimation: Decimation factor of the profiles
+        :param profiles: False if the client does not use the intensity and spectrum profiles
+        :param max_previews: Number of previews kept for the client, older ones are dropped
+        """
+        self.binary = binary
+        self.roi = roi
+        self.decimation = max(1, int(decimation))
+        self.profiles = profiles
+        self.quality = AdaptiveQuality(min(max(fps, 0.1), MAX_FPS))
+        self.viewport = viewport or (None, None)
+        self.key = None
+        self.dropped = 0
+        self._dropped = False
+        self._sending = False
+        self._last_preview = 0
+        self._previews = deque(maxlen=max_previews)
+        self._notifications = deque()
+        self._ready = asyncio.Event()
+
+    @property
+    def fps(self):
+        return self.quality.fps
+
+    def target(self, frame_width, frame_height, width, height):
+        """
+        Get the preview image sent to the client.
+
+        :param frame_width: Width of the camera frame
+        :param frame_height: Height of the camera frame
+        :param width: Width of the full quality preview of the whole frame
+        :param height: Height of the full quality preview of the whole frame
+        :return: Image key (roi, width, height, quality), roi being None for the whole frame
+        """
+        roi = None
+        if self.roi:
+            # Region clipped to the frame, at the scale of the full quality preview
+            x, y = min(self.roi[0], frame_width-1), min(self.roi[1], frame_height-1)
+            w, h = min(self.roi[2], frame_width-x), min(self.roi[3], frame_height-y)
+            if (w, h) != (frame_width, frame_height):
+                roi = (x, y, w, h)
+                width = max(1, round(w * width / frame_width))
+                height = max(1, round(h * height / frame_height))
+        return (roi,) + self._size(width, height)
+
+    def _size(self, width, height):
+        """
+        Get the preview size and quality for the current quality level and the viewport.
+
+        :param width: Width of the full quality preview
+        :param height: Height of the full quality preview
+        :return: Tuple (width, height, quality)
+        """
+        scale, jpeg_quality = QUALITY_LEVELS[self.quality.level]
+        w = width * scale
+        viewport_width, viewport_height = self.viewport
+        if viewport_width:
+            w = min(w, viewport_width)
+        if viewport_height:
+            w = min(w, viewport_height * width / height)
+        w = int(w) // SIZE_STEP * SIZE_STEP
+        if w <= 0 or w >= width:
+            return (width, height, jpeg_quality)
+        return (w, max(1, round(w * height / width)), jpeg_quality)
+
+    def putPreview(self, preview, key, now):
+        # small tolerance, so that the frame rate jitter does not halve the preview rate
+        if now - self._last_preview < 0.9 / self.fps:
+            return
+        self._last_preview = now
+        if len(self._previews) == self._previews.maxlen:
+            self.dropped += 1
+            self._dropped = True
+        self._previews.append((preview, key))
+        self._ready.set()
+
+    def sent(self, send_time):
+        """
+        Report the time spent sending the last messages, to adapt the preview quality.
+
+        :param send_time: Time in seconds
+        """
+        if self._sending:
+            self.quality.update(send_time, self._dropped)
+            self._dropped = False
+
+    def putNotification(self, message):
+        self._notifications.append(message)
+        self._ready.set()
+
+    async def get(self):
+        """
+        Wait for the next messages to send to the client.
+
+        :return: List of messages, notifications first
+        """
+        await self._ready.wait()
+        self._ready.clear()
+        messages = list(self._notifications)
+        self._notifications.clear()
+        self._sending = bool(self._previews)
+        while self._previews:
+            preview, key = self._previews.popleft()
+            messages.extend(preview.messages(self.binary, key, self.decimation, self.profiles))
+        return messages
+
+
+class LoopLatencyMonitor:
+    """
+    Measure the event loop latency, the delay between the time a sleeping task
+    should wake up and the time it actually runs.
+    """
+
+    def __init__(self, interval=LATENCY_INTERVAL, window=100):
+        """
+        :param interval: Sampling period in seconds
+        :param window: Number of samples of the mean latency
+        """
+        self._interval = interval
+        self._samples = deque(maxlen=window)
+        self._max = 0
+        self._task = None
+
+    def start(self):
+        """
+        Start the measure in the running event loop, if not started yet.
+        """
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        while True:
+            t0 = time.monotonic()
+            await asyncio.sleep(self._interval)
+            latency = max(0, time.monotonic() - t0 - self._interval)
+            self._samples.append(latency)
+            self._max = max(self._max, latency)
+
+    def getStats(self):
+        """
+        Get the event loop latency in milliseconds.
+
+        :return: Dictionary with the last, mean and max latency
+        """
+        if not self._samples:
+            return {'last_ms': None, 'mean_ms': None, 'max_ms': None}
+        return {'last_ms': self._samples[-1]*1000,
+                'mean_ms': sum(self._samples)/len(self._samples)*1000,
+                'max_ms': self._max*1000}
+
+
+class PreviewProducer:
+    """
+    Build the camera previews once and fan them out to all the WebSocket clients.
+    """
+
+    def __init__(self, app):
+        """
+        :param app: The FastAPI application, holding the camera controller,
+                    the notification queue and the snapshot request
+        """
+        self._app = app
+        self._subscribers = set()
+        self._task = None
+        self._focus_analyzer = FocusAnalyzer(measure_every=5)
+        # a single thread builds the previews, FocusAnalyzer keeps its state between frames
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='preview')
+        self._latency = LoopLatencyMonitor()
+        self._encoded = 0
+        self._encode_time = 0
+
+    def subscribe(self, binary, fps=DEFAULT_FPS, viewport=None, roi=None, decimation=1, profiles=True):
+        """
+        Register a client and start the producer if needed.
+
+        :param binary: True if the client uses the binary protocol
+        :param fps: Maximum number of previews per second sent to the client
+        :param viewport: Size (width, height) of the client screen in pixels, None values if unknown
+        :param roi: Region (x, y, width, height) of the frame sent to the client, None for the whole frame
+        :param decimation: Decimation factor of the profiles
+        :param profiles: False if the client does not use the intensity and spectrum profiles
+        :return: The subscriber to read messages from
+        """
+        subscriber = PreviewSubscriber(binary, fps, viewport, roi, decimation, profiles)
+        self._subscribers.add(subscriber)
+        self._latency.start()
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self._subscribers.discard(subscriber)
+
+    def getStats(self):
+        """
+        Get the preview counters and the event loop latency.
+
+        :return: Dictionary with the number of encoded previews, the last encoding
+                 time, the clients rates and dropped previews, and the loop latency
+        """
+        return {'encoded': self._encoded,
+                'encode_ms': self._encode_time*1000,
+                'clients': [{'binary': s.binary, 'fps': s.fps, 'max_fps': s.quality.max_fps,
+                             'level': s.quality.level, 'image': s.key, 'dropped': s.dropped}
+                            for s in list(self._subscribers)],
+                'loop_latency': self._latency.getStats()}
+
+    def getTelemetry(self):
+        """
+        Get the capture, record and SER writer counters of the camera with the preview counters.
+
+        :return: Dictionary with 'capture', 'record', 'writer' and 'preview' counters
+        """
+        cameraController = self._app.cameraController
+        telemetry = cameraController.getTelemetry() if cameraController else {}
+        telemetry['preview'] = self.getStats()
+        return telemetry
+
+    def _publishTelemetry(self):
+        message = 'telemetry;#;' + json.dumps(self.getTelemetry())
+        for subscriber in list(self._subscribers):
+            subscriber.putNotification(message)
+
+    async def _run(self):
+        """
+        Producer task, runs while there are clients.
+        """
+        loop = asyncio.get_running_loop()
+        camera = None
+        seq = None
+        last = 0
+        last_telemetry = 0
+        while self._subscribers:
+            self._publishNotifications()
+
+            cameraController = self._app.cameraController
+            if cameraController and cameraController.isRecording() and time.monotonic() - last_telemetry >= TELEMETRY_INTERVAL:
+                last_telemetry = time.monotonic()
+                self._publishTelemetry()
+
+            cameraController = self._app.cameraController
+            if not (cameraController and cameraController.getStatus() == 'connected'):
+                await asyncio.sleep(FRAME_WAIT)
+                continue
+            if cameraController is not camera:
+                # sequence numbers restart with a new camera controller
+                camera = cameraController
+                seq = None
+
+            # Limit the encoding rate to the fastest client, and while recording
+            fps = max(subscriber.fps for subscriber in self._subscribers)
+            if cameraController.isRecording():
+                fps = min(fps, RECORD_FPS)
+            delay = last + 1.0 / fps - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+            # Wait for a frame not encoded yet
+            new_seq, frame = await loop.run_in_executor(self._executor, cameraController.waitFrame, seq, FRAME_WAIT)
+            if new_seq == seq:
+                continue
+            seq = new_seq
+            last = time.monotonic()
+
+            subscribers = list(self._subscribers)
+            preview = await loop.run_in_executor(self._executor, self._encode, cameraController, frame, subscribers)
+            if preview is not None:
+                for subscriber in subscribers:
+                    if subscriber in self._subscribers:
+                        subscriber.putPreview(preview, subscriber.key, last)
+
+    def _publishNotifications(self):
+        while True:
+            try:
+                message = self._app.q.get_nowait()
+            except queue.Empty:
+                return
+            for subscriber in list(self._subscribers):
+                subscriber.putNotification(message)
+
+    def _saveSnapshot(self, frame):
+        """
+        Save the frame as PNG and FITS if a snapshot was requested.
+
+        :param frame: The camera frame
+        """
+        app = self._app
+        if app.takeSnapShot and app.snapshot_filename and app.snapshot_header:
+            cv2.imwrite(app.snapshot_filename+'.png',frame)
+
+            app.snapshot_header['WIDTH']=frame.shape[1]
+            app.snapshot_header['HEIGHT']=frame.shape[0]
+
+            DiskHDU=fits.PrimaryHDU(frame,app.snapshot_header)
+            DiskHDU.writeto(app.snapshot_filename+'.fits', overwrite='True')
+
+            app.snapShotCount += 1
+            app.takeSnapShot = False
+            app.snapshot_header = None
+
+    def _encode(self, cameraController, frame, subscribers):
+        """
+        Build a preview and its messages, run in the preview thread.
+
+        :param cameraController: The camera controller
+        :param frame: The camera frame
+        :param subscribers: The clients to build the preview for
+        :return: The preview, or None if there is no frame
+        """
+        t0 = time.perf_counter()
+        preview = self._build(cameraController, frame, subscribers)
+        if preview is not None:
+            for subscriber in subscribers:
+                preview.messages(subscriber.binary, subscriber.key, subscriber.decimation, subscriber.profiles)
+            self._encoded += 1
+        self._encode_time = time.perf_counter() - t0
+        return preview
+
+    def _build(self, cameraController, frame, subscribers):
+        """
+        Build the preview of a camera frame.
+
+        :param cameraController: The camera controller
+        :param frame: The camera frame
+        :param subscribers: The clients to build the preview for, their image key is updated
+        :return: The preview, or None if there is no frame
+        """
+        if frame is None or not len(frame):
+            return None
+
+        preview = Preview()
+        edges = None
+        # Full quality preview size, the frame is not resized while recording
+        width, height = frame.shape[1], frame.shape[0]
+        if not cameraController.isRecording():
+            # Handle snapshot capture if requested
+            self._saveSnapshot(frame)
+
+            # Resize image for streaming
+            scale_percent = 90 if cameraController.isInColorMode() else 70
+            width = int(frame.shape[1] * scale_percent / 100)
+            height = int(frame.shape[0] * scale_percent / 100)
+
+            preview.adu = cameraController.getMaxADU()
+
+            # Intensity and spectrum data for cropped images
+            if len(frame.shape) == 2 and cameraController.cameraIsCropped() and any(s.profiles for s in subscribers):
+                preview.intensity = frame[0,500:1500]
+                preview.spectrum = (calculate_fwhm(frame[:,1014]), frame[:,1014])
+
+            # Focus analyzer data
+            if cameraController.focusAssistantIsOn() and not cameraController.isInColorMode():
+                sharpness, edges = self._focus_analyzer.update(frame)
+                preview.focus = (sharpness, edges)
+
+        # One JPEG image for each size and quality used by the clients
+        for subscriber in subscribers:
+            subscriber.key = subscriber.target(frame.shape[1], frame.shape[0], width, height)
+            if subscriber.key not in preview.jpegs:
+                preview.jpegs[subscriber.key] = self._render(cameraController, frame, edges, subscriber.key)
+        return preview
+
+    def _render(self, cameraController, frame, edges, key):
+        """
+        Resize, normalize and encode a frame.
+
+        :param cameraController: The camera controller
+        :param frame: The camera frame
+        :param edges: Spectrum edges found by the focus analyzer, or None
+        :param key: Image (roi, width, height, quality)
+        :return: The JPEG bytes
+        """
+        roi, width, height, jpeg_quality = key
+        r = frame
+        x0 = 0
+        if roi:
+            # Only the region of interest is resized and encoded
+            x0, y0, w, h = roi
+            r = frame[y0:y0+h, x0:x0+w]
+        if (width, height) != (r.shape[1], r.shape[0]):
+            r = cv2.resize(r, (width, height))
+        r = r / 256
+
+        # Apply normalization if enabled
+        if cameraController.normalizeMode()==1:
+            r = cv2.normalize(r, dst=None, alpha=0, beta=256, norm_type=cv2.NORM_MINMAX)
+        else:
+            max_threshold = cameraController.getMaxVisuThreshold()
+            r = (r * 256) / max_threshold
+
+        # Rescale edges if they exist
+        if edges:
+            # Compute resize ratios
+            scale_x = width / (roi[2] if roi else frame.shape[1])   # width ratio
+
+            edges_scaled = (
+                int((edges[0] - x0) * scale_x - 10) if edges[0] is not None else None,
+                int((edges[1] - x0) * scale_x + 10) if edges[1] is not None else None
+            )
+            r = FocusAnalyzer.overlay_edges(r.copy(), edges_scaled)
+
+        return cv2.imencode('.jpg', r, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])[1].tobytes()
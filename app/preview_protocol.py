@@ -0,0 +1,119 @@
+"""
+Binary preview protocol of the /ws WebSocket.
+
+A client opting in with /ws?protocol=2 receives the camera preview and the
+live profiles as binary messages instead of base64 text. Notifications
+(scan_process, scan_job...) are still sent as text messages.
+
+Each binary message is an 8 bytes little endian header followed by a payload:
+
+    uint8   version   PROTOCOL_VERSION
+    uint8   type      one of the MSG_* values
+    uint16  flags     profile decimation factor for MSG_INTENSITY and MSG_SPECTRUM, 0 otherwise
+    uint32  length    payload length in bytes
+
+Payloads:
+
+    MSG_CAMERA     JPEG image bytes
+    MSG_ADU        3 float32 : max ADU of red, green, blue channels
+    MSG_INTENSITY  uint16 array : intensity profile along the spectrum
+    MSG_SPECTRUM   float32 FWHM (NaN if unknown) then uint16 array : spectrum profile
+    MSG_FOCUS      float32 sharpness, int32 left edge, int32 right edge (-1 if unknown)
+    MSG_ROI        4 uint16 : x, y, width, height of the region in frame pixels, then JPEG image bytes
+
+Profiles may be decimated: each value is then the mean of `flags` consecutive
+pixels of the frame, the FWHM being measured on the full resolution profile.
+"""
+
+import struct
+import numpy as np
+
+PROTOCOL_VERSION = 2
+
+MSG_CAMERA = 1
+MSG_ADU = 2
+MSG_INTENSITY = 3
+MSG_SPECTRUM = 4
+MSG_FOCUS = 5
+MSG_ROI = 6
+
+_HEADER = struct.Struct('<BBHI')
+
+
+def pack(msg_type, payload, flags=0):
+    """
+    Build a binary message.
+
+    :param msg_type: One of the MSG_* values
+    :param payload: Payload bytes
+    :param flags: Message flags
+    :return: Header and payload bytes
+    """
+    return _HEADER.pack(PROTOCOL_VERSION, msg_type, flags, len(payload)) + payload
+
+
+def pack_camera(jpeg_bytes):
+    """
+    Build a camera preview message.
+
+    :param jpeg_bytes: The JPEG encoded preview
+    :return: Message bytes
+    """
+    return pack(MSG_CAMERA, jpeg_bytes)
+
+
+def pack_roi(roi, jpeg_bytes):
+    """
+    Build a region of interest preview message.
+
+    :param roi: Region (x, y, width, height) in frame pixels
+    :param jpeg_bytes: The JPEG encoded region
+    :return: Message bytes
+    """
+    return pack(MSG_ROI, struct.pack('<4H', *roi) + jpeg_bytes)
+
+
+def pack_adu(max_adu):
+    """
+    Build a max ADU message.
+
+    :param max_adu: Max ADU of red, green and blue channels
+    :return: Message bytes
+    """
+    return pack(MSG_ADU, struct.pack('<3f', *[float(v) for v in max_adu[:3]]))
+
+
+def pack_intensity(profile, decimation=1):
+    """
+    Build an intensity profile message.
+
+    :param profile: 1D array of intensities
+    :param decimation: Decimation factor of the profile
+    :return: Message bytes
+    """
+    return pack(MSG_INTENSITY, np.asarray(profile, dtype='<u2').tobytes(), decimation)
+
+
+def pack_spectrum(fwhm, profile, decimation=1):
+    """
+    Build a spectrum profile message.
+
+    :param fwhm: Full width at half maximum of the profile, or None
+    :param profile: 1D array of intensities
+    :param decimation: Decimation factor of the profile
+    :return: Message bytes
+    """
+    fwhm = float('nan') if fwhm is None else float(fwhm)
+    return pack(MSG_SPECTRUM, struct.pack('<f', fwhm) + np.asarray(profile, dtype='<u2').tobytes(), decimation)
+
+
+def pack_focus(sharpness, edges):
+    """
+    Build a focus assistant message.
+
+    :param sharpness: Sharpness measure
+    :param edges: Left and right edges of the spectrum, or None values
+    :return: Message bytes
+    """
+    left, right = [-1 if e is None else int(e) for e in edges[:2]]
+    return pack(MSG_FOCUS, struct.pack('<fii', float(sharpness), left, right))
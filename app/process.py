@@ -1,6 +1,8 @@
 import os
 import cv2
 import json
+import time
+import hashlib
 import datetime
 import numpy as np
 from astropy.io import fits
@@ -10,14 +12,161 @@ from PIL import Image, ImageDraw, ImageFont, ImageChops
 from datetime import datetime
 from helium import process_helium, create_circular_mask, blend_images
 from mapping import create_solar_planisphere
+import scan_cache
 
-def process_scan(callback, scan):
+# Fingerprints of the products already generated in a scan directory
+PRODUCTS_FILENAME = 'sunscan_products.json'
+PRODUCTS_VERSION = 2  # to increase when the image processing changes
+
+
+class Product:
+    """
+    A product of the scan processing: a set of output images generated from the
+    reconstruction and from other products.
+    """
+
+    def __init__(self, name, create, inputs=(), params=(), outputs=(), load=None, enabled=True):
+        """
+        Args:
+            name (str): Product name, also the progress stage name.
+            create (function): create(values) generates the product from the values of the
+                reconstruction and of the inputs, and returns the product value.
+            inputs (tuple): Names of the products used by create.
+            params (tuple): Values of the scan parameters used by create.
+            outputs (tuple): Files the product may write. The files actually written are
+                recorded, the product is stale if one of them is missing.
+            load (function, optional): load() returns the product value from its files,
+                so that an up to date product is not generated again for another product.
+            enabled (bool): False if the product is not generated for this scan.
+        """
+        self.name = name
+        self.create = create
+        self.inputs = inputs
+        self.params = params
+        self.outputs = outputs
+        self.load = load
+        self.enabled = enabled
+
+
+def product_fingerprints(products, reconstruction_key):
+    """
+    Compute the fingerprint of each product from its parameters and the fingerprints of its inputs.
+
+    Args:
+        products (list): Products, each one after its inputs.
+        reconstruction_key (list): Fingerprints of the reconstruction and of the FITS header settings.
+
+    Returns:
+        dict: Fingerprint by product name.
+    """
+    fingerprints = {}
+    for product in products:
+        h = hashlib.sha1()
+        h.update(json.dumps([PRODUCTS_VERSION, product.name, reconstruction_key, list(product.params),
+                             [fingerprints[name] for name in product.inputs]], default=str).encode())
+        fingerprints[product.name] = h.hexdigest()
+    return fingerprints
+
+
+def run_products(wd, products, requested, reconstruction_key, get_reconstruction, progress):
+    """
+    Generate the requested products which are not up to date, with the inputs they need.
+
+    Args:
+        wd (str): Scan directory.
+        products (list): Products, each one after its inputs.
+        requested (list): Names of the requested products, None for all.
+        reconstruction_key (list): Fingerprints of the reconstruction and of the FITS header settings.
+        get_reconstruction (function): Returns the reconstruction values (frames, header, cercle).
+        progress (function): Called with the name of each generated product.
+
+    Returns:
+        list: Names of the generated products.
+    """
+    by_name = {product.name: product for product in products}
+    fingerprints = product_fingerprints(products, reconstruction_key)
+    state_file = os.path.join(wd, PRODUCTS_FILENAME)
+    try:
+        with open(state_file) as f:
+            state = json.load(f)
+    except Exception:
+        state = {}
+
+    def is_stale(product):
+        entry = state.get(product.name)
+        if not isinstance(entry, dict) or entry.get('fingerprint') != fingerprints[product.name]:
+            return True
+        return not all(os.path.exists(os.path.join(wd, output)) for output in entry.get('outputs', []))
+
+    def written(product, started):
+        # outputs written since the product generation started, some are optional
+        # (number of frames, doppler, planisphere, color)
+        paths = [(output, os.path.join(wd, output)) for output in product.outputs]
+        return [output for output, path in paths if os.path.exists(path) and os.path.getmtime(path) >= started]
+
+    values = {}
+    generated = []
+
+    def value(name):
+        # value of a product, generated if stale or without loader
+        if name in values:
+            return values[name]
+        product = by_name[name]
+        if not is_stale(product) and product.load:
+            try:
+                values[name] = product.load()
+                return values[name]
+            except Exception as e:
+                print('product', name, 'cannot be loaded', e)
+        progress(name)
+        inputs = dict(get_reconstruction())
+        for input_name in product.inputs:
+            inputs[input_name] = value(input_name)
+        started = time.time() - 1  # file dates may be rounded to the second
+        values[name] = product.create(inputs)
+        generated.append(name)
+        state[name] = {'fingerprint': fingerprints[name], 'outputs': written(product, started)}
+        with open(state_file, 'w') as f:
+            json.dump(state, f)
+        return values[name]
+
+    for product in products:
+        if not product.enabled or (requested is not None and product.name not in requested):
+            continue
+        if is_stale(product):
+            value(product.name)
+    return generated
+
+
+def read_scan_conf(path):
+    """
+    Read the capture settings saved with a scan, used by update_header.
+
+    Args:
+        path (str): Scan directory.
+
+    Returns:
+        str: Content of sunscan_conf.txt, empty if there is none.
+    """
+    try:
+        with open(os.path.join(path, 'sunscan_conf.txt')) as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def process_scan(callback, scan, progress=None):
     """
     Process a solar scan from a .ser file and generate various images.
 
+    The images are grouped in products (surface, continuum, protus, doppler, helium).
+    Only the products requested by scan.products (all if None) which are not up to
+    date with the scan parameters are generated.
+
     Args:
         serfile (str): Path to the .ser file.
         callback (function): Callback function to report processing status.
+        progress (function, optional): Called with the name of each processing stage.
         dopcont (bool): Flag to enable Doppler processing.
         autocrop (bool): Flag to enable auto-cropping.
         autocrop_size (int): Size for auto-cropping.
@@ -41,6 +190,7 @@ def process_scan(callback, scan):
     advanced=scan.advanced
     doppler_color=scan.doppler_color
     process_doppler=scan.process_doppler
+    requested=getattr(scan, 'products', None)
       
     if not os.path.exists(serfile):
         return callback(serfile, 'failed')
@@ -103,27 +253,71 @@ def process_scan(callback, scan):
         color = tag_value
         print('auto extracted line tag :'+color)
 
-    try:
-        # Process the SER file using solex_proc function
-        frames, header, cercle, range_dec, geom, polynome = solex_proc(serfile, Shift, Flags, ratio_fixe, ang_tilt, poly, data_entete, ang_P, solar_dict, param)
-        
-        header = update_header(WorkDir, header, observer)
-
-        if helium:
-            result_image = process_helium(WorkDir, frames, cercle, header, observer, apply_watermark_if_enable, Colorise_Image)
+    if progress is None:
+        progress = lambda stage: None
 
- 
-        else:
-            # Create and save surface image
-            raw = create_surface_image(WorkDir, frames, helium, surfaceSharpLevel, header, observer, color, cercle)
+    try:
+        cache_key = scan_cache.make_key(serfile, [Shift, Flags, ratio_fixe, ang_tilt, poly, data_entete, ang_P, solar_dict, param])
+        # the FITS header of every product is updated from sunscan_conf.txt
+        header_key = [cache_key, read_scan_conf(WorkDir)]
+        reconstruction = {}
+
+        def get_reconstruction():
+            # Process the SER file using solex_proc function, unless it was already
+            # reconstructed with the same inputs, only when a product needs it
+            if not reconstruction:
+                progress('reconstruction')
+                cached = scan_cache.load(serfile, cache_key)
+                if cached:
+                    print('reconstruction loaded from cache')
+                    frames, header, cercle, range_dec, geom, polynome = cached
+                else:
+                    frames, header, cercle, range_dec, geom, polynome = solex_proc(serfile, Shift, Flags, ratio_fixe, ang_tilt, poly, data_entete, ang_P, solar_dict, param)
+                    scan_cache.save(serfile, cache_key, frames, header, cercle, range_dec, geom, polynome)
+                header = update_header(WorkDir, header, observer)
+                reconstruction.update(frames=frames, header=header, cercle=cercle)
+            return reconstruction
+
+        print('doppler:', dopcont)
+        products = [
+            Product('helium',
+                    lambda v: process_helium(WorkDir, v['frames'], v['cercle'], v['header'], observer, apply_watermark_if_enable, Colorise_Image),
+                    params=(observer,),
+                    outputs=('sunscan_helium.png', 'sunscan_helium.jpg', 'sunscan_helium_proj.jpg',
+                             'sunscan_helium_cont.png', 'sunscan_helium_cont.jpg', 'sunscan_helium_cont_proj.jpg',
+                             'sunscan_color.jpg', 'sunscan_cont.png', 'sunscan_cont.jpg', 'sunscan_cont_proj.jpg',
+                             'sunscan_preview.jpg'),
+                    enabled=helium),
+            # Create and save surface image, with the preview, returns the raw image
+            Product('surface',
+                    lambda v: create_surface_image(WorkDir, v['frames'], helium, surfaceSharpLevel, v['header'], observer, color, v['cercle']),
+                    params=(surfaceSharpLevel, observer, color),
+                    outputs=('sunscan_raw.png', 'sunscan_raw.jpg', 'sunscan_raw.fits',
+                             'sunscan_clahe.png', 'sunscan_clahe.jpg', 'sunscan_clahe.fits', 'sunscan_clahe_proj.jpg',
+                             'sunscan_preview.jpg', 'sunscan_color.jpg'),
+                    load=lambda: cv2.imread(os.path.join(WorkDir, 'sunscan_raw.png'), cv2.IMREAD_UNCHANGED),
+                    enabled=not helium),
             # Create and save continuum image
-            create_continuum_image(WorkDir, frames, contSharpLevel, header, observer)
+            Product('continuum',
+                    lambda v: create_continuum_image(WorkDir, v['frames'], contSharpLevel, v['header'], observer),
+                    params=(contSharpLevel, observer),
+                    outputs=('sunscan_cont.png', 'sunscan_cont.jpg', 'sunscan_cont_proj.jpg'),
+                    enabled=not helium),
             # Create and save prominence (protus) image
-            create_protus_image(WorkDir, cv2.flip(raw,0), cercle,proSharpLevel, header, observer, 'sunscan_protus')
+            Product('protus',
+                    lambda v: create_protus_image(WorkDir, cv2.flip(v['surface'],0), v['cercle'], proSharpLevel, v['header'], observer, 'sunscan_protus'),
+                    inputs=('surface',), params=(proSharpLevel, observer),
+                    outputs=('sunscan_protus.png', 'sunscan_protus.jpg'), enabled=not helium),
             # If doppler contrast is enabled, create and save doppler image
-            print('doppler:', dopcont)
-            if dopcont and process_doppler:
-                create_doppler_image(WorkDir, frames, cercle, header, observer, doppler_color)
+            Product('doppler',
+                    lambda v: create_doppler_image(WorkDir, v['frames'], v['cercle'], v['header'], observer, doppler_color),
+                    params=(doppler_color, observer),
+                    outputs=('sunscan_doppler.png', 'sunscan_doppler.jpg',
+                             'sunscan_protus_doppler.png', 'sunscan_protus_doppler.jpg'),
+                    enabled=not helium and dopcont and process_doppler),
+        ]
+        generated = run_products(WorkDir, products, requested, header_key, get_reconstruction, progress)
+        print('products generated :', generated)
         # Call the callback function to indicate successful completion
         callback(serfile, 'completed')
     except Exception as e:
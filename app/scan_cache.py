@@ -0,0 +1,117 @@
+"""
+Cache of the reconstruction of a scan.
+
+solex_proc results (reconstructed disks, header, circle, shifts, geometry and
+slit polynomial) are saved next to the SER file, keyed by a hash of the SER
+file and of the reconstruction inputs. A scan reprocessed with only image
+parameters changed (sharpen levels, doppler colour, watermark...) reuses them
+instead of running the reconstruction again.
+"""
+
+import hashlib
+import json
+import os
+
+import numpy as np
+from astropy.io import fits
+
+import config as cfg
+from live_recon import LIVE_FILENAME
+
+CACHE_FILENAME = 'scan_geometry.npz'
+CACHE_VERSION = 1  # to increase when the reconstruction output changes
+SER_HEADER_SIZE = 178
+
+
+def _jsonable(value):
+    """
+    Convert numpy values to JSON compatible values.
+
+    :param value: Any value
+    :return: The value as a list or a Python scalar when it is a numpy value
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+def make_key(serfile, inputs):
+    """
+    Compute the cache key of a reconstruction.
+
+    The SER file is identified by its size, modification date and header, the
+    frames are not read. The live reconstruction saved with the scan, which
+    solex_proc may use instead of the frames, is identified the same way.
+
+    :param serfile: Path of the SER file
+    :param inputs: List of the solex_proc inputs (Shift, Flags, ratio, tilt, poly...)
+    :return: Hexadecimal key
+    """
+    h = hashlib.sha1()
+    st = os.stat(serfile)
+    h.update(str((CACHE_VERSION, st.st_size, st.st_mtime_ns)).encode())
+    with open(serfile, 'rb') as f:
+        h.update(f.read(SER_HEADER_SIZE))
+    live_file = os.path.join(os.path.dirname(serfile), LIVE_FILENAME)
+    if os.path.exists(live_file):
+        st = os.stat(live_file)
+        h.update(str(('live', st.st_size, st.st_mtime_ns)).encode())
+    settings = {k: v for k, v in vars(cfg).items()
+                if not k.startswith('_') and isinstance(v, (bool, int, float, str))}
+    h.update(json.dumps([inputs, settings], sort_keys=True, default=_jsonable).encode())
+    return h.hexdigest()
+
+
+def save(serfile, key, frames, header, cercle, range_dec, geom, poly):
+    """
+    Save the reconstruction of a scan next to its SER file.
+
+    :param serfile: Path of the SER file
+    :param key: Cache key from make_key
+    :param frames: Reconstructed disks
+    :param header: FITS header of the disks
+    :param cercle: Disk circle (x0, y0, width, height)
+    :param range_dec: Pixel shifts of the disks
+    :param geom: Geometry [ratio, tilt]
+    :param poly: Slit polynomial
+    """
+    filename = os.path.join(os.path.dirname(serfile), CACHE_FILENAME)
+    meta = {'key': key,
+            'header': header.tostring(),
+            'cercle': cercle,
+            'range_dec': range_dec,
+            'geom': geom,
+            'poly': poly,
+            'count': len(frames)}
+    arrays = {'frame_%d' % i: frame for i, frame in enumerate(frames)}
+    try:
+        np.savez(filename, meta=np.array(json.dumps(meta, default=_jsonable)), **arrays)
+    except Exception as e:
+        print('scan cache, cannot write', filename, e)
+
+
+def load(serfile, key):
+    """
+    Load the reconstruction of a scan saved with the same key.
+
+    :param serfile: Path of the SER file
+    :param key: Cache key from make_key
+    :return: Tuple (frames, header, cercle, range_dec, geom, poly) as returned by
+             solex_proc, or None if there is no reconstruction for this key
+    """
+    filename = os.path.join(os.path.dirname(serfile), CACHE_FILENAME)
+    if not os.path.exists(filename):
+        return None
+    try:
+        with np.load(filename) as data:
+            meta = json.loads(str(data['meta']))
+            if meta['key'] != key:
+                return None
+            frames = [data['frame_%d' % i] for i in range(meta['count'])]
+    except Exception as e:
+        print('scan cache, cannot read', filename, e)
+        return None
+    header = fits.Header.fromstring(meta['header'])
+    return frames, header, np.array(meta['cercle']), meta['range_dec'], meta['geom'], np.array(meta['poly'])
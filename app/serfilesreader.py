@@ -18,6 +18,7 @@
     To be quick : this library can only be used by free/open softwares GPL compas.
 """
 
+import os
 import numpy as np
 import cv2, copy   
 from astropy.io import fits
@@ -65,13 +66,17 @@ class Serfile():
     Compatible with V3 specifitations :  http://www.grischa-hahn.homepage.t-online.de/astro/ser/SER%20Doc%20V3b.pdf
     
     usage : serfile = Serfile(filename, NEW) NEW is a boolean if you want to create a NEW File
+            serfile = Serfile(filename, memmap=True) to map all frames in memory (read only)
     
     Methods : 
     Public :
     .read() :           return a numpy frame,  position
     .getHeader() :      return SER file header in a dictionnary
-    .readFrameAtPos(n:int) : return frame number n.
+    .readFrameAtPos(n:int) : return frame number n. (zero-copy view in memmap mode)
+    .getFrames() :      return all frames as a (FrameCount, Height, Width) array
+    .close() :          release the memory map
     .dateFrameAtPos(n:int) : return UTC DATE of File if possible else -1.
+    .findFrameGaps(factor) : return indexes of frames following an abnormally long interval (trail needed)
     .getLength() :      return number of frame in SER file.
     .getWidth() :       return width of a frame
     .getHeight() :      return height of a frame
@@ -84,6 +89,9 @@ class Serfile():
     .testFile(filneame) : test if filename exist. RAISE : FileNotFoundError
     .getName()          return name of SER file.
     .addFrame(frame) : add a frame at the end of file
+    .openWriter(checkpoint:int) : open a buffered handle to stream frames at the end of file
+    .writeFrame(frame) : append a frame through the buffered handle
+    .closeWriter(trail) : flush frames, write trail (frame dates) and FrameCount, close the handle
     
     Private : 
     ._readExistingHeader() :    read header and return it in a dictionnary
@@ -119,13 +127,16 @@ class Serfile():
     self._debug         : Debug Flag
     self._header        : SER file header in a dictionnary
     self._bytesPerPixels : number of bytes per pixels (depends on "colorId"
+    self._memmap        : np.memmap of all frames when opened in memmap mode, else None
+    self._writer        : buffered file handle used by writeFrame, else None
+    self._checkpoint    : number of frames between two FrameCount updates while streaming
     
     Public : 
     
     
     """
     
-    def __init__(self, name_of_serfile, NEW=False, header = None):
+    def __init__(self, name_of_serfile, NEW=False, header = None, memmap=False):
         """
         Initialize a new Serfile object.
 
@@ -133,11 +144,16 @@ class Serfile():
             name_of_serfile (str): The name of the SER file.
             NEW (bool, optional): If True, create a new SER file. Defaults to False.
             header (dict, optional): Header information for a new file. Defaults to None.
+            memmap (bool, optional): If True, map the frames of an existing file in memory
+                and return frames as views instead of reading them from disk. Defaults to False.
         """
         self._nameOfSerfile = name_of_serfile
         
         self._debug = True
         self._trail = []
+        self._memmap = None
+        self._writer = None
+        self._checkpoint = 0
         if not NEW : 
             "" if self.testFile(self._nameOfSerfile) else self.quit()
             self._header, readOk, trail = self._readExistingHeader()
@@ -150,6 +166,8 @@ class Serfile():
             
             if trail : 
                 self._trail = self.readTrailFromHeader()
+            if memmap :
+                self._openMemmap()
         elif header is None : 
             self.createNewHeader()
         self._cursor = 0
@@ -176,15 +194,29 @@ class Serfile():
         Returns:
             list: A list of frame dates.
         """
-        trail = []
-        offset = self._header['ImageHeight'] * self._header['ImageWidth'] * self._header['FrameCount'] * self._bytesPerPixels + 178
+        offset = int(self._header['ImageHeight']) * int(self._header['ImageWidth']) * int(self._header['FrameCount']) * self._bytesPerPixels + 178
         with open(self._nameOfSerfile, 'rb') as file:
-            for i in range(self.getLength()):
-                file.seek(offset)
-                trail.append(np.fromfile(file, dtype='uint64', count=1)[0])
-                offset+=8    
+            file.seek(offset)
+            trail = np.fromfile(file, dtype='<u8', count=int(self._header['FrameCount']))
         return trail
     
+    def findFrameGaps(self, factor=1.5):
+        """
+        Find the frames recorded after an abnormally long interval (dropped or stalled frames).
+
+        Args:
+            factor (float, optional): An interval longer than factor * median interval is a gap. Defaults to 1.5.
+
+        Returns:
+            numpy.ndarray: Indexes n of the frames such that date(n) - date(n-1) is a gap.
+                Empty if the file has no trail.
+        """
+        if len(self._trail) < 3 :
+            return np.array([], dtype=int)
+        intervals = np.diff(np.asarray(self._trail, dtype='int64'))
+        median = np.median(intervals)
+        return np.nonzero(intervals > factor * median)[0] + 1
+    
     def getName():
         """
         Get the name of the SER file.
@@ -379,6 +411,50 @@ class Serfile():
         """
         return self.readFrameAtPos(self._cursor)
     
+    def _openMemmap(self):
+        """
+        Map all the frames of the SER file in memory as a read only array.
+
+        The shape is (FrameCount, Height, Width), or (FrameCount, Height, Width, 3)
+        for RGB files. If the file is shorter than announced by the header (interrupted
+        record), only the complete frames are mapped.
+        """
+        planes = 3 if self._header['ColorID'] > 19 else 1
+        dtype = 'uint8' if self._header['PixelDepthPerPlane'] <= 8 else 'uint16'
+        frame_bytes = self._frameDimension * self._bytesPerPixels
+        shape = (self._height, self._width) if planes == 1 else (self._height, self._width, planes)
+
+        count = int(self._length)
+        if frame_bytes > 0 :
+            available = (os.path.getsize(self._nameOfSerfile) - 178) // frame_bytes
+            count = max(0, min(count, int(available)))
+        if count == 0 :
+            self._memmap = np.zeros((0,) + shape, dtype=dtype)
+        else :
+            self._memmap = np.memmap(self._nameOfSerfile, dtype=dtype, mode='r', offset=178, shape=(count,) + shape)
+        self._length = count
+
+    def getFrames(self):
+        """
+        Get all the frames of the SER file.
+
+        In memmap mode no data is copied, frames are paged in from disk on access.
+
+        Returns:
+            numpy.ndarray: Array of shape (FrameCount, Height, Width).
+        """
+        if self._memmap is None :
+            self._openMemmap()
+        return self._memmap
+
+    def close(self):
+        """
+        Release the memory map of the SER file, if any.
+        The file is unmapped once the frames still referenced by the caller are released.
+        """
+        self._memmap = None
+        self._currentFrame = np.array([])
+
     def readFrameAtPos(self,n):
         """
         Read and return the frame at the specified position.
@@ -388,7 +464,13 @@ class Serfile():
 
         Returns:
             numpy.ndarray: The frame at the specified position, or -1 if out of range.
+                In memmap mode the frame is a read only view on the file.
         """
+        if self._memmap is not None :
+            if 0 <= n < self._length :
+                self._currentFrame = self._memmap[n]
+                return self._currentFrame
+            return -1
         if n<self._length : 
             with open(self._nameOfSerfile, 'rb') as file:
                 frame = np.array([])
@@ -731,6 +813,84 @@ class Serfile():
                 raise IndexError("tuple index out of range, may be Width and height are false. Shape :  %s"%(frame.shape))
             
     
+    def openWriter(self, checkpoint=100, buffering=4*1024*1024):
+        """
+        Open a single buffered handle to append frames at the end of the SER file.
+
+        Frames are then written with writeFrame(). FrameCount is only patched in the
+        header every `checkpoint` frames and on closeWriter(), so an interrupted
+        record is still readable up to the last checkpoint.
+
+        Args:
+            checkpoint (int, optional): Number of frames between two FrameCount updates.
+                0 to update it only on close. Defaults to 100.
+            buffering (int, optional): Size in bytes of the write buffer. Defaults to 4 MB.
+        """
+        if self._writer is not None :
+            return
+        self._checkpoint = checkpoint
+        self._writer = open(self._nameOfSerfile, 'r+b', buffering)
+        self._writer.seek(0, 2)
+
+    def writeFrame(self, frame):
+        """
+        Append a frame to the SER file through the buffered handle opened by openWriter().
+
+        Args:
+            frame (numpy.ndarray): The frame to add.
+
+        Raises:
+            IndexError: If the frame dimensions do not match the existing frames.
+        """
+        if self._writer is None :
+            self.openWriter()
+        try :
+            if self._length == 0 : #first frame
+                if self._header['ImageHeight'] != frame.shape[0] or self._header['ImageWidth'] != frame.shape[1] :
+                    self._updateHeader('ImageHeight',frame.shape[0])
+                    self._updateHeader('ImageWidth',frame.shape[1])
+                self._height = self._header.get('ImageHeight')
+                self._width = self._header.get('ImageWidth')
+                self._frameDimension = self._height * self._width
+            elif frame.shape[0] != self._height or frame.shape[1] != self._width :
+                raise IndexError
+            self._writer.write(memoryview(np.ascontiguousarray(frame)).cast('B'))
+            self._cursor += 1
+            self._length += 1
+            if self._checkpoint and self._length % self._checkpoint == 0 :
+                self._writeFrameCount()
+        except IndexError:
+                raise IndexError("tuple index out of range, may be Width and height are false. Shape :  %s"%(frame.shape,))
+
+    def _writeFrameCount(self):
+        """
+        Patch FrameCount in the header through the writer handle, then go back to the end of file.
+        """
+        self._writer.seek(38)
+        self._writer.write(np.uint32(self._length).tobytes())
+        self._writer.seek(0, 2)
+        self._header['FrameCount'] = np.uint32(self._length)
+
+    def closeWriter(self, trail=None):
+        """
+        Flush the pending frames, write the final FrameCount in the header and close the handle.
+
+        Args:
+            trail (array-like, optional): UTC date of each frame (SER timestamps, 100 ns ticks
+                since 0001-01-01), written after the frames in a single write. Ignored if its
+                length is not the number of frames. Defaults to None.
+        """
+        if self._writer is None :
+            return
+        if trail is not None and len(trail) == self._length and self._length > 0 :
+            self._writer.write(np.asarray(trail, dtype='<u8').tobytes())
+        self._writeFrameCount()
+        self._writer.close()
+        self._writer = None
+        self._header, readOk, trail = self._readExistingHeader()
+        if trail :
+            self._trail = self.readTrailFromHeader()
+
     def setImageHeight(self, height):
         """Set the image height in the header."""
         self._updateHeader('ImageHeight',height)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# the application modules are imported without package, as in app/main.py
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
@@ -0,0 +1,73 @@
+"""
+Parity of detect_edge_rows with the former row by row loop of detect_edge.
+"""
+
+import pytest
+
+np = pytest.importorskip('numpy')
+pytest.importorskip('scipy')
+pytest.importorskip('matplotlib')
+pytest.importorskip('cv2')
+pytest.importorskip('astropy')
+pytest.importorskip('ellipse')
+
+from scipy.ndimage import gaussian_filter1d
+
+import config as cfg
+from Inti_functions import detect_edge_rows
+
+
+def former_detect_edge_rows(img_c, r1, r2, largeur):
+    """
+    Former loop of detect_edge over the rows r1 to r2-1.
+    """
+    bord_gauche = []
+    bord_droit = []
+    bord_gaucheY = []
+    for i in range(r1, r2):
+        li = np.copy(img_c[i, :-5])
+        b = np.percentile(li, 97)
+        bb = b*0.7
+        if cfg.LowDyn:
+            bb = b*0.9
+        li[li > bb] = bb
+        li = gaussian_filter1d(li, 2)
+        li_filter = gaussian_filter1d(li, 11)
+        li_gr = np.gradient(li_filter)
+        x1li = li_gr.argmax()
+        x2li = li_gr.argmin()
+        if x1li == 0 or x2li == 0:
+            pass
+        else:
+            s = np.array([x1li, x2li])
+            if s.size != 0 and (s[-1]-s[0]) > largeur/2:
+                bord_gauche.append(s[0])
+                bord_droit.append(s[-1])
+                bord_gaucheY.append(i)
+    return bord_gauche, bord_droit, bord_gaucheY
+
+
+def synthetic_disk(height=300, width=400, radius=110):
+    """
+    Build a noisy uint16 solar disk with limb darkening on a dark background.
+    """
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    r = np.hypot(x - width/2, y - height/2) / radius
+    disk = np.where(r < 1, 30000 * (0.4 + 0.6*np.sqrt(np.clip(1 - r**2, 0, 1))), 500)
+    disk = disk + rng.normal(0, 200, size=disk.shape)
+    return np.clip(disk, 0, 65535).astype(np.uint16)
+
+
+@pytest.mark.parametrize('low_dyn', [False, True])
+def test_detect_edge_rows_matches_former_loop(monkeypatch, low_dyn):
+    monkeypatch.setattr(cfg, 'LowDyn', low_dyn)
+    img = synthetic_disk()
+    expected = former_detect_edge_rows(img, 50, 250, 220)
+    result = detect_edge_rows(img, 50, 250, 220)
+    assert len(result[2]) > 0
+    assert [list(map(int, r)) for r in result] == [list(map(int, e)) for e in expected]
+
+
+def test_detect_edge_rows_empty_range():
+    assert detect_edge_rows(synthetic_disk(), 100, 100, 220) == ([], [], [])